@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import subprocess
+import multiprocessing
+from types import SimpleNamespace
+
+from src.fake_printer import FakePrinter
+from src.ultimaker import Ultimaker
+from src.printer_state import PrinterSnapshot
+from src.text_formating import format_printjob_status, format_printer_status
+from src.utils import progress_bar
+
+
+# Benchmarks of the Ultimaker client against a local FakePrinter and of the message building paths.
+# Results are written as json, --compare reports the change of each benchmark against an older result file.
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+
+BENCH_USER_ID = 1
+PRINTJOB_STATES = ('printing', 'pre_print', 'post_print', 'paused', 'wait_cleanup', 'resuming', 'pausing', 'no_printjob', 'none', 'other')
+PRINTER_STATUSES = ('idle', 'printing', 'error', 'maintenance', 'booting', 'other')
+
+
+# Percentile (0-100) of sorted values, linear interpolation between the closest ranks
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * percent / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+# Run func iterations times (after warmup runs), setup is called before each run and is not timed.
+# Peak memory is measured in a separate pass, tracemalloc would slow down the timed runs.
+def measure(func, iterations, warmup=3, setup=None, memory_iterations=5):
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+
+    latencies = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        for _ in range(min(iterations, memory_iterations)):
+            if setup is not None:
+                setup()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'iterations': iterations,
+        'mean': total / iterations,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1],
+        'throughput': iterations / total if total > 0 else None,
+        'peak_memory': peak_memory
+    }
+
+
+# The fake printer runs in its own process, so its allocations and threads do not count for the client
+def serve_fake_printer(scenario, connection):
+    fake_printer = FakePrinter(scenario).start()
+    connection.send((fake_printer.printer_ip, fake_printer.camera_port, fake_printer.scenario['auth_id'], fake_printer.scenario['auth_key']))
+    connection.recv()
+    fake_printer.stop()
+
+def connect(printer_ip, camera_port, auth_id, auth_key):
+    config = SimpleNamespace(NAME='Benchmark', STATIC_IP=True, PRINTER_IP=printer_ip, PRINTER_MAC=None, PRINTER_SUBNET=None,
+                             CAMERA_PORT=camera_port, ULTIMAKER_ID=auth_id, ULTIMAKER_KEY=auth_key)
+    return Ultimaker('Benchmark', config)
+
+def client_benchmarks(ultimaker, model_path):
+    def abort_printjob():
+        ultimaker.put('api/v1/print_job/state', data={'target': 'abort'})
+
+    return [
+        ('ultimaker.get_printer_state', ultimaker.get_printer_state, None),
+        ('ultimaker.get_printjob_status', ultimaker.get_printjob_status, None),
+        ('ultimaker.get_camera_snapshot', ultimaker.get_camera_snapshot, None),
+        ('ultimaker.get_printer_image', ultimaker.get_printer_image, None),
+        ('ultimaker.get_printjob_thumbnail', ultimaker.get_printjob_thumbnail, None),
+        # the printer only takes a new job when there is none, the running one is aborted before each upload
+        ('ultimaker.print_model', lambda: ultimaker.print_model('benchmark.ufp', model_path), abort_printjob)
+    ]
+
+# Handlers answering from a snapshot, with a stub bot that only collects the messages
+def message_benchmarks(snapshot):
+    from src.auth import auth_load_users
+    from src.main_menu import MainMenu
+
+    auth_load_users({ 'access_levels': ['monitor', 'control'], 'users': [{ 'id': BENCH_USER_ID, 'access_level': 1, 'notify': False }] })
+
+    printer = SimpleNamespace(name='Benchmark', state_poller=SimpleNamespace(get_snapshot=lambda max_age=None: snapshot))
+    printer_bot = SimpleNamespace(fleet=SimpleNamespace(is_multi=lambda: False), get_printer=lambda context: printer)
+    main_menu = MainMenu(printer_bot)
+
+    messages = []
+    bot = SimpleNamespace(send_chat_action=lambda **kwargs: None, send_message=lambda **kwargs: messages.append(kwargs['text']))
+    user = SimpleNamespace(id=BENCH_USER_ID)
+    update = SimpleNamespace(message=SimpleNamespace(from_user=user), effective_chat=SimpleNamespace(id=BENCH_USER_ID))
+    context = SimpleNamespace(bot=bot, args=[], user_data={})
+
+    # handlers print exceptions instead of raising them, make sure the benchmark measures a real answer
+    for handler in (main_menu.get_printjob_cmd, main_menu.get_printer_cmd):
+        del messages[:]
+        handler(update, context)
+        if not messages or 'Status' not in messages[-1]:
+            raise RuntimeError('Benchmark: {} did not answer with a status message'.format(handler.__name__))
+
+    def format_states():
+        for state in PRINTJOB_STATES:
+            format_printjob_status(state)
+        for status in PRINTER_STATUSES:
+            format_printer_status(status)
+
+    def progress_bars():
+        for step in range(101):
+            progress_bar(step / 100.0)
+
+    return [
+        ('text_formating.format_status', format_states, None),
+        ('utils.progress_bar', progress_bars, None),
+        ('main_menu.get_printjob_cmd', lambda: main_menu.get_printjob_cmd(update, context), None),
+        ('main_menu.get_printer_cmd', lambda: main_menu.get_printer_cmd(update, context), None)
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    scenario = {
+        'latency': args.latency,
+        'camera_fps': 100,
+        'container_model_size': args.container_size,
+        'job': { 'name': 'benchmark.ufp', 'pre_print': 0, 'duration': 24 * 3600, 'post_print': 0, 'wait_cleanup': 0 }
+    }
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scenario': scenario,
+        'benchmarks': {}
+    }
+
+    connection, child_connection = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve_fake_printer, args=(scenario, child_connection), daemon=True)
+    server.start()
+    try:
+        ultimaker = connect(*connection.recv())
+        printer, printjob = ultimaker.get_printer_and_printjob_status()
+        snapshot = PrinterSnapshot(printer, printjob, time.time(), None)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = os.path.join(tmp_dir, 'benchmark.ufp')
+            with open(model_path, 'wb') as f:
+                f.write(os.urandom(args.upload_size))
+
+            benchmarks = [(name, func, setup, args.iterations) for name, func, setup in client_benchmarks(ultimaker, model_path)]
+            benchmarks += [(name, func, setup, args.message_iterations) for name, func, setup in message_benchmarks(snapshot)]
+
+            for name, func, setup, iterations in benchmarks:
+                if args.filter and args.filter not in name:
+                    continue
+                result = measure(func, iterations, setup=setup)
+                results['benchmarks'][name] = result
+                print_result(name, result)
+    finally:
+        connection.send('stop')
+        server.join(5)
+
+    return results
+
+def print_result(name, result):
+    print ('{:<36} p50 {:>9.3f} ms  p95 {:>9.3f} ms  p99 {:>9.3f} ms  {:>10.1f} ops/s  peak {:>8.1f} KiB'.format(
+        name, result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000, result['throughput'] or 0, result['peak_memory'] / 1024.0))
+
+# Print the change of p50, p95 and peak memory against the baseline results. Return names that got slower than threshold.
+def compare(baseline, results, threshold):
+    print ('\nCompared to {} ({}):'.format(baseline.get('commit'), baseline.get('timestamp')))
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            print ('{:<36} new'.format(name))
+            continue
+
+        changes = { key: (result[key] - before[key]) / before[key] if before[key] else 0.0 for key in ('p50', 'p95', 'peak_memory') }
+        slower = changes['p50'] > threshold
+        if slower:
+            regressions.append(name)
+        print ('{:<36} p50 {:>+7.1%}  p95 {:>+7.1%}  peak {:>+7.1%}{}'.format(
+            name, changes['p50'], changes['p95'], changes['peak_memory'], '  REGRESSION' if slower else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Ultimaker client and bot message paths against a fake printer')
+    parser.add_argument('--iterations', type=int, default=200, help='runs of each client benchmark')
+    parser.add_argument('--message-iterations', type=int, default=2000, help='runs of each message building benchmark')
+    parser.add_argument('--latency', type=float, default=0.0, help='latency added by the fake printer to each request (s)')
+    parser.add_argument('--upload-size', type=int, default=1024 * 1024, help='size of the model uploaded by print_model (bytes)')
+    parser.add_argument('--container-size', type=int, default=1024 * 1024, help='size of the model in the print job container (bytes)')
+    parser.add_argument('--filter', help='only run benchmarks with this text in their name')
+    parser.add_argument('--output', default='benchmark_results.json', help='json file the results are written to')
+    parser.add_argument('--compare', help='results json of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='p50 slowdown reported as regression (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    with open(args.output, 'wt') as f:
+        json.dump(results, f, indent=2)
+    print ('Results written to {}'.format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare, 'rt') as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
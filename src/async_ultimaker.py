@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import time
+import asyncio
+import httpx
+
+from .discovery import find_ip_by_mac
+from .mjpeg import MjpegFrameReader, parse_boundary
+from .metrics import observe_request, REDISCOVERIES
+from .ultimaker import UltimakerError, REQUEST_TIMEOUTS, endpoint_class, parse_printer_status, parse_printer_state, parse_printjob_status, parse_json_value, parse_put_result, parse_thumbnail
+
+
+class AsyncUltimaker:
+    # Asyncio version of Ultimaker with the same methods, all of them are coroutines.
+    # One httpx.AsyncClient keeps the connection pool and the digest auth state, so many requests can run on one event loop.
+    # Use AsyncUltimaker.create(...) or call connect() before the first request, and close() when done.
+    def __init__(self, application, config, ip_cache=None, discovery_workers=32, max_connections=20, timeouts=REQUEST_TIMEOUTS):
+        self.ip_cache = ip_cache
+        self.discovery_workers = discovery_workers
+        self.timeouts = timeouts
+        self.load_config(config)
+
+        self.__ip = None
+        self.__application = application
+        self.__client = httpx.AsyncClient(
+            auth=self.__auth,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=None
+        )
+
+    @classmethod
+    async def create(cls, application, config, **kwargs):
+        ultimaker = cls(application, config, **kwargs)
+        try:
+            await ultimaker.connect()
+        except UltimakerError:
+            await ultimaker.close()
+            raise
+        return ultimaker
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def load_config(self, config):
+        self.name = config.NAME
+        self.use_static_ip = config.STATIC_IP
+        self.printer_mac = config.PRINTER_MAC
+        self.printer_subnet = config.PRINTER_SUBNET
+        self.printer_ip = config.PRINTER_IP
+        self.camera_port = config.CAMERA_PORT
+
+        self.__auth = httpx.DigestAuth(config.ULTIMAKER_ID, config.ULTIMAKER_KEY)
+
+    async def connect(self):
+        if self.use_static_ip:
+            self.set_printer_ip(self.printer_ip)
+        else:
+            printer_ip = await self.get_ip_from_mac()
+            if printer_ip is None:
+                raise UltimakerError("Ultimaker: Could not find printer IP")
+            self.set_printer_ip(printer_ip)
+
+        if not await self.__check_auth():
+            raise UltimakerError("Ultimaker: Authentication Failed")
+
+    async def close(self):
+        await self.__client.aclose()
+
+    # The subnet sweep is blocking, it runs in the default executor of the loop.
+    async def get_ip_from_mac(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, find_ip_by_mac, self.printer_subnet, self.printer_mac, self.discovery_workers, self.ip_cache)
+
+    def set_printer_ip(self, ip):
+        self.__ip = ip
+
+    # Camera stream runs on its own port of the printer host. PRINTER_IP may contain the api port (e.g. for a local fake printer).
+    def camera_url(self, action):
+        return "http://{}:{}/?action={}".format(self.__ip.split(':')[0], self.camera_port, action)
+
+    async def reset_printer_ip(self):
+        ip = await self.get_ip_from_mac()
+        REDISCOVERIES.inc(printer=self.name, result='found' if ip is not None else 'not_found')
+        if ip is not None:
+            self.set_printer_ip(ip)
+            return True
+        return False
+
+    async def __check_auth(self):
+        response = await self.get("api/v1/auth/verify")
+        if response.status_code == 200:
+            return True
+        return False
+
+    async def request(self, method, path, **kwargs):
+        if "data" in kwargs:
+            kwargs["content"] = json.dumps(kwargs.pop("data"))
+        if "headers" not in kwargs:
+            kwargs["headers"] = {"Content-type": "application/json"}
+        if "timeout" not in kwargs:
+            connect, read = self.timeouts[endpoint_class(method, path)]
+            kwargs["timeout"] = httpx.Timeout(read, connect=connect)
+        try:
+            response = await self.__send(method, path, **kwargs)
+        except httpx.TimeoutException:
+            raise UltimakerError('Ultimaker: Printer at {} did not answer in time'.format(self.__ip))
+        except httpx.ConnectError:
+            if not self.use_static_ip:
+                # try to find new ip
+                if await self.reset_printer_ip():
+                    # try with new ip
+                    response = await self.__send(method, path, **kwargs)
+                else:
+                    # ip not found
+                    raise UltimakerError('Ultimaker: Could not get printer IP')
+            else:
+                raise UltimakerError('Ultimaker: Could not connect to printer at {}'.format(self.__ip))
+        return response
+
+    async def __send(self, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.__client.request(method, "http://{}/{}".format(self.__ip, path), **kwargs)
+        except httpx.HTTPError as ex:
+            observe_request(self.name, method, path, time.perf_counter() - start, error=ex)
+            raise
+        observe_request(self.name, method, path, time.perf_counter() - start, response)
+        return response
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def put(self, path, **kwargs):
+        return await self.request("PUT", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def get_printer_status(self):
+        return parse_printer_status(await self.get('api/v1/printer'))
+
+    async def get_printjob_status(self):
+        return parse_printjob_status(await self.get('api/v1/print_job'))
+
+    # Printer status and print job are requested at the same time, state and pause source both come with api/v1/print_job.
+    async def get_printer_state(self):
+        status_response, printjob_response = await asyncio.gather(self.get('api/v1/printer/status'), self.get('api/v1/print_job'))
+
+        return parse_printer_state(status_response, printjob_response)
+
+    async def get_printer_and_printjob_status(self):
+        return await asyncio.gather(self.get_printer_status(), self.get_printjob_status())
+
+    async def get_printjob_state(self):
+        return parse_json_value(await self.get('api/v1/print_job/state'), 'printjob_state', 'no_printjob')
+
+    async def get_printjob_pause_source(self):
+        return parse_json_value(await self.get('api/v1/print_job/pause_source'), 'pause_source', '')
+
+    async def get_history_events(self, offset=0, count=20):
+        return parse_json_value(await self.get('api/v1/history/events', params={'offset': offset, 'count': count}), 'events')
+
+    # The camera requests bypass request(), they get the camera timeouts here. The read timeout is per chunk of the stream.
+    def camera_timeout(self):
+        connect, read = self.timeouts['camera']
+        return httpx.Timeout(read, connect=connect)
+
+    # Yield camera frames continuously as memoryviews, each is valid until the next one is requested.
+    async def iter_printer_frames(self):
+        try:
+            async with self.__client.stream("GET", self.camera_url("stream"), auth=None, timeout=self.camera_timeout()) as stream:
+                reader = MjpegFrameReader(parse_boundary(stream.headers.get('Content-Type')))
+
+                async for chunk in stream.aiter_raw():
+                    reader.feed(chunk)
+                    frame = reader.next_frame()
+                    while frame is not None:
+                        yield frame
+                        frame = reader.next_frame()
+        except httpx.HTTPError as ex:
+            raise UltimakerError('Ultimaker: Could not read the camera at {} ({})'.format(self.__ip, type(ex).__name__))
+
+    async def get_printer_image(self):
+        frames = self.iter_printer_frames()
+        try:
+            async for frame in frames:
+                bio = io.BytesIO(frame)
+                bio.seek(0)
+                return bio
+        finally:
+            await frames.aclose()
+
+    async def get_camera_snapshot(self):
+        try:
+            response = await self.__client.get(self.camera_url("snapshot"), auth=None, timeout=self.camera_timeout())
+        except httpx.HTTPError as ex:
+            raise UltimakerError('Ultimaker: Could not read the camera at {} ({})'.format(self.__ip, type(ex).__name__))
+        bio = io.BytesIO(response.content)
+        bio.seek(0)
+        return bio
+
+    async def get_led_brightness(self):
+        return parse_json_value(await self.get('api/v1/printer/led/brightness'), 'level')
+
+    async def set_led_brightness(self, brightness):
+        return parse_put_result(await self.put('api/v1/printer/led/brightness', data=brightness))
+
+    async def pause_printjob(self):
+        return parse_put_result(await self.put('api/v1/print_job/state', data={'target': 'pause'}))
+
+    async def unpause_printjob(self):
+        return parse_put_result(await self.put('api/v1/print_job/state', data={'target': 'print'}))
+
+    async def print_model(self, name, path):
+        with open(path, 'rb') as f:
+            # multipart sets its own content type
+            response = await self.post('api/v1/print_job', files={"file": (name, f)}, headers={})
+
+        return response
+
+    async def get_printjob_container(self):
+        return await self.get('api/v1/print_job/container')
+
+    async def get_printjob_thumbnail(self):
+        return parse_thumbnail(await self.get_printjob_container())
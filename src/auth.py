@@ -1,32 +1,54 @@
+import os
 import json
+import threading
 from functools import wraps
 from telegram import Update
 from telegram.ext import Updater, CallbackContext
 
 
-AUTHORIZED_USERS = {}
-ACCESS_LEVELS = []
-USERS = []
-NOTIFY_GROUP = set()
+UNAUTHORIZED_TEXT = "You are not authorized to do this, send /myid to your admin to get access"
+
+
+class AuthIndex:
+    # Immutable lookup of the users config: user id -> (access level bitmask, notify).
+    # A user with access level n has the bits of levels 0..n, higher access levels get access to lower.
+    # It is never changed after it is built, a reload builds a new index and replaces the module INDEX.
+    def __init__(self, users_config):
+        access_levels = users_config['access_levels']
+        self.level_bits = { level: 1 << index for index, level in enumerate(access_levels) }
+
+        users = {}
+        for user in users_config['users']:
+            access_level = int(user['access_level'])
+            if not 0 <= access_level < len(access_levels):
+                raise ValueError('Auth: User {} has unknown access level {}'.format(user['id'], access_level))
+            users[user['id']] = ((1 << (access_level + 1)) - 1, bool(user.get('notify', False)))
+
+        self.users = users
+        self.notify_group = frozenset(user_id for user_id, (_, notify) in users.items() if notify)
+
+    def is_authorized(self, user_id, level):
+        user = self.users.get(user_id)
+        return user is not None and bool(user[0] & self.level_bits.get(level, 0))
+
+
+INDEX = AuthIndex({ 'access_levels': [], 'users': [] })
 
 def auth_load_users(users_config):
-    global NOTIFY_GROUP
-    ACCESS_LEVELS = users_config['access_levels']
-
-    USERS = users_config['users']
-    
-    for level in ACCESS_LEVELS:
-        AUTHORIZED_USERS[level] = set()
-
-    NOTIFY_GROUP = set()
-    
-    for user in USERS:
-        # higher access levels get acces to lower
-        for level in range(0, user['access_level'] + 1):
-            AUTHORIZED_USERS[ACCESS_LEVELS[level]].add(user['id'])
-        
-        if user['notify']:
-            NOTIFY_GROUP.add(user['id'])
+    global INDEX
+    INDEX = AuthIndex(users_config)
+
+# Load the users file. Raises IOError or ValueError, the current index is kept then.
+def auth_load_users_file(users_path):
+    with open(users_path, "rt") as f:
+        users_config = json.load(f)
+    auth_load_users(users_config)
+
+def auth_is_authorized(user_id, level):
+    return INDEX.is_authorized(user_id, level)
+
+def auth_get_notify_group():
+    return INDEX.notify_group
 
 def authorized(level):
 
@@ -37,14 +59,61 @@ def authorized(level):
                 user_id = update.message.from_user.id
             else:
                 user_id = update._effective_user.id
-            
-            if user_id in AUTHORIZED_USERS[level]:
+
+            if INDEX.is_authorized(user_id, level):
                 return function(self, update, context, *args, **kwargs)
 
+            print ('Auth: User {} is not authorized for {} ({})'.format(user_id, function.__name__, level))
+            try:
+                if update.callback_query is not None:
+                    update.callback_query.answer(text=UNAUTHORIZED_TEXT)
+                else:
+                    context.bot.send_message(chat_id=update.effective_chat.id, text=UNAUTHORIZED_TEXT)
+            except Exception as ex:
+                print ('Auth: Could not answer unauthorized user {}: {}'.format(user_id, ex))
+
         return wrapper
 
     return decorator
 
-def auth_get_notify_group():
-    return NOTIFY_GROUP
 
+class UsersFileWatcher:
+    # Reloads the users file when its modification time or size changes, checked every interval seconds.
+    # A file that can not be loaded (e.g. saved half way or invalid json) is reported and the previous users stay active.
+    def __init__(self, users_path, interval=2.0):
+        self.users_path = users_path
+        self.interval = interval
+        self.__stop = threading.Event()
+        self.__signature = self.__file_signature()
+
+    def __file_signature(self):
+        try:
+            stat = os.stat(self.users_path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def start(self):
+        threading.Thread(target=self.__run, name='UsersFileWatcher', daemon=True).start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def check(self):
+        signature = self.__file_signature()
+        if signature is None or signature == self.__signature:
+            return False
+
+        self.__signature = signature
+        try:
+            auth_load_users_file(self.users_path)
+        except (IOError, ValueError, KeyError, TypeError) as ex:
+            print ('Auth: Could not reload users file {}, keeping the current users: {}'.format(self.users_path, ex))
+            return False
+
+        print ('Auth: Reloaded users file {}'.format(self.users_path))
+        return True
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.check()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import io
+import time
+import threading
+
+
+class CameraFrameCache:
+    # Latest camera frame of one printer, shared by all image requests.
+    # With use_stream a background thread keeps one camera stream open and stores every frame.
+    # Otherwise (or if the stream stalls) a request for a frame older than max_age fetches a snapshot,
+    # requests arriving while that fetch is running wait for it instead of starting their own.
+    def __init__(self, ultimaker, max_age=1.0, use_stream=False, reconnect_delay=5.0):
+        self.ultimaker = ultimaker
+        self.max_age = max_age
+        self.use_stream = use_stream
+        self.reconnect_delay = reconnect_delay
+
+        self.__condition = threading.Condition()
+        self.__frame = None
+        self.__timestamp = 0
+        self.__fetching = False
+        self.__fetch_count = 0
+        self.__thread = None
+
+    def start(self):
+        if self.use_stream and self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='CameraFrameGrabber', daemon=True)
+            self.__thread.start()
+
+    # Return (frame bytes, timestamp) of the newest frame, (None, 0) if there is none yet
+    def get_latest(self):
+        with self.__condition:
+            return self.__frame, self.__timestamp
+
+    # Return image as BytesIO, None if it could not be retrieved
+    def get_image(self, max_age=None):
+        frame = self.get_frame(max_age)
+        if frame is None:
+            return None
+
+        bio = io.BytesIO(frame)
+        bio.seek(0)
+        return bio
+
+    # Return frame not older than max_age as bytes, None if it could not be retrieved
+    def get_frame(self, max_age=None):
+        if max_age is None:
+            max_age = self.max_age
+
+        with self.__condition:
+            fetch_count = self.__fetch_count
+            while True:
+                if self.__frame is not None and time.time() - self.__timestamp <= max_age:
+                    return self.__frame
+                if not self.__fetching:
+                    break
+                if self.__fetch_count != fetch_count:
+                    # the fetch we waited for has failed
+                    return None
+                self.__condition.wait()
+
+            self.__fetching = True
+
+        frame = None
+        try:
+            frame = self.ultimaker.get_camera_snapshot().getvalue()
+        except Exception as ex:
+            print ('Camera: Could not get snapshot: {}'.format(ex))
+        finally:
+            with self.__condition:
+                self.__fetching = False
+                self.__fetch_count += 1
+                if frame:
+                    self.__store(frame)
+                self.__condition.notify_all()
+
+        return frame if frame else None
+
+    def __store(self, frame):
+        self.__frame = frame
+        self.__timestamp = time.time()
+
+    def __run(self):
+        while True:
+            try:
+                for frame in self.ultimaker.iter_printer_frames():
+                    # the view is only valid until the next frame, keep a copy
+                    frame = bytes(frame)
+                    with self.__condition:
+                        self.__store(frame)
+                        self.__condition.notify_all()
+            except Exception as ex:
+                print ('Camera: Stream failed: {}'.format(ex))
+
+            time.sleep(self.reconnect_delay)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+
+class CircuitBreaker:
+    # Stops sending requests to a printer that keeps failing. After failure_threshold failed calls in a row
+    # the circuit opens and calls fail fast for reset_timeout seconds. Then one trial call is let through (half open):
+    # if it succeeds the circuit closes, if it fails the circuit opens again.
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.__lock = threading.Lock()
+        self.__state = CircuitBreaker.CLOSED
+        self.__failures = 0
+        self.__opened = 0.0
+        self.__trial_started = 0.0
+
+    @property
+    def state(self):
+        return self.__state
+
+    # Return True if a call may be made now
+    def allow(self):
+        with self.__lock:
+            if self.__state == CircuitBreaker.CLOSED:
+                return True
+
+            now = time.monotonic()
+            if self.__state == CircuitBreaker.OPEN:
+                if now < self.__opened + self.reset_timeout:
+                    return False
+                self.__state = CircuitBreaker.HALF_OPEN
+                self.__trial_started = now
+                return True
+
+            # half open: only the trial call, unless it never reported back
+            if now < self.__trial_started + self.reset_timeout:
+                return False
+            self.__trial_started = now
+            return True
+
+    def record_success(self):
+        with self.__lock:
+            self.__state = CircuitBreaker.CLOSED
+            self.__failures = 0
+
+    # Return True if this failure opened the circuit
+    def record_failure(self):
+        with self.__lock:
+            self.__failures += 1
+            if self.__state == CircuitBreaker.OPEN:
+                return False
+            if self.__state == CircuitBreaker.HALF_OPEN or self.__failures >= self.failure_threshold:
+                self.__state = CircuitBreaker.OPEN
+                self.__opened = time.monotonic()
+                return True
+            return False
+
+    # Let the next call through as a trial, e.g. when the printer was found at a new ip
+    def allow_trial(self):
+        with self.__lock:
+            if self.__state == CircuitBreaker.OPEN:
+                self.__opened = time.monotonic() - self.reset_timeout
+
+    # Seconds until the next trial call is let through, 0 if calls are allowed
+    def retry_in(self):
+        with self.__lock:
+            if self.__state != CircuitBreaker.OPEN:
+                return 0.0
+            return max(0.0, self.__opened + self.reset_timeout - time.monotonic())
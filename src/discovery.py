@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import threading
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+EMPTY_MAC = '00:00:00:00:00:00'
+
+
+# Get mac of the host, updating the arp table if the first lookup was empty. Return None if not found.
+def probe_mac(ip):
+    # imported on first use, printers with a static ip never need it
+    from getmac import get_mac_address
+
+    # try without network request
+    mac = get_mac_address(ip=ip)
+    # if we dont get mac from arp table try updating mac
+    if mac == EMPTY_MAC:
+        mac = get_mac_address(ip=ip, network_request=True)
+    # if we dont get mac from arp table again, it probably was
+    if mac == EMPTY_MAC:
+        mac = get_mac_address(ip=ip, network_request=True)
+    return mac
+
+def mac_matches(mac, target_mac):
+    return mac is not None and mac.lower() == target_mac.lower()
+
+
+class IpCache:
+    # Persistent mac -> ip bindings, so that a reconnect can check the last known host before sweeping the subnet.
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__bindings = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rt') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, mac):
+        with self.__lock:
+            return self.__bindings.get(mac.lower())
+
+    def set(self, mac, ip):
+        with self.__lock:
+            if self.__bindings.get(mac.lower()) == ip:
+                return
+            self.__bindings[mac.lower()] = ip
+            self.save()
+
+    # Write to a temporary file and rename it, so a crash never leaves a half written cache.
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wt') as f:
+                json.dump(self.__bindings, f, indent=4)
+            os.replace(tmp_path, self.path)
+        except IOError:
+            print ('Discovery: Could not save ip cache: {}'.format(self.path))
+
+
+# Probe all hosts of the subnet on a bounded worker pool. Stops submitting new probes as soon as the mac matches.
+# Failed probes are counted and the first error is printed, so e.g. a broken getmac is not taken for a missing printer.
+def sweep_subnet(subnet, mac, workers=32, skip=None):
+    hosts = (str(ip) for ip in ipaddress.IPv4Network(subnet) if str(ip) != skip)
+    found = threading.Event()
+    result = []
+    failures = { 'count': 0, 'first': None }
+    failures_lock = threading.Lock()
+
+    def probe(ip):
+        if found.is_set():
+            return
+        try:
+            host_mac = probe_mac(ip)
+        except Exception as ex:
+            with failures_lock:
+                failures['count'] += 1
+                if failures['first'] is None:
+                    failures['first'] = '{}: {}'.format(ip, ex)
+            return
+        if mac_matches(host_mac, mac):
+            result.append(ip)
+            found.set()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for ip in hosts:
+            pending.add(executor.submit(probe, ip))
+            # keep at most two probes per worker in flight
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if found.is_set():
+                break
+
+        if not found.is_set():
+            wait(pending)
+
+        for future in pending:
+            future.cancel()
+
+    if failures['count'] > 0:
+        print ('Discovery: {} probes of {} failed, first error {}'.format(failures['count'], subnet, failures['first']))
+
+    if result:
+        print ('host: ' + result[0] + ', mac: ' + mac)
+        return result[0]
+    return None
+
+# Find ip of the host with given mac. The cached host is probed first, the subnet is swept only if it does not match.
+def find_ip_by_mac(subnet, mac, workers=32, cache=None):
+    cached_ip = cache.get(mac) if cache is not None else None
+
+    if cached_ip is not None and mac_matches(probe_mac(cached_ip), mac):
+        return cached_ip
+
+    ip = sweep_subnet(subnet, mac, workers, skip=cached_ip)
+    if ip is not None and cache is not None:
+        cache.set(mac, ip)
+    return ip
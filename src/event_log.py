@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+# Event types of the printer event log (api/v1/history/events) that have their own notification event
+EVENT_TYPE_PRINT_STARTED = 0x20000
+EVENT_TYPE_PRINT_PAUSED = 0x20001
+EVENT_TYPE_PRINT_RESUMED = 0x20002
+EVENT_TYPE_PRINT_ABORTED = 0x20003
+EVENT_TYPE_PRINT_FINISHED = 0x20004
+EVENT_TYPE_PRINT_CLEARED = 0x20005
+
+# StateStore section of the cursors, by printer name
+STORE_SECTION = 'event_cursors'
+# Cursor of a log that was empty on the first sync, all entries after it are new
+EMPTY_CURSOR = { 'time': '', 'keys': [] }
+
+
+# Entries logged in the same second are told apart by their type and message
+def entry_key(entry):
+    return '{}:{}'.format(entry.get('type_id'), entry.get('message'))
+
+
+class EventLogSync:
+    # Reads the entries added to the printer event log since the last sync, so a transition shorter than the poll interval
+    # (a quick pause and resume, a brief error) is still notified. The log is read newest first, page by page,
+    # until the cursor is reached: usually one small page per sync. The cursor is the time of the newest entry read
+    # and the keys of the entries with that time, kept in the StateStore so no entry is missed or repeated after a restart.
+    # The first sync of a printer only sets the cursor, the history before it is not notified.
+    def __init__(self, ultimaker, store, name, page_size=20, max_pages=5):
+        self.ultimaker = ultimaker
+        self.store = store
+        self.name = name
+        self.page_size = page_size
+        self.max_pages = max_pages
+        # None until the first answer, False if the printer has no event log
+        self.available = None
+        self.__lock = threading.Lock()
+
+    # Return the new entries, oldest first. Raises UltimakerError if the printer can not be reached.
+    def sync(self):
+        with self.__lock:
+            cursor = self.store.get(STORE_SECTION, self.name)
+            entries = []
+            answered = False
+
+            for page in range(self.max_pages):
+                res = self.ultimaker.get_history_events(page * self.page_size, self.page_size)
+                if res['status_code'] != 200:
+                    if page == 0 and res['status_code'] == 404:
+                        self.available = False
+                    break
+                self.available = True
+                answered = True
+
+                page_entries = sorted(res['events'], key=lambda entry: entry['time'], reverse=True)
+                entries.extend(page_entries)
+                if cursor is None or len(page_entries) < self.page_size or page_entries[-1]['time'] < cursor['time']:
+                    break
+
+            if not entries:
+                if cursor is None and answered:
+                    self.store.set(STORE_SECTION, self.name, EMPTY_CURSOR)
+                return []
+
+            # entries logged while the pages were read shift the offsets, so an entry can be on two pages
+            unique = {}
+            for entry in entries:
+                unique.setdefault((entry['time'], entry_key(entry)), entry)
+            entries = sorted(unique.values(), key=lambda entry: entry['time'], reverse=True)
+
+            newest = entries[0]['time']
+            self.store.set(STORE_SECTION, self.name, {
+                'time': newest,
+                'keys': sorted(set(entry_key(entry) for entry in entries if entry['time'] == newest))
+            })
+
+            if cursor is None:
+                return []
+            new_entries = [entry for entry in entries if not self.seen(entry, cursor)]
+            new_entries.reverse()
+            return new_entries
+
+    def seen(self, entry, cursor):
+        if entry['time'] != cursor['time']:
+            return entry['time'] < cursor['time']
+        return entry_key(entry) in cursor['keys']
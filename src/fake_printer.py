@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+
+import io
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import hashlib
+import zipfile
+import argparse
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from .event_log import (EVENT_TYPE_PRINT_STARTED, EVENT_TYPE_PRINT_PAUSED, EVENT_TYPE_PRINT_RESUMED,
+                        EVENT_TYPE_PRINT_ABORTED, EVENT_TYPE_PRINT_FINISHED, EVENT_TYPE_PRINT_CLEARED)
+
+
+# Scenario used when none is given. Times are in seconds.
+DEFAULT_SCENARIO = {
+    # added to every response, latency_jitter is the max random extra
+    "latency": 0.0,
+    "latency_jitter": 0.0,
+    # share of api requests that fail, failure_mode is "error" (500 response) or "drop" (connection closed)
+    "failure_rate": 0.0,
+    "failure_mode": "error",
+    "auth_id": "fake_id",
+    "auth_key": "fake_key",
+    "led_brightness": 100,
+    "camera_fps": 10,
+    "camera_size": [320, 240],
+    # size of the model file in the job container, to make full container downloads expensive
+    "container_model_size": 1024 * 1024,
+    # print job started with the server, null for an idle printer
+    "job": {
+        "name": "fake_model.ufp",
+        "pre_print": 5,
+        "duration": 600,
+        "post_print": 5,
+        "wait_cleanup": 5
+    }
+}
+
+REALM = 'Jedi-API'
+DIGEST_FIELD_RE = re.compile(r'(\w+)=(?:"([^"]*)"|([^\s,]+))')
+
+
+def md5(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+class FakePrintJob:
+    # Print job progressing with wall time: pre_print -> printing -> post_print -> wait_cleanup -> done.
+    # Paused time does not count towards progress.
+    def __init__(self, name, pre_print=5, duration=600, post_print=5, wait_cleanup=5):
+        self.uuid = str(uuid.uuid4())
+        self.name = name
+        self.pre_print = pre_print
+        self.duration = duration
+        self.post_print = post_print
+        self.wait_cleanup = wait_cleanup
+
+        self.started = time.time()
+        self.datetime_started = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+        self.paused_at = None
+        self.paused_total = 0
+        self.pause_source = ''
+        # state at the last request, the event log gets an entry when it moves on with time
+        self.logged_state = 'pre_print'
+
+    def elapsed(self):
+        now = self.paused_at if self.paused_at is not None else time.time()
+        return now - self.started - self.paused_total
+
+    def state(self):
+        elapsed = self.elapsed()
+        if self.paused_at is not None:
+            return 'paused'
+        if elapsed < self.pre_print:
+            return 'pre_print'
+        if elapsed < self.pre_print + self.duration:
+            return 'printing'
+        if elapsed < self.pre_print + self.duration + self.post_print:
+            return 'post_print'
+        if elapsed < self.pre_print + self.duration + self.post_print + self.wait_cleanup:
+            return 'wait_cleanup'
+        return None
+
+    def progress(self):
+        return max(0.0, min(1.0, (self.elapsed() - self.pre_print) / float(self.duration)))
+
+    def pause(self, source='api'):
+        if self.paused_at is None and self.state() == 'printing':
+            self.paused_at = time.time()
+            self.pause_source = source
+
+    def resume(self):
+        if self.paused_at is not None:
+            self.paused_total += time.time() - self.paused_at
+            self.paused_at = None
+            self.pause_source = ''
+
+    def to_json(self):
+        time_elapsed = int(max(0, self.elapsed() - self.pre_print))
+        return {
+            'uuid': self.uuid,
+            'name': self.name,
+            'state': self.state(),
+            'progress': self.progress(),
+            'time_total': int(self.duration),
+            'time_elapsed': min(time_elapsed, int(self.duration)),
+            'datetime_started': self.datetime_started,
+            'datetime_finished': '',
+            'pause_source': self.pause_source
+        }
+
+
+class FakePrinter:
+    # Local stand-in for an Ultimaker printer serving the api endpoints used by Ultimaker and the camera on a second port.
+    # Latency, failures and the print job come from the scenario, see DEFAULT_SCENARIO.
+    # Use port=0 / camera_port=0 to get free ports, printer_ip is then the value to put into PRINTER_IP.
+    def __init__(self, scenario=None, host='127.0.0.1', port=0, camera_port=0):
+        self.scenario = dict(DEFAULT_SCENARIO)
+        self.scenario.update(scenario or {})
+
+        self.lock = threading.Lock()
+        self.led_brightness = self.scenario['led_brightness']
+        self.nonces = set()
+        self.request_count = 0
+        # event log entries, oldest first
+        self.events = []
+        self.job = self.new_job(self.scenario['job']) if self.scenario['job'] else None
+
+        self.api_server = ThreadingHTTPServer((host, port), self.handler(FakeApiHandler))
+        self.camera_server = ThreadingHTTPServer((host, camera_port), self.handler(FakeCameraHandler))
+        self.__threads = []
+        self.__frames = None
+
+    @property
+    def host(self):
+        return self.api_server.server_address[0]
+
+    @property
+    def port(self):
+        return self.api_server.server_address[1]
+
+    @property
+    def camera_port(self):
+        return self.camera_server.server_address[1]
+
+    @property
+    def printer_ip(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def handler(self, handler_class):
+        printer = self
+        return type(handler_class.__name__, (handler_class,), { 'printer': printer })
+
+    def start(self):
+        for server in (self.api_server, self.camera_server):
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in (self.api_server, self.camera_server):
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def new_job(self, job):
+        job = FakePrintJob(job.get('name', 'fake_model.ufp'), job.get('pre_print', 5), job.get('duration', 600),
+                           job.get('post_print', 5), job.get('wait_cleanup', 5))
+        self.log_event(EVENT_TYPE_PRINT_STARTED, 'Print job {} started'.format(job.name))
+        return job
+
+    def log_event(self, type_id, message):
+        self.events.append({
+            'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+            'type_id': type_id,
+            'message': message,
+            'parameters': []
+        })
+
+    # Newest first, like the printer
+    def history_events(self, offset=0, count=20):
+        with self.lock:
+            events = list(reversed(self.events))
+        return events[offset:offset + count]
+
+    # Current job, None when there is no job or it has finished
+    def current_job(self):
+        with self.lock:
+            if self.job is not None:
+                state = self.job.state()
+                if self.job.logged_state in ('printing', 'paused') and state in ('post_print', 'wait_cleanup', None):
+                    self.log_event(EVENT_TYPE_PRINT_FINISHED, 'Print job {} finished'.format(self.job.name))
+                if state is None:
+                    self.log_event(EVENT_TYPE_PRINT_CLEARED, 'Print job {} removed from the build plate'.format(self.job.name))
+                    self.job = None
+                else:
+                    self.job.logged_state = state
+            return self.job
+
+    def printer_status(self):
+        return 'printing' if self.current_job() is not None else 'idle'
+
+    def printer_json(self):
+        job = self.current_job()
+        printing = job is not None and job.state() in ('printing', 'paused')
+        return {
+            'status': self.printer_status(),
+            'bed': { 'temperature': { 'current': 60.0 + random.uniform(-0.5, 0.5) if printing else 22.0, 'target': 60.0 if printing else 0.0 } },
+            'heads': [{ 'extruders': [{
+                'hotend': { 'temperature': { 'current': 210.0 + random.uniform(-1, 1) if printing else 24.0, 'target': 210.0 if printing else 0.0 } },
+                'feeder': { 'max_speed': 45.0 }
+            }] }],
+            'led': { 'brightness': self.led_brightness }
+        }
+
+    def container(self):
+        job = self.current_job()
+        if job is None:
+            return None
+
+        bio = io.BytesIO()
+        with zipfile.ZipFile(bio, 'w') as zf:
+            zf.writestr('/3D/model.gcode', b';FLAVOR:Griffin\n' + b'G1 X0 Y0\n' * (self.scenario['container_model_size'] // 9))
+            zf.writestr('/Metadata/thumbnail.png', self.frame(job.progress()))
+        return bio.getvalue()
+
+    # Camera frame showing the progress, frames are rendered once and reused
+    def frame(self, progress=0.0):
+        if self.__frames is None:
+            from PIL import Image, ImageDraw
+            frames = []
+            width, height = self.scenario['camera_size']
+            for step in range(11):
+                img = Image.new('RGB', (width, height), (40, 40, 40))
+                draw = ImageDraw.Draw(img)
+                draw.rectangle([10, height - 30, 10 + (width - 20) * step // 10, height - 10], fill=(0, 160, 255))
+                draw.text((10, 10), 'Fake printer {}%'.format(step * 10), fill=(255, 255, 255))
+                bio = io.BytesIO()
+                img.save(bio, format='JPEG', quality=80)
+                frames.append(bio.getvalue())
+            self.__frames = frames
+        return self.__frames[int(progress * 10)]
+
+    def current_frame(self):
+        job = self.current_job()
+        return self.frame(job.progress() if job is not None else 0.0)
+
+    def delay(self):
+        latency = self.scenario['latency'] + random.uniform(0, self.scenario['latency_jitter'])
+        if latency > 0:
+            time.sleep(latency)
+
+    def should_fail(self):
+        return random.random() < self.scenario['failure_rate']
+
+    def new_nonce(self):
+        nonce = uuid.uuid4().hex
+        with self.lock:
+            self.nonces.add(nonce)
+        return nonce
+
+    # Check RFC 2617 digest authorization header (qop=auth, MD5)
+    def check_digest(self, method, header):
+        if header is None or not header.startswith('Digest '):
+            return False
+
+        fields = { key: quoted or plain for key, quoted, plain in DIGEST_FIELD_RE.findall(header[len('Digest '):]) }
+        if fields.get('username') != self.scenario['auth_id'] or fields.get('nonce') not in self.nonces:
+            return False
+
+        ha1 = md5('{}:{}:{}'.format(self.scenario['auth_id'], REALM, self.scenario['auth_key']))
+        ha2 = md5('{}:{}'.format(method, fields.get('uri', '')))
+        if 'qop' in fields:
+            expected = md5('{}:{}:{}:{}:{}:{}'.format(ha1, fields['nonce'], fields.get('nc', ''), fields.get('cnonce', ''), fields['qop'], ha2))
+        else:
+            expected = md5('{}:{}:{}'.format(ha1, fields['nonce'], ha2))
+        return fields.get('response') == expected
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    printer = None
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, with Nagle every keep-alive response would wait for the delayed ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length > 0 else b''
+
+
+class FakeApiHandler(FakeHandler):
+    AUTH_PATHS = ('/api/v1/auth/verify',)
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_PUT(self):
+        self.handle_api('PUT')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def handle_api(self, method):
+        printer = self.printer
+        with printer.lock:
+            printer.request_count += 1
+
+        body = self.read_body() if method != 'GET' else b''
+        printer.delay()
+
+        if printer.should_fail():
+            if printer.scenario['failure_mode'] == 'drop':
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            return self.send_body(500, { 'message': 'Simulated failure' })
+
+        path = urlparse(self.path).path
+        if method != 'GET' or path in self.AUTH_PATHS:
+            if not printer.check_digest(method, self.headers.get('Authorization')):
+                nonce = printer.new_nonce()
+                return self.send_body(401, { 'message': 'Authorization required' }, headers={
+                    'WWW-Authenticate': 'Digest realm="{}", nonce="{}", qop="auth", algorithm=MD5'.format(REALM, nonce)
+                })
+
+        route = (method, path)
+        if route == ('GET', '/api/v1/auth/verify'):
+            return self.send_body(200, { 'message': 'ok' })
+        if route == ('GET', '/api/v1/printer'):
+            return self.send_body(200, printer.printer_json())
+        if route == ('GET', '/api/v1/printer/status'):
+            return self.send_body(200, printer.printer_status())
+        if route == ('GET', '/api/v1/printer/led/brightness'):
+            return self.send_body(200, printer.led_brightness)
+        if route == ('PUT', '/api/v1/printer/led/brightness'):
+            printer.led_brightness = json.loads(body.decode('utf-8'))
+            return self.send_body(200, { 'message': 'ok' })
+        if route == ('POST', '/api/v1/print_job'):
+            return self.start_job(body)
+        if route == ('GET', '/api/v1/history/events'):
+            printer.current_job()
+            query = parse_qs(urlparse(self.path).query)
+            return self.send_body(200, printer.history_events(int(query.get('offset', ['0'])[0]), int(query.get('count', ['20'])[0])))
+        if path.startswith('/api/v1/print_job'):
+            return self.handle_print_job(method, path, body)
+
+        self.send_body(404, { 'message': 'Not found' })
+
+    def handle_print_job(self, method, path, body):
+        printer = self.printer
+        job = printer.current_job()
+        if job is None:
+            return self.send_body(404, { 'message': 'No print job' })
+
+        if path == '/api/v1/print_job' and method == 'GET':
+            return self.send_body(200, job.to_json())
+        if path == '/api/v1/print_job/state' and method == 'GET':
+            return self.send_body(200, job.state())
+        if path == '/api/v1/print_job/state' and method == 'PUT':
+            target = json.loads(body.decode('utf-8')).get('target')
+            with printer.lock:
+                if target == 'pause' and job.paused_at is None and job.state() == 'printing':
+                    job.pause()
+                    printer.log_event(EVENT_TYPE_PRINT_PAUSED, 'Print job {} paused'.format(job.name))
+                elif target == 'print' and job.paused_at is not None:
+                    job.resume()
+                    printer.log_event(EVENT_TYPE_PRINT_RESUMED, 'Print job {} resumed'.format(job.name))
+                elif target == 'abort':
+                    printer.job = None
+                    printer.log_event(EVENT_TYPE_PRINT_ABORTED, 'Print job {} aborted'.format(job.name))
+            return self.send_body(200, { 'message': 'ok' })
+        if path == '/api/v1/print_job/pause_source' and method == 'GET':
+            return self.send_body(200, job.pause_source)
+        if path == '/api/v1/print_job/container' and method == 'GET':
+            return self.send_range(printer.container(), 'application/zip')
+
+        self.send_body(404, { 'message': 'Not found' })
+
+    # Serve single byte ranges (bytes=a-b, bytes=a-, bytes=-n) like the printer web server
+    def send_range(self, content, content_type):
+        range_header = self.headers.get('Range')
+        match = re.match(r'bytes=(\d*)-(\d*)$', range_header or '')
+        if match is None or (match.group(1) == '' and match.group(2) == ''):
+            return self.send_body(200, content, content_type, { 'Accept-Ranges': 'bytes' })
+
+        size = len(content)
+        if match.group(1) == '':
+            start, end = max(0, size - int(match.group(2))), size - 1
+        else:
+            start = int(match.group(1))
+            end = min(size - 1, int(match.group(2))) if match.group(2) != '' else size - 1
+        if start >= size or start > end:
+            return self.send_body(416, b'', content_type, { 'Content-Range': 'bytes */{}'.format(size) })
+
+        self.send_body(206, content[start:end + 1], content_type, {
+            'Accept-Ranges': 'bytes',
+            'Content-Range': 'bytes {}-{}/{}'.format(start, end, size)
+        })
+
+    def start_job(self, body):
+        printer = self.printer
+        if printer.current_job() is not None:
+            return self.send_body(405, { 'message': 'Printer is busy' })
+
+        match = re.search(br'filename="([^"]*)"', body)
+        name = match.group(1).decode('utf-8') if match is not None else 'uploaded.ufp'
+        job = dict(printer.scenario['job'] or {})
+        job['name'] = name
+        with printer.lock:
+            printer.job = printer.new_job(job)
+        self.send_body(201, { 'message': 'ok', 'uuid': printer.job.uuid })
+
+
+class FakeCameraHandler(FakeHandler):
+    BOUNDARY = 'boundarydonotcross'
+
+    def do_GET(self):
+        action = parse_qs(urlparse(self.path).query).get('action', [''])[0]
+        if action == 'snapshot':
+            self.printer.delay()
+            return self.send_body(200, self.printer.current_frame(), 'image/jpeg')
+        if action == 'stream':
+            return self.stream()
+        self.send_body(404, { 'message': 'Not found' })
+
+    def stream(self):
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace;boundary={}'.format(self.BOUNDARY))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        interval = 1.0 / self.printer.scenario['camera_fps']
+        try:
+            while True:
+                frame = self.printer.current_frame()
+                self.wfile.write('--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n'.format(self.BOUNDARY, len(frame)).encode('ascii'))
+                self.wfile.write(frame)
+                self.wfile.write(b'\r\n')
+                time.sleep(interval)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Ultimaker printer for offline testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--camera-port', type=int, default=8080)
+    parser.add_argument('--scenario', help='json file with scenario values, see DEFAULT_SCENARIO')
+    args = parser.parse_args()
+
+    scenario = None
+    if args.scenario is not None:
+        with open(args.scenario, 'rt') as f:
+            scenario = json.load(f)
+
+    fake_printer = FakePrinter(scenario, args.host, args.port, args.camera_port).start()
+    print ('Fake printer: PRINTER_IP={} CAMERA_PORT={} ULTIMAKER_ID={} ULTIMAKER_KEY={}'.format(
+        fake_printer.printer_ip, fake_printer.camera_port, fake_printer.scenario['auth_id'], fake_printer.scenario['auth_key']))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake_printer.stop()
+        sys.exit(0)
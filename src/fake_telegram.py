@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qsl
+
+
+# Local stand-in for Telegram to try the bot in webhook mode without a public url.
+# It posts updates (messages, button callbacks) to the bot's webhook listener and answers the Bot api calls
+# the bot makes when BOT_API_URL points at it, printing the replies. For example:
+#
+#   BOT_MODE=webhook WEBHOOK_PATH=hook BOT_API_URL=http://127.0.0.1:8081/bot
+#   python -m src.fake_telegram --webhook http://127.0.0.1:8443/hook --user-id 1 /start "Printer Status 🖨"
+
+BOT_USER = { 'id': 1000, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot' }
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+def make_user(user_id):
+    return { 'id': user_id, 'is_bot': False, 'first_name': 'User {}'.format(user_id) }
+
+def make_message(user_id, text, from_bot=False):
+    return {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': { 'id': user_id, 'type': 'private' },
+        'from': BOT_USER if from_bot else make_user(user_id),
+        'text': text
+    }
+
+# Text message, commands are marked as bot_command like Telegram does
+def message_update(user_id, text):
+    message = make_message(user_id, text)
+    if text.startswith('/'):
+        message['entities'] = [{ 'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ', 1)[0]) }]
+    return { 'update_id': next(update_ids), 'message': message }
+
+# Inline button press on a message sent by the bot
+def callback_update(user_id, data):
+    return {
+        'update_id': next(update_ids),
+        'callback_query': {
+            'id': str(next(update_ids)),
+            'from': make_user(user_id),
+            'chat_instance': str(user_id),
+            'message': make_message(user_id, 'menu', from_bot=True),
+            'data': data
+        }
+    }
+
+def post_update(webhook_url, update):
+    request = urllib.request.Request(webhook_url, data=json.dumps(update).encode('utf-8'),
+                                     headers={ 'Content-Type': 'application/json' }, method='POST')
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status
+
+
+class FakeBotApi:
+    # Answers Bot api calls with plausible results and keeps them in calls as (method, params)
+    def __init__(self, host='127.0.0.1', port=0, verbose=True):
+        self.calls = []
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                api.handle(self)
+
+            def do_GET(self):
+                api.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+
+    @property
+    def url(self):
+        return 'http://{}:{}/bot'.format(*self.server.server_address)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, handler):
+        method = handler.path.rsplit('/', 1)[-1]
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length > 0 else b''
+        params = self.parse_params(handler.headers.get('Content-Type', ''), body)
+
+        with self.lock:
+            self.calls.append((method, params))
+        if self.verbose:
+            print ('{} {}'.format(method, json.dumps({ key: value for key, value in params.items() if key != 'reply_markup' }, ensure_ascii=False)))
+
+        response = json.dumps({ 'ok': True, 'result': self.result(method, params) }).encode('utf-8')
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(response)))
+        handler.end_headers()
+        handler.wfile.write(response)
+
+    def parse_params(self, content_type, body):
+        if content_type.startswith('application/json'):
+            return json.loads(body.decode('utf-8')) if body else {}
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return dict(parse_qsl(body.decode('utf-8')))
+        # multipart uploads (photos, documents), only the size is kept
+        return { 'body_size': len(body) }
+
+    def result(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method.startswith('send') and method != 'sendChatAction' or method.startswith('edit'):
+            return make_message(int(params.get('chat_id', 0) or 0), params.get('text', ''), from_bot=True)
+        if method in ('getUpdates', 'getMyCommands'):
+            return []
+        return True
+
+
+# Post the update, retrying while the webhook listener is not up yet (e.g. the bot is still starting)
+def post_update_when_ready(webhook_url, update, timeout=60):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return post_update(webhook_url, update)
+        except urllib.error.URLError as ex:
+            if time.time() > deadline or not isinstance(ex.reason, ConnectionError):
+                raise
+            time.sleep(0.5)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer the Bot api calls of the bot and post updates to its webhook')
+    parser.add_argument('--api-port', type=int, default=8081, help='port of the fake Bot api, BOT_API_URL=http://127.0.0.1:<port>/bot')
+    parser.add_argument('--webhook', help='webhook url of the bot, e.g. http://127.0.0.1:8443/<WEBHOOK_PATH>')
+    parser.add_argument('--user-id', type=int, default=1)
+    parser.add_argument('--callback', action='store_true', help='send the texts as inline button presses')
+    parser.add_argument('--wait', type=float, default=2.0, help='seconds to wait for the replies of each update')
+    parser.add_argument('texts', nargs='*', help='messages (or callback data) to send, without any the Bot api is served until interrupted')
+    args = parser.parse_args()
+
+    # the bot asks the Bot api who it is when it starts, so the api has to run before the bot
+    api = FakeBotApi(port=args.api_port).start()
+    try:
+        if args.texts and args.webhook is not None:
+            for text in args.texts:
+                update = callback_update(args.user_id, text) if args.callback else message_update(args.user_id, text)
+                print ('> {} ({})'.format(text, post_update_when_ready(args.webhook, update)))
+                time.sleep(args.wait)
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    api.stop()
+    sys.exit(0)
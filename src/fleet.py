@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .ultimaker import Ultimaker, UltimakerError
+from .discovery import IpCache
+from .printer_state import PrinterStatePoller
+from .scheduler import AdaptiveSchedule
+from .camera import CameraFrameCache
+from .telemetry import TelemetryBuffer
+from .thumbnails import ThumbnailCache
+
+
+class FleetPrinter:
+    # One printer of the fleet: its client, its poller, its camera frame cache, its telemetry and its own notification state.
+    def __init__(self, name, ultimaker, state_poller, camera, telemetry):
+        self.name = name
+        self.ultimaker = ultimaker
+        self.state_poller = state_poller
+        self.camera = camera
+        self.telemetry = telemetry
+        self.thumbnails = ThumbnailCache(ultimaker)
+        self.state_poller.add_listener(self.telemetry.record_snapshot)
+        self.state_poller.add_listener(self.thumbnails.on_snapshot)
+
+        # last notified state, compared with each new snapshot
+        self.printer_status = None
+        self.printjob_state = None
+
+        # snapshots (with their event log entries) waiting to be notified, handled in order under status_lock
+        self.pending_snapshots = deque()
+        self.status_lock = threading.Lock()
+
+        # TimelapseRecorder of the running print job
+        self.timelapse = None
+
+        # EventLogSync of the printer, notifications come from its entries when the printer has an event log
+        self.event_log = None
+
+
+class PrinterFleet:
+    def __init__(self, app_name, config):
+        self.ip_cache = IpCache(config.IP_CACHE_FILE)
+        self.printers = OrderedDict()
+
+        client_options = {
+            'retries': config.REQUEST_RETRIES,
+            'retry_backoff': config.REQUEST_RETRY_BACKOFF,
+            'breaker_failures': config.BREAKER_FAILURES,
+            'breaker_reset': config.BREAKER_RESET
+        }
+
+        # connecting can mean a subnet sweep, so all printers are connected at the same time
+        with ThreadPoolExecutor(max_workers=len(config.PRINTERS)) as executor:
+            futures = [(printer_config, executor.submit(Ultimaker, app_name, printer_config, self.ip_cache, config.DISCOVERY_WORKERS, **client_options))
+                        for printer_config in config.PRINTERS]
+
+            for printer_config, future in futures:
+                try:
+                    ultimaker = future.result()
+                except UltimakerError as uer:
+                    print ('{} ({})'.format(uer.message, printer_config.NAME))
+                    continue
+
+                schedule = AdaptiveSchedule(config.STATUS_UPDATE_INTERVAL, config.FAST_UPDATE_INTERVAL,
+                                            config.IDLE_UPDATE_INTERVAL, config.MAX_UPDATE_BACKOFF)
+                state_poller = PrinterStatePoller(ultimaker, config.STATUS_UPDATE_INTERVAL, config.STATE_CACHE_TTL, schedule)
+                camera = CameraFrameCache(ultimaker, config.CAMERA_MAX_AGE, config.CAMERA_STREAM)
+                telemetry = TelemetryBuffer(config.TELEMETRY_CAPACITY)
+                self.printers[printer_config.NAME] = FleetPrinter(printer_config.NAME, ultimaker, state_poller, camera, telemetry)
+
+        if len(self.printers) == 0:
+            raise UltimakerError("Ultimaker: Could not connect to any printer")
+
+    def names(self):
+        return list(self.printers.keys())
+
+    def is_multi(self):
+        return len(self.printers) > 1
+
+    def default(self):
+        return next(iter(self.printers.values()))
+
+    # Return printer by name (case insensitive), None if there is no such printer
+    def get(self, name):
+        if name is None:
+            return None
+        for printer in self.printers.values():
+            if printer.name.lower() == name.lower():
+                return printer
+        return None
+
+    # Each poller runs in its own thread, so a poll cycle takes as long as the slowest printer.
+    def start(self):
+        for printer in self.printers.values():
+            printer.state_poller.start()
+            printer.camera.start()
+
+    # Listener is called with (printer, snapshot) on every new snapshot of any printer.
+    def add_listener(self, listener):
+        for printer in self.printers.values():
+            printer.state_poller.add_listener(lambda snapshot, printer=printer: listener(printer, snapshot))
+
+    # Snapshots of all printers, stale ones are refreshed at the same time. Return dict name -> snapshot.
+    def get_snapshots(self, max_age=None):
+        with ThreadPoolExecutor(max_workers=len(self.printers)) as executor:
+            futures = OrderedDict((name, executor.submit(printer.state_poller.get_snapshot, max_age)) for name, printer in self.printers.items())
+            return OrderedDict((name, future.result()) for name, future in futures.items())
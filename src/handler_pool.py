@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import traceback
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import HANDLER_QUEUED, HANDLER_RUNNING, HANDLER_REJECTED, HANDLER_WAIT_SECONDS, HANDLER_SECONDS
+
+
+BUSY_TEXT = "The bot is busy right now, please try again in a moment"
+
+
+class HandlerPool:
+    # Bounded thread pool for one class of slow handlers (camera images, container downloads, model uploads),
+    # so they do not hold the dispatcher threads that answer the fast status commands.
+    # At most max_queued calls wait for a worker, submit returns False when the queue is full.
+    def __init__(self, handler_class, workers, max_queued):
+        self.handler_class = handler_class
+        self.max_queued = max_queued
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Handler-{}'.format(handler_class))
+        self.__lock = threading.Lock()
+        self.__queued = 0
+
+        HANDLER_QUEUED.set(0, handler_class=handler_class)
+        HANDLER_RUNNING.set(0, handler_class=handler_class)
+
+    def submit(self, function, *args, **kwargs):
+        with self.__lock:
+            if self.__queued >= self.max_queued:
+                HANDLER_REJECTED.inc(handler_class=self.handler_class)
+                return False
+            self.__queued += 1
+        HANDLER_QUEUED.inc(handler_class=self.handler_class)
+
+        self.__executor.submit(self.__run, time.perf_counter(), function, args, kwargs)
+        return True
+
+    def __run(self, submitted, function, args, kwargs):
+        with self.__lock:
+            self.__queued -= 1
+        HANDLER_QUEUED.dec(handler_class=self.handler_class)
+        HANDLER_RUNNING.inc(handler_class=self.handler_class)
+        HANDLER_WAIT_SECONDS.observe(time.perf_counter() - submitted, handler_class=self.handler_class)
+
+        try:
+            with HANDLER_SECONDS.time(handler_class=self.handler_class, handler=function.__name__):
+                function(*args, **kwargs)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            HANDLER_RUNNING.dec(handler_class=self.handler_class)
+
+    def shutdown(self, wait=True):
+        self.__executor.shutdown(wait=wait)
+
+
+# Run the handler on the PrinterBot handler pool of the class instead of the dispatcher thread.
+# Used on handlers of MainMenu and SettingsMenu (self.printer_bot), the dispatcher gets None back,
+# so handlers that change the conversation state have to start their slow part themselves.
+def run_in_pool(handler_class):
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(self, update, context, *args, **kwargs):
+            pool = self.printer_bot.handler_pools[handler_class]
+            if not pool.submit(function, self, update, context, *args, **kwargs):
+                context.bot.send_message(chat_id=update.effective_chat.id, text=BUSY_TEXT)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from telegram import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+
+# StateStore section of the live status messages, by chat id
+STORE_SECTION = 'live_status'
+
+
+class LiveStatus:
+    # Live status message of one chat
+    def __init__(self, chat_id, printer_name, message_id, text, pinned):
+        self.chat_id = chat_id
+        self.printer_name = printer_name
+        self.message_id = message_id
+        self.pinned = pinned
+        self.text = text
+        self.pending = None
+        self.edited = time.monotonic()
+        self.timer = None
+        self.lock = threading.Lock()
+
+
+class LiveStatusBoard:
+    # One status message per chat, edited in place with every new snapshot of its printer.
+    # Edits are skipped when the rendered text has not changed, and done at most every min_interval seconds per chat:
+    # a change within the interval is sent when it is over, only the latest text is sent.
+    # render(printer, snapshot) returns the message text.
+    # With a StateStore the messages are kept across restarts, the first snapshot after a restart edits them.
+    def __init__(self, bot, render, min_interval=10.0, pin=False, store=None):
+        self.bot = bot
+        self.render = render
+        self.min_interval = min_interval
+        self.pin = pin
+        self.store = store
+        self.__lock = threading.Lock()
+        self.__chats = {}
+
+        if store is not None:
+            for chat_id, live in store.section(STORE_SECTION).items():
+                self.__chats[int(chat_id)] = LiveStatus(int(chat_id), live['printer'], live['message_id'], None, live['pinned'])
+
+    def chats(self):
+        with self.__lock:
+            return { chat_id: live.printer_name for chat_id, live in self.__chats.items() }
+
+    def start(self, chat_id, printer, snapshot):
+        self.stop(chat_id)
+
+        text = self.render(printer, snapshot)
+        message = self.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+
+        pinned = False
+        if self.pin:
+            try:
+                self.bot.pin_chat_message(chat_id=chat_id, message_id=message.message_id, disable_notification=True)
+                pinned = True
+            except Exception as ex:
+                print ('LiveStatus: Could not pin message in chat {}: {}'.format(chat_id, ex))
+
+        with self.__lock:
+            self.__chats[chat_id] = LiveStatus(chat_id, printer.name, message.message_id, text, pinned)
+        if self.store is not None:
+            self.store.set(STORE_SECTION, chat_id, { 'printer': printer.name, 'message_id': message.message_id, 'pinned': pinned })
+
+    # Stop editing the chat's message. Return False if the chat had none.
+    def stop(self, chat_id):
+        with self.__lock:
+            live = self.__chats.pop(chat_id, None)
+        if live is None:
+            return False
+        if self.store is not None:
+            self.store.delete(STORE_SECTION, chat_id)
+
+        with live.lock:
+            if live.timer is not None:
+                live.timer.cancel()
+                live.timer = None
+        if live.pinned:
+            try:
+                self.bot.unpin_chat_message(chat_id=chat_id)
+            except Exception as ex:
+                print ('LiveStatus: Could not unpin message in chat {}: {}'.format(chat_id, ex))
+        return True
+
+    # New snapshot of printer, called from the status callback
+    def update(self, printer, snapshot):
+        with self.__lock:
+            chats = [live for live in self.__chats.values() if live.printer_name == printer.name]
+        if not chats:
+            return
+
+        text = self.render(printer, snapshot)
+        for live in chats:
+            self.__schedule(live, text, 0)
+
+    def __schedule(self, live, text, min_wait):
+        with live.lock:
+            if text == live.text:
+                live.pending = None
+                return
+            live.pending = text
+            if live.timer is not None:
+                return
+
+            wait = max(min_wait, live.edited + self.min_interval - time.monotonic())
+            live.timer = threading.Timer(wait, self.__edit, args=(live,))
+            live.timer.daemon = True
+            live.timer.start()
+
+    def __edit(self, live):
+        with live.lock:
+            live.timer = None
+            text = live.pending
+            live.pending = None
+            if text is None or text == live.text:
+                return
+            # counts from the start of the edit, so a change during the edit waits for the next interval
+            live.edited = time.monotonic()
+
+        try:
+            self.bot.edit_message_text(chat_id=live.chat_id, message_id=live.message_id, text=text, parse_mode=ParseMode.HTML)
+            with live.lock:
+                live.text = text
+        except RetryAfter as ra:
+            with live.lock:
+                newer = live.pending
+            self.__schedule(live, newer if newer is not None else text, ra.retry_after)
+        except BadRequest as ex:
+            if 'not modified' in ex.message:
+                with live.lock:
+                    live.text = text
+            elif 'not found' in ex.message:
+                # the user deleted the message
+                with self.__lock:
+                    if self.__chats.get(live.chat_id) is live:
+                        del self.__chats[live.chat_id]
+                        if self.store is not None:
+                            self.store.delete(STORE_SECTION, live.chat_id)
+            else:
+                print ('LiveStatus: Could not edit message in chat {}: {}'.format(live.chat_id, ex))
+        except Exception as ex:
+            print ('LiveStatus: Could not edit message in chat {}: {}'.format(live.chat_id, ex))
@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import datetime
-import dateutil.parser
-from tzlocal import get_localzone
 
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
 from telegram import Update, ChatAction, ParseMode, ReplyKeyboardMarkup
 
 from .auth import authorized
-from .utils import progress_bar,  send_typing_action, build_keyboard
+from .handler_pool import run_in_pool
+from .routing import TextRouter
+from .utils import send_typing_action, build_keyboard
 from .settings_menu import SettingsMenu
-from .text_formating import format_printjob_status, format_printer_status
+from .text_formating import format_printjob_status, format_printer_status, format_printjob_message
+from .notifications import EVENTS
 
 
 class MainMenu:
@@ -42,6 +43,11 @@ class MainMenu:
             [ self.MENU_TEST ]
         ]
 
+        # markups are built once and sent with every /start
+        self.MARKUP_UNAUTHORIZED = ReplyKeyboardMarkup(build_keyboard(self.MENU_LAYOUT_UNAUTHORIZED), resize_keyboard=True)
+        self.MARKUP_MONITOR = ReplyKeyboardMarkup(build_keyboard(self.MENU_LAYOUT_MONITOR), resize_keyboard=True)
+        self.MARKUP_CONTROL = ReplyKeyboardMarkup(build_keyboard(self.MENU_LAYOUT_CONTROL), resize_keyboard=True)
+
     def add_handlers(self, dp):
         dp.add_handler(CommandHandler('start', self.start_cmd))
         dp.add_handler(CommandHandler('image', self.get_image_cmd))
@@ -49,17 +55,29 @@ class MainMenu:
         dp.add_handler(CommandHandler('printjob', self.get_printjob_cmd))
         dp.add_handler(CommandHandler('printer', self.get_printjob_cmd))
         dp.add_handler(CommandHandler('myid', self.get_id_cmd))
-
-
-        dp.add_handler(MessageHandler(Filters.regex('^{}$'.format(self.MENU_TEST)), self.test_cmd))
-        dp.add_handler(MessageHandler(Filters.regex('^{}$'.format(self.MENU_GET_IMAGE)), self.get_image_cmd))
-        dp.add_handler(MessageHandler(Filters.regex('^{}$'.format(self.MENU_GET_PRINTJOB)), self.get_printjob_cmd))
-        dp.add_handler(MessageHandler(Filters.regex('^{}$'.format(self.MENU_GET_PRINTER_STATUS)), self.get_printer_cmd))
-        dp.add_handler(MessageHandler(Filters.regex('^{}$'.format(self.MENU_GET_ID)), self.get_id_cmd))
+        dp.add_handler(CommandHandler('printers', self.get_printers_cmd))
+        dp.add_handler(CommandHandler('use', self.use_printer_cmd))
+        dp.add_handler(CommandHandler('telemetry', self.get_telemetry_cmd))
+        dp.add_handler(CommandHandler('subscribe', self.subscribe_cmd))
+        dp.add_handler(CommandHandler('unsubscribe', self.unsubscribe_cmd))
+        dp.add_handler(CommandHandler('subscriptions', self.subscriptions_cmd))
+        dp.add_handler(CommandHandler('live', self.live_status_cmd))
+        dp.add_handler(CommandHandler('stoplive', self.stop_live_status_cmd))
+
+
+        # reply keyboard buttons, looked up by their text
+        dp.add_handler(TextRouter({
+            self.MENU_TEST: self.test_cmd,
+            self.MENU_GET_IMAGE: self.get_image_cmd,
+            self.MENU_GET_PRINTJOB: self.get_printjob_cmd,
+            self.MENU_GET_PRINTER_STATUS: self.get_printer_cmd,
+            self.MENU_GET_ID: self.get_id_cmd
+        }))
 
         self.settings_menu.add_handlers(dp)
 
     @authorized('monitor')
+    @run_in_pool('media')
     def get_image_cmd(self, update: Update, context: CallbackContext):
         chat_id = update.effective_chat.id
             
@@ -67,7 +85,7 @@ class MainMenu:
 
         context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
 
-        img = self.printer_bot.ultimaker.get_camera_snapshot()
+        img = self.printer_bot.get_printer(context).camera.get_image()
         
         if img is not None:
             img_name = 'printer_{}.jpeg'.format(datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S"))
@@ -85,39 +103,15 @@ class MainMenu:
         try:
             chat_id = update.effective_chat.id
 
-            res = self.printer_bot.ultimaker.get_printjob_status()
+            res = self.printer_bot.get_printer(context).state_poller.get_snapshot().printjob
 
             if res['status_code'] == 200:
-                status = format_printjob_status(res['status'])
-
-                time_remaining_secs = res['time_total'] - res['time_elapsed']
-                if time_remaining_secs < 0:
-                    time_remaining_secs = 0
-
-                time_remaining = datetime.timedelta(seconds=time_remaining_secs)
-
-                if 'datetime_finished' in res and res['datetime_finished'] != '':
-                    end_time_utc = dateutil.parser.parse(res['datetime_finished']).replace(tzinfo=datetime.timezone.utc)
-                    end_time = end_time_utc.astimezone(get_localzone())
-                else:
-                    end_time = datetime.datetime.now() + time_remaining
-
-                start_time_utc = dateutil.parser.parse(res['datetime_started']).replace(tzinfo=datetime.timezone.utc)
-                start_time = start_time_utc.astimezone(get_localzone())
-
-                msg = "<b>Status:</b> {0}\n".format(status)
-                if res['status'] == 'paused':
-                    msg += "<b>Pause Source:</b> {0}\n".format(res['pause_source'])
-                msg += "<b>Model name:</b> {0}\n".format(res['print_name'])
-                msg += "<b>Total time:</b> {0}\n".format(str(datetime.timedelta(seconds=res['time_total'])))
-                msg += "<b>Time remaning:</b> {0}\n".format(str(time_remaining))
-                msg += "<b>Progress:</b> {0:.2f}% {1}\n".format(res['progress'] * 100, progress_bar(res['progress']))
-                msg += "<b>Start Time:</b> {0}\n".format(start_time.strftime("%Y-%m-%d %H:%M:%S"))
-                msg += "<b>End Time:</b> {0}".format(end_time.strftime("%Y-%m-%d %H:%M:%S"))
+                msg = self.printer_header(context) + format_printjob_message(res)
 
                 context.bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.HTML)
             else:
-                msg = "<b>Status:</b> No printer job running"
+                msg = self.printer_header(context)
+                msg += "<b>Status:</b> No printer job running"
                 context.bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.HTML)
         except Exception as ex:
             print(ex)
@@ -128,12 +122,13 @@ class MainMenu:
         try:
             chat_id = update.effective_chat.id
             
-            res = self.printer_bot.ultimaker.get_printer_status()
+            res = self.printer_bot.get_printer(context).state_poller.get_snapshot().printer
 
             if res['status_code'] == 200:
                 status = format_printjob_status(res['status'])
 
-                msg = "<b>Printer Status:</b> {0}\n".format(status)
+                msg = self.printer_header(context)
+                msg += "<b>Printer Status:</b> {0}\n".format(status)
                 msg += "<b>  Bed Temperature 🌡:</b>\n"
                 msg += "<b>    Current:</b> {0:.2f} C\n".format(res['bed_temp_cur'])
                 msg += "<b>    Target:</b> {0} C\n".format(res['bed_temp_target'])
@@ -150,6 +145,127 @@ class MainMenu:
         except Exception as ex:
             print(ex)
 
+    # Temperatures and progress over the last minutes (first argument, default 10), answered from the telemetry buffer
+    @authorized('monitor')
+    @send_typing_action
+    def get_telemetry_cmd(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        printer = self.printer_bot.get_printer(context)
+
+        minutes = 10
+        for arg in context.args or []:
+            if arg.isdigit():
+                minutes = int(arg)
+        seconds = minutes * 60
+        telemetry = printer.telemetry
+
+        msg = self.printer_header(context)
+        msg += "<b>Last {0} min:</b>\n".format(minutes)
+        for title, current, target in (('Bed', 'bed_cur', 'bed_target'), ('Extruder [1]', 'ext_cur', 'ext_target')):
+            stats = telemetry.stats(current, seconds)
+            if stats is None:
+                msg += "<b>  {0}:</b> No data\n".format(title)
+                continue
+
+            msg += "<b>  {0} 🌡:</b> {1:.1f} C (min {2:.1f}, max {3:.1f}, mean {4:.1f})\n".format(title, stats['last'], stats['min'], stats['max'], stats['mean'])
+            rate = telemetry.rate(current, seconds)
+            if rate is not None:
+                msg += "<b>    Rate:</b> {0:+.2f} C/min\n".format(rate * 60)
+            at_target = telemetry.time_since_target_reached(current, target, seconds=seconds)
+            if at_target is not None:
+                msg += "<b>    At target for:</b> {0}\n".format(str(datetime.timedelta(seconds=int(at_target))))
+
+        progress_rate = telemetry.rate('progress', seconds)
+        if progress_rate is not None:
+            msg += "<b>  Progress:</b> {0:+.2f}% per hour".format(progress_rate * 100 * 3600)
+
+        context.bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.HTML)
+
+    @authorized('monitor')
+    def get_printers_cmd(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        selected = self.printer_bot.get_printer(context)
+
+        msg = "<b>Printers:</b>\n"
+        for name, snapshot in self.printer_bot.fleet.get_snapshots().items():
+            state = snapshot.printer_state()
+            if state['status_code'] == 200:
+                status = format_printer_status(state['printer_status'])
+            else:
+                status = 'Not available'
+            msg += "  {0} <b>{1}</b>: {2}\n".format('▶' if name == selected.name else '▫', name, status)
+        msg += "Use /use &lt;name&gt; to select printer"
+
+        context.bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.HTML)
+
+    @authorized('monitor')
+    def use_printer_cmd(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+
+        printer = self.printer_bot.fleet.get(context.args[0]) if context.args else None
+        if printer is None:
+            msg = "Unknown printer. Available printers: {}".format(', '.join(self.printer_bot.fleet.names()))
+        else:
+            context.user_data['printer'] = printer.name
+            msg = "Selected printer: {}".format(printer.name)
+
+        context.bot.send_message(chat_id=chat_id, text=msg)
+
+    @authorized('monitor')
+    def subscribe_cmd(self, update: Update, context: CallbackContext):
+        self.change_subscriptions(update, context, self.printer_bot.notifications.subscribe)
+
+    @authorized('monitor')
+    def unsubscribe_cmd(self, update: Update, context: CallbackContext):
+        self.change_subscriptions(update, context, self.printer_bot.notifications.unsubscribe)
+
+    @authorized('monitor')
+    def subscriptions_cmd(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        user_id = update.message.from_user.id
+        events = self.printer_bot.notifications.get_subscriptions(user_id)
+        context.bot.send_message(chat_id=chat_id, text=self.subscriptions_text(events))
+
+    # Events are given as command arguments, no arguments means all events
+    def change_subscriptions(self, update: Update, context: CallbackContext, change):
+        chat_id = update.effective_chat.id
+        user_id = update.message.from_user.id
+
+        events = [event.lower() for event in context.args] if context.args else list(EVENTS)
+        unknown = [event for event in events if event not in EVENTS]
+        if unknown:
+            msg = "Unknown events: {}. Events: {}".format(', '.join(unknown), ', '.join(EVENTS))
+        else:
+            msg = self.subscriptions_text(change(user_id, events))
+
+        context.bot.send_message(chat_id=chat_id, text=msg)
+
+    def subscriptions_text(self, events):
+        if not events:
+            return "You are not subscribed to any notifications"
+        return "You are subscribed to: {}".format(', '.join(event for event in EVENTS if event in events))
+
+    # Status message that is kept up to date, instead of asking for the print job again and again
+    @authorized('monitor')
+    def live_status_cmd(self, update: Update, context: CallbackContext):
+        printer = self.printer_bot.get_printer(context)
+        self.printer_bot.live_status.start(update.effective_chat.id, printer, printer.state_poller.get_snapshot())
+
+    @authorized('monitor')
+    def stop_live_status_cmd(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        if self.printer_bot.live_status.stop(chat_id):
+            msg = "Live status stopped"
+        else:
+            msg = "There is no live status in this chat"
+        context.bot.send_message(chat_id=chat_id, text=msg)
+
+    # Name of the printer the answer is about, only shown when there is more than one printer
+    def printer_header(self, context: CallbackContext):
+        if self.printer_bot.fleet.is_multi():
+            return "<b>Printer:</b> {0}\n".format(self.printer_bot.get_printer(context).name)
+        return ""
+
     @authorized('monitor')
     def test_cmd(self, update: Update, context: CallbackContext):
         chat_id = update.effective_chat.id
@@ -161,8 +277,7 @@ class MainMenu:
         context.bot.send_message(chat_id=chat_id, text="Your user id is {}".format(user_id))
 
     def start_menu_unauth(self):
-        button_list = build_keyboard(self.MENU_LAYOUT_UNAUTHORIZED)
-        reply_markup = ReplyKeyboardMarkup(button_list, resize_keyboard=True)
+        reply_markup = self.MARKUP_UNAUTHORIZED
         
         msg = "Commands:\n"
         msg += "/start - To get started\n"
@@ -171,8 +286,7 @@ class MainMenu:
         return msg, reply_markup
 
     def start_menu_monitor(self):
-        button_list = build_keyboard(self.MENU_LAYOUT_MONITOR)
-        reply_markup = ReplyKeyboardMarkup(button_list, resize_keyboard=True)
+        reply_markup = self.MARKUP_MONITOR
 
         msg = "Commands:\n"
         msg += "/start - To get started\n"
@@ -180,13 +294,17 @@ class MainMenu:
         msg += "/image - To get image from printer\n"
         msg += "/printjob - To get current print job\n"
         msg += "/printer - To get printer status\n"
+        msg += "/live, /stoplive - To get a status message that updates itself\n"
+        msg += "/telemetry - To get temperatures and progress of last minutes\n"
+        msg += "/printers - To list printers\n"
+        msg += "/use - To select printer\n"
+        msg += "/subscribe, /unsubscribe - To change notifications ({})\n".format(', '.join(EVENTS))
         msg += "/myid - To get your user id"
 
         return msg, reply_markup
 
     def start_menu_control(self):
-        button_list = build_keyboard(self.MENU_LAYOUT_CONTROL)
-        reply_markup = ReplyKeyboardMarkup(button_list, resize_keyboard=True)
+        reply_markup = self.MARKUP_CONTROL
 
         msg = "Commands:\n"
         msg += "/start - To get started\n"
@@ -194,6 +312,11 @@ class MainMenu:
         msg += "/image - To get image from printer\n"
         msg += "/printjob - To get current print job\n"
         msg += "/printer - To get printer status\n"
+        msg += "/live, /stoplive - To get a status message that updates itself\n"
+        msg += "/telemetry - To get temperatures and progress of last minutes\n"
+        msg += "/printers - To list printers\n"
+        msg += "/use - To select printer\n"
+        msg += "/subscribe, /unsubscribe - To change notifications ({})\n".format(', '.join(EVENTS))
         msg += "/myid - To get your user id"
 
         return msg, reply_markup
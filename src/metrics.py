@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Seconds, from a fast local request up to a printer that is about to time out
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in zip(labelnames, values)) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    # One metric family in the Prometheus text format. Samples are kept per label values tuple.
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.TYPE)]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return ['{}{} {}'.format(self.name, format_labels(self.labelnames, key), format_value(value))]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    # Value read from func when the metrics are rendered, e.g. the length of a queue owned by a library
+    def set_function(self, func, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = func
+
+    def _render_sample(self, key, value):
+        return super()._render_sample(key, value() if callable(value) else value)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_sample(self, key, value):
+        counts, total = value
+        labels = format_labels(self.labelnames, key)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            bucket_labels = format_labels(self.labelnames + ('le',), key + (format_value(bound),))
+            lines.append('{}_bucket{} {}'.format(self.name, bucket_labels, cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, labels, format_value(total)))
+        lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__metrics = []
+        self.__lock = threading.Lock()
+
+    def register(self, metric):
+        with self.__lock:
+            self.__metrics.append(metric)
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.__metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_SECONDS = Histogram('ultimaker_request_seconds', 'Duration of printer api requests.', ('printer', 'method', 'endpoint'))
+REQUEST_ERRORS = Counter('ultimaker_request_errors_total', 'Printer api requests that failed, by exception or 5xx status.', ('printer', 'method', 'endpoint', 'error'))
+RESPONSES = Counter('ultimaker_responses_total', 'Printer api responses by status code.', ('printer', 'method', 'endpoint', 'status'))
+BYTES_SENT = Counter('ultimaker_sent_bytes_total', 'Request body bytes sent to the printer.', ('printer', 'endpoint'))
+BYTES_RECEIVED = Counter('ultimaker_received_bytes_total', 'Response body bytes received from the printer.', ('printer', 'endpoint'))
+REDISCOVERIES = Counter('ultimaker_rediscoveries_total', 'Printer ip searches by mac after the printer could not be reached.', ('printer', 'result'))
+REQUEST_RETRIES = Counter('ultimaker_request_retries_total', 'Printer api requests sent again after a connection error or timeout.', ('printer', 'endpoint'))
+CIRCUIT_STATE = Gauge('ultimaker_circuit_state', 'Circuit breaker state of the printer: 0 closed, 1 half open, 2 open.', ('printer',))
+CIRCUIT_REJECTED = Counter('ultimaker_circuit_rejected_total', 'Printer api requests failed fast because the circuit was open.', ('printer',))
+
+POLL_SECONDS = Histogram('printer_poll_seconds', 'Duration of one printer status poll.', ('printer',))
+STATUS_CALLBACK_SECONDS = Histogram('status_callback_seconds', 'Duration of the status notification callback.', ('printer',))
+STATUS_CALLBACK_LAG = Histogram('status_callback_lag_seconds', 'Time from the poll to the status notification callback.', ('printer',))
+
+TELEGRAM_SEND_SECONDS = Histogram('telegram_request_seconds', 'Duration of Telegram bot api requests.', ('method',))
+TELEGRAM_SEND_ERRORS = Counter('telegram_request_errors_total', 'Telegram bot api requests that failed.', ('method', 'error'))
+
+HANDLER_QUEUED = Gauge('handler_queued', 'Handler calls waiting for a worker, by handler class.', ('handler_class',))
+HANDLER_RUNNING = Gauge('handler_running', 'Handler calls running, by handler class.', ('handler_class',))
+HANDLER_REJECTED = Counter('handler_rejected_total', 'Handler calls turned away because the queue of their class was full.', ('handler_class',))
+HANDLER_WAIT_SECONDS = Histogram('handler_wait_seconds', 'Time handler calls waited for a worker.', ('handler_class',))
+HANDLER_SECONDS = Histogram('handler_seconds', 'Duration of handler calls run on a handler pool.', ('handler_class', 'handler'))
+
+
+# Record one printer api request, shared by Ultimaker and AsyncUltimaker.
+# response is None when the request raised error. Bodies are counted from Content-Length, streamed bodies that have none are not counted.
+def observe_request(printer, method, path, duration, response=None, error=None):
+    method = method.upper()
+    endpoint = path.split('?', 1)[0]
+    REQUEST_SECONDS.observe(duration, printer=printer, method=method, endpoint=endpoint)
+
+    if response is None:
+        REQUEST_ERRORS.inc(printer=printer, method=method, endpoint=endpoint, error=type(error).__name__)
+        return
+
+    RESPONSES.inc(printer=printer, method=method, endpoint=endpoint, status=response.status_code)
+    if response.status_code >= 500:
+        REQUEST_ERRORS.inc(printer=printer, method=method, endpoint=endpoint, error='http_{}'.format(response.status_code))
+
+    sent = response.request.headers.get('Content-Length')
+    if sent:
+        BYTES_SENT.inc(int(sent), printer=printer, endpoint=endpoint)
+    received = response.headers.get('Content-Length')
+    if received:
+        BYTES_RECEIVED.inc(int(received), printer=printer, endpoint=endpoint)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve /metrics in a background thread, on localhost unless another host is given
+def start_metrics_server(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    return server
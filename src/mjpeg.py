@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+HEADERS_END = b'\r\n\r\n'
+CONTENT_LENGTH_RE = re.compile(br'content-length:\s*(\d+)', re.IGNORECASE)
+BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+
+
+class MjpegError(Exception):
+    """Base error for mjpeg stream reader.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+# Get multipart boundary from Content-Type header, None if the stream is not multipart
+def parse_boundary(content_type):
+    if content_type is None:
+        return None
+    match = BOUNDARY_RE.search(content_type)
+    return match.group(1) if match is not None else None
+
+
+class MjpegFrameReader:
+    # Incremental JPEG frame extractor for camera streams.
+    # Data is written into one preallocated bytearray, marker searches resume where the previous one stopped,
+    # so every byte is scanned once. If the stream is multipart, part headers are parsed and Content-Length is
+    # used to cut frames without scanning them. Frames are memoryview slices of the buffer: they stay valid
+    # only until more data is written, copy them (bytes(frame)) to keep them longer.
+    def __init__(self, boundary=None, buffer_size=256*1024, max_frame_size=16*1024*1024):
+        self.boundary = boundary
+        self.max_frame_size = max_frame_size
+
+        self.__buffer = bytearray(buffer_size)
+        self.__view = memoryview(self.__buffer)
+        self.__start = 0    # first byte not consumed yet
+        self.__end = 0      # end of written data
+        self.__scan = 0     # where the next marker search starts
+        self.__frame_start = None
+        self.__frame_length = None
+
+    # Free part of the buffer to write stream data into, e.g. with readinto. Call commit with the number of bytes written.
+    def writable(self):
+        if self.__end == len(self.__buffer):
+            self.__make_room()
+        return self.__view[self.__end:]
+
+    def commit(self, count):
+        self.__end += count
+
+    def feed(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            space = self.writable()
+            count = min(len(space), len(data))
+            space[:count] = data[:count]
+            self.commit(count)
+            data = data[count:]
+
+    # Return next complete frame or None if more data is needed
+    def next_frame(self):
+        if self.__frame_start is None and not self.__find_frame_start():
+            return None
+
+        if self.__frame_length is not None:
+            frame_end = self.__frame_start + self.__frame_length
+            if self.__end < frame_end:
+                return None
+        else:
+            eoi = self.__buffer.find(EOI, self.__scan, self.__end)
+            if eoi == -1:
+                # last byte can be the first half of the marker
+                self.__scan = max(self.__frame_start + len(SOI), self.__end - 1)
+                if self.__end - self.__frame_start > self.max_frame_size:
+                    raise MjpegError('Mjpeg: Frame is bigger than {} bytes'.format(self.max_frame_size))
+                return None
+            frame_end = eoi + len(EOI)
+
+        frame = self.__view[self.__frame_start:frame_end]
+        self.__start = self.__scan = frame_end
+        self.__frame_start = self.__frame_length = None
+        return frame
+
+    # Yield frames continuously. read_into(buffer) fills the given buffer and returns the number of bytes, 0 at the end of stream.
+    def iter_frames(self, read_into):
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                yield frame
+                continue
+
+            count = read_into(self.writable())
+            if not count:
+                return
+            self.commit(count)
+
+    def __find_frame_start(self):
+        if self.boundary is not None:
+            headers_end = self.__buffer.find(HEADERS_END, self.__scan, self.__end)
+            if headers_end == -1:
+                self.__scan = max(self.__start, self.__end - len(HEADERS_END) + 1)
+                return False
+
+            length = CONTENT_LENGTH_RE.search(self.__view[self.__start:headers_end].tobytes())
+            self.__start = self.__scan = self.__frame_start = headers_end + len(HEADERS_END)
+            if length is not None:
+                self.__frame_length = int(length.group(1))
+                if self.__frame_length > self.max_frame_size:
+                    raise MjpegError('Mjpeg: Frame is bigger than {} bytes'.format(self.max_frame_size))
+            return True
+
+        soi = self.__buffer.find(SOI, self.__scan, self.__end)
+        if soi == -1:
+            # nothing here can start a frame, except the last byte
+            self.__start = self.__scan = max(self.__start, self.__end - 1)
+            return False
+
+        self.__start = self.__frame_start = soi
+        self.__scan = soi + len(SOI)
+        return True
+
+    # Move unconsumed data to the front of the buffer, or grow the buffer if a frame does not fit into it.
+    def __make_room(self):
+        count = self.__end - self.__start
+
+        if self.__start == 0:
+            needed = len(self.__buffer) * 2
+            if self.__frame_length is not None:
+                needed = max(needed, self.__frame_length)
+            if count >= self.max_frame_size:
+                raise MjpegError('Mjpeg: Frame is bigger than {} bytes'.format(self.max_frame_size))
+
+            # a new buffer, not a resize: frames returned earlier may still reference the old one
+            buffer = bytearray(min(needed, self.max_frame_size + len(HEADERS_END)))
+            buffer[:count] = self.__view[:count]
+            self.__buffer = buffer
+            self.__view = memoryview(buffer)
+        else:
+            self.__view[:count] = self.__view[self.__start:self.__end]
+
+        shift = self.__start
+        self.__start = 0
+        self.__end -= shift
+        self.__scan -= shift
+        if self.__frame_start is not None:
+            self.__frame_start -= shift
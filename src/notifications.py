@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from telegram import ParseMode
+from telegram.error import RetryAfter
+
+from .auth import auth_get_notify_group, auth_is_authorized
+from .event_log import EVENT_TYPE_PRINT_PAUSED, EVENT_TYPE_PRINT_FINISHED
+
+
+EVENT_STATE, EVENT_PAUSE, EVENT_COMPLETE, EVENT_ERROR = ('state', 'pause', 'complete', 'error')
+EVENTS = (EVENT_STATE, EVENT_PAUSE, EVENT_COMPLETE, EVENT_ERROR)
+
+# Telegram limits: about 30 messages per second overall and 1 per second to the same chat
+GLOBAL_RATE = 30
+CHAT_INTERVAL = 1.0
+
+
+# Classify a status change by the most specific event it contains
+def classify_change(old_printer_status, printer_status, old_printjob_state, printjob_state):
+    if printer_status == 'error' and old_printer_status != 'error':
+        return EVENT_ERROR
+    if printjob_state != old_printjob_state:
+        if printjob_state == 'paused':
+            return EVENT_PAUSE
+        if printjob_state in ('post_print', 'wait_cleanup'):
+            return EVENT_COMPLETE
+    return EVENT_STATE
+
+# Classify an entry of the printer event log. Errors have no single event type, they are recognized by their message.
+def classify_event(entry):
+    if entry.get('type_id') == EVENT_TYPE_PRINT_PAUSED:
+        return EVENT_PAUSE
+    if entry.get('type_id') == EVENT_TYPE_PRINT_FINISHED:
+        return EVENT_COMPLETE
+    if 'error' in str(entry.get('message', '')).lower():
+        return EVENT_ERROR
+    return EVENT_STATE
+
+
+class RateLimiter:
+    # Token bucket, acquire blocks until a token is available
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.__tokens = self.burst
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate)
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
+
+
+class NotificationEngine:
+    # Sends printer events to subscribed users.
+    # Users of the notify group get all events unless they changed their subscription, others get none unless they subscribed.
+    # Messages are sent on a thread pool within Telegram rate limits, so a slow or failing chat does not delay the others.
+    # With digest_window > 0 the events of each user are collected for that many seconds and sent as one message.
+    def __init__(self, bot, subscriptions_path, digest_window=0, workers=8):
+        self.bot = bot
+        self.subscriptions_path = subscriptions_path
+        self.digest_window = digest_window
+
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Notification')
+        self.__global_limiter = RateLimiter(GLOBAL_RATE)
+        self.__lock = threading.Lock()
+        self.__chat_locks = {}
+        self.__chat_last_sent = {}
+        self.__pending = {}
+        self.__subscriptions = self.load_subscriptions()
+
+    def load_subscriptions(self):
+        try:
+            with open(self.subscriptions_path, 'rt') as f:
+                return { int(user_id): set(events) for user_id, events in json.load(f).items() }
+        except (IOError, ValueError):
+            return {}
+
+    def save_subscriptions(self):
+        tmp_path = self.subscriptions_path + '.tmp'
+        try:
+            with open(tmp_path, 'wt') as f:
+                json.dump({ str(user_id): sorted(events) for user_id, events in self.__subscriptions.items() }, f, indent=4)
+            os.replace(tmp_path, self.subscriptions_path)
+        except IOError:
+            print ('Notifications: Could not save subscriptions: {}'.format(self.subscriptions_path))
+
+    def get_subscriptions(self, user_id):
+        with self.__lock:
+            if user_id in self.__subscriptions:
+                return set(self.__subscriptions[user_id])
+        return set(EVENTS) if user_id in auth_get_notify_group() else set()
+
+    def subscribe(self, user_id, events):
+        return self.set_subscriptions(user_id, self.get_subscriptions(user_id) | set(events))
+
+    def unsubscribe(self, user_id, events):
+        return self.set_subscriptions(user_id, self.get_subscriptions(user_id) - set(events))
+
+    def set_subscriptions(self, user_id, events):
+        with self.__lock:
+            self.__subscriptions[user_id] = set(events)
+            self.save_subscriptions()
+        return set(events)
+
+    def recipients(self, event):
+        with self.__lock:
+            subscriptions = dict(self.__subscriptions)
+
+        # subscriptions of users removed from the users file are kept, but they get nothing while they are not authorized
+        users = set(auth_get_notify_group()) | set(subscriptions.keys())
+        return [user_id for user_id in users if event in subscriptions.get(user_id, EVENTS) and auth_is_authorized(user_id, 'monitor')]
+
+    def publish(self, event, text):
+        for user_id in self.recipients(event):
+            if self.digest_window > 0:
+                self.__add_to_digest(user_id, text)
+            else:
+                self.__executor.submit(self.send, user_id, text)
+
+    def __add_to_digest(self, user_id, text):
+        with self.__lock:
+            if user_id in self.__pending:
+                self.__pending[user_id].append(text)
+                return
+            self.__pending[user_id] = [text]
+
+        timer = threading.Timer(self.digest_window, self.__flush_digest, args=(user_id,))
+        timer.daemon = True
+        timer.start()
+
+    def __flush_digest(self, user_id):
+        with self.__lock:
+            texts = self.__pending.pop(user_id, [])
+
+        if len(texts) == 1:
+            self.__executor.submit(self.send, user_id, texts[0])
+        elif len(texts) > 1:
+            text = "{} updates:\n\n".format(len(texts)) + "\n\n".join(texts)
+            self.__executor.submit(self.send, user_id, text)
+
+    # Send message now, waiting for the rate limits
+    def send(self, chat_id, text, **kwargs):
+        with self.__lock:
+            chat_lock = self.__chat_locks.setdefault(chat_id, threading.Lock())
+
+        with chat_lock:
+            wait = self.__chat_last_sent.get(chat_id, 0) + CHAT_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.__global_limiter.acquire()
+
+            try:
+                self.__send(chat_id, text, **kwargs)
+            finally:
+                self.__chat_last_sent[chat_id] = time.monotonic()
+
+    def __send(self, chat_id, text, **kwargs):
+        try:
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, **kwargs)
+            except RetryAfter as ra:
+                time.sleep(ra.retry_after)
+                self.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, **kwargs)
+        except Exception as ex:
+            print ('Notifications: Could not send message to {}: {}'.format(chat_id, ex))
@@ -2,17 +2,31 @@
 
 import sys
 import os
+import html
 import datetime
 import json
 import re
-from telegram.ext import Updater, CallbackContext, MessageHandler, Filters
-from telegram import Update, ParseMode
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from telegram.ext import Updater, CallbackContext, MessageHandler, TypeHandler, Filters, DispatcherHandlerStop
+from telegram import Bot, Update, ParseMode
 
 from .settings import load_settings
-from .auth import auth_load_users, auth_get_notify_group, authorized
-from .ultimaker import Ultimaker, UltimakerError
+from .auth import auth_load_users_file, auth_is_authorized, UsersFileWatcher
+from .ultimaker import UltimakerError
+from .notifications import NotificationEngine, classify_change, classify_event, EVENT_COMPLETE
 from .main_menu import MainMenu
-from .text_formating import format_printjob_status, format_printer_status
+from .metrics import start_metrics_server, STATUS_CALLBACK_SECONDS, STATUS_CALLBACK_LAG, HANDLER_QUEUED
+from .handler_pool import HandlerPool
+from .utils import TimedRequest, StartupProfile
+from .text_formating import format_printjob_status, format_printer_status, format_printjob_message, format_event_time
+from .live_status import LiveStatusBoard
+from .state_store import StateStore, StatePersistence
+from .event_log import EventLogSync
+
+
+CONNECTING_TEXT = "The printer is still connecting, please try again in a moment"
 
 
 class BotError(Exception):
@@ -27,113 +41,328 @@ class BotError(Exception):
 
 
 class PrinterBot:
-    printer_status = None
-    printjob_state = None
+    TIMELAPSE_STOP_STATES = ('post_print', 'wait_cleanup', 'no_printjob')
+
+    # Commands answered before the printers are connected, they need no printer
+    PRINTERLESS_COMMANDS = ('/start', '/myid', '/test')
 
-    def __init__(self, config, app_name='TelegramBot', users_path='authorized_users.json'):
+    def __init__(self, config, app_name='TelegramBot', users_path='authorized_users.json', profile=None):
         print ('Loading Configs...')
         self.config = config
+        self.profile = profile if profile is not None else StartupProfile()
         
         self.bot_token = self.config.TLEGRAM_TOKEN
         self.status_update_interval = self.config.STATUS_UPDATE_INTERVAL
 
-        self.load_users(users_path)
+        with self.profile.phase('users'):
+            self.load_users(users_path)
+        with self.profile.phase('state'):
+            self.state_store = StateStore(self.config.STATE_FILE, self.config.STATE_WRITE_DELAY)
 
-        print ('Loading Ultimaker...')
-        self.ultimaker = Ultimaker(app_name, self.config)
-        print ('Ultimaker loaded.')
+        # connected in background by attach_printers, set when the pollers are running
+        self.fleet = None
+        self.printers_ready = threading.Event()
+
+        self.timelapse_executor = ProcessPoolExecutor(max_workers=self.config.TIMELAPSE_WORKERS) if self.config.TIMELAPSE else None
+
+        # slow handlers run on their own pools, the dispatcher thread only answers the fast commands
+        self.handler_pools = {
+            'media': HandlerPool('media', self.config.MEDIA_HANDLER_WORKERS, self.config.HANDLER_QUEUE_SIZE),
+            'upload': HandlerPool('upload', self.config.UPLOAD_HANDLER_WORKERS, self.config.HANDLER_QUEUE_SIZE)
+        }
 
-        self.main_menu = MainMenu(self)
+        with self.profile.phase('menus'):
+            self.main_menu = MainMenu(self)
+
+        if self.config.METRICS_PORT:
+            start_metrics_server(self.config.METRICS_PORT, self.config.METRICS_HOST)
+            print ('Metrics served on http://{}:{}/metrics'.format(self.config.METRICS_HOST, self.config.METRICS_PORT))
 
         print ('Starting bot...')
-        updater = Updater(self.bot_token, use_context=True)
-        dp = updater.dispatcher
-        jq = updater.job_queue
-        
-        self.main_menu.add_handlers(dp)
-        self.add_handlers(dp)
+        with self.profile.phase('telegram'):
+            # the bot connection pool needs 4 more connections than workers, like the Updater default
+            updater = Updater(bot=Bot(self.bot_token, base_url=self.config.BOT_API_URL, request=TimedRequest(con_pool_size=self.config.BOT_WORKERS + 4)),
+                              workers=self.config.BOT_WORKERS, use_context=True, persistence=StatePersistence(self.state_store))
+            dp = updater.dispatcher
+            HANDLER_QUEUED.set_function(updater.update_queue.qsize, handler_class='fast')
 
-        self.add_job_queue(jq)
+            self.notifications = NotificationEngine(updater.bot, self.config.NOTIFY_SUBSCRIPTIONS_FILE,
+                                                    self.config.NOTIFY_DIGEST_WINDOW, self.config.NOTIFY_WORKERS)
+            self.live_status = LiveStatusBoard(updater.bot, self.render_live_status, self.config.LIVE_STATUS_INTERVAL, self.config.LIVE_STATUS_PIN, self.state_store)
+        
+            self.main_menu.add_handlers(dp)
+            self.add_handlers(dp)
 
-        updater.start_polling()
+        with self.profile.phase('updates'):
+            self.start_updates(updater)
+        self.profile.mark('serving')
         print ('Bot has been successfully started.')
+
+        threading.Thread(target=self.attach_printers, args=(app_name, updater.job_queue), name='PrinterAttach', daemon=True).start()
         updater.idle()
 
+    # Connect the printers in background, meanwhile the bot answers the commands that need no printer.
+    # Connecting can take a subnet sweep, if no printer is found it is tried again after ATTACH_RETRY_INTERVAL seconds.
+    def attach_printers(self, app_name, job_queue):
+        print ('Loading Ultimaker...')
+        with self.profile.phase('printer imports'):
+            # numpy (telemetry) is only needed once there are printers
+            from .fleet import PrinterFleet
+
+        while True:
+            try:
+                with self.profile.phase('printers'):
+                    fleet = PrinterFleet(app_name, self.config)
+                break
+            except UltimakerError as uer:
+                print ('{}, trying again in {:.0f}s'.format(uer.message, self.config.ATTACH_RETRY_INTERVAL))
+                time.sleep(self.config.ATTACH_RETRY_INTERVAL)
+        print ('Ultimaker loaded: {}'.format(', '.join(fleet.names())))
+
+        self.fleet = fleet
+        self.restore_printer_states()
+        if self.config.EVENT_LOG_SYNC:
+            for printer in fleet.printers.values():
+                printer.event_log = EventLogSync(printer.ultimaker, self.state_store, printer.name, self.config.EVENT_LOG_PAGE_SIZE)
+        self.add_job_queue(job_queue)
+        fleet.start()
+        self.printers_ready.set()
+
+        self.profile.mark('printers ready')
+        self.profile.report()
+
     def load_users(self, users_path):
         try:
-            f = open(users_path, "rt")
-            users_config = json.load(f)    
-            f.close()
-
-            auth_load_users(users_config)
-        except IOError:
+            auth_load_users_file(users_path)
+        except (IOError, ValueError, KeyError, TypeError) as ex:
             print ("Telegran Bot: Could not load users config file: {}".format(users_path))
-            raise BotError("Telegran Bot: Could not load users config file: {}".format(users_path))
-        
-        self.access_levels = users_config['access_levels']
-        self.users = users_config['users']
+            raise BotError("Telegran Bot: Could not load users config file: {} ({})".format(users_path, ex))
 
-        self.authorized_uses = {}
-        for level in self.access_levels:
-            self.authorized_uses[level] = set()
+        # operators are added and removed while the bot runs, the users file is reloaded when it changes
+        if self.config.USERS_RELOAD_INTERVAL > 0:
+            self.users_watcher = UsersFileWatcher(users_path, self.config.USERS_RELOAD_INTERVAL)
+            self.users_watcher.start()
 
-        self.notify_group = set()
-        
-        for user in self.users:
-            # higher access levels get acces to lower
-            for level in range(0, user['access_level'] + 1):
-                self.authorized_uses[self.access_levels[level]].add(user['id'])
-            
-            if user['notify']:
-                self.notify_group.add(user['id'])
+    # Receive updates with long polling, or with a webhook listener that Telegram (or a local test client) posts updates to.
+    def start_updates(self, updater):
+        config = self.config
+        if config.BOT_MODE == 'webhook':
+            url_path = config.WEBHOOK_PATH if config.WEBHOOK_PATH is not None else self.bot_token
+
+            # the updater registers the webhook, WEBHOOK_URL or the listener's own address if it is not set
+            updater.start_webhook(listen=config.WEBHOOK_LISTEN, port=config.WEBHOOK_PORT, url_path=url_path,
+                                  cert=config.WEBHOOK_CERT, key=config.WEBHOOK_KEY, webhook_url=config.WEBHOOK_URL,
+                                  allowed_updates=config.ALLOWED_UPDATES)
+            print ('Webhook listening on {}:{}'.format(config.WEBHOOK_LISTEN, config.WEBHOOK_PORT))
+        else:
+            updater.start_polling(poll_interval=config.POLL_INTERVAL, timeout=config.POLL_TIMEOUT,
+                                  allowed_updates=config.ALLOWED_UPDATES)
 
     def add_handlers(self, dp):
+        # group -1 runs before the menus and can stop the update from reaching them
+        dp.add_handler(TypeHandler(Update, self.printers_ready_gate), group=-1)
         dp.add_handler(MessageHandler(Filters.regex(re.compile('^{}$'.format('well done'), re.IGNORECASE)), self.send_ok))
         dp.add_error_handler(self.error)
 
     def add_job_queue(self, job_queue):
-        job_queue.run_repeating(self.status_notification_callback, interval=self.status_update_interval, first=0)
+        # the pollers do the printer requests (the event log too), notifications are sent from the job queue threads.
+        # Jobs can run at the same time, so each job handles the pending snapshots of its printer in order.
+        def on_snapshot(printer, snapshot):
+            entries = self.sync_event_log(printer, snapshot)
+            printer.pending_snapshots.append((snapshot, entries))
+            job_queue.run_once(self.status_notification_callback, 0, context=printer)
+
+        self.fleet.add_listener(on_snapshot)
+
+    # New entries of the printer event log, [] if the printer has none or could not be reached
+    def sync_event_log(self, printer, snapshot):
+        if printer.event_log is None or printer.event_log.available is False or snapshot.error is not None:
+            return []
+        try:
+            return printer.event_log.sync()
+        except (UltimakerError, KeyError, ValueError) as ex:
+            print ('Event log sync failed ({}): {}'.format(printer.name, getattr(ex, 'message', ex)))
+            return []
+
+    def has_event_log(self, printer):
+        return printer.event_log is not None and printer.event_log.available is True
+
+    # Until the printers are connected, updates that need a printer are answered with a note instead of reaching the menus.
+    # Users that are not authorized are let through, the menus tell them so.
+    def printers_ready_gate(self, update: Update, context: CallbackContext):
+        if self.printers_ready.is_set() or update.effective_user is None:
+            return
+        if not self.is_authorized(update.effective_user.id, 'monitor'):
+            return
+
+        message = update.message
+        if message is not None and message.text is not None:
+            command = message.text.split(' ', 1)[0].split('@', 1)[0]
+            if command in self.PRINTERLESS_COMMANDS or message.text in (MainMenu.MENU_GET_ID, MainMenu.MENU_TEST):
+                return
+
+        if update.callback_query is not None:
+            update.callback_query.answer(text=CONNECTING_TEXT)
+        elif update.effective_chat is not None:
+            context.bot.send_message(chat_id=update.effective_chat.id, text=CONNECTING_TEXT)
+        raise DispatcherHandlerStop()
+
+    # Printer given as the first command argument, otherwise the one selected with /use, otherwise the first one.
+    def get_printer(self, context: CallbackContext):
+        if context.args:
+            printer = self.fleet.get(context.args[0])
+            if printer is not None:
+                return printer
+
+        if context.user_data is not None:
+            printer = self.fleet.get(context.user_data.get('printer'))
+            if printer is not None:
+                return printer
+
+        return self.fleet.default()
+
+    # Last notified state of each printer from before the restart, so a change while the bot was down is notified
+    # with the first status update and an unchanged state is not notified again.
+    def restore_printer_states(self):
+        for printer in self.fleet.printers.values():
+            state = self.state_store.get('printers', printer.name)
+            if state is not None:
+                printer.printer_status = state['printer_status']
+                printer.printjob_state = state['printjob_state']
 
     def is_authorized(self, user_id, level):
-        return user_id in self.authorized_uses[level]
+        return auth_is_authorized(user_id, level)
 
     def error(self, update, context):
         """Log Errors caused by Updates."""
         print('[{}] Update caused error: {}'.format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), context.error))
 
-    def simulate_printer(self):
-        res = json.load(open('sim.json', "rt"))  
-        return res
+    # Start a fake printer for offline testing. The scenario file has the FakePrinter scenario values,
+    # point PRINTER_IP / CAMERA_PORT at the returned printer (printer_ip, camera_port).
+    def simulate_printer(self, scenario_path='sim.json', port=0, camera_port=0):
+        from .fake_printer import FakePrinter
+
+        scenario = None
+        if os.path.isfile(scenario_path):
+            with open(scenario_path, "rt") as f:
+                scenario = json.load(f)
+
+        return FakePrinter(scenario, port=port, camera_port=camera_port).start()
 
     def send_ok(self, update: Update, context: CallbackContext):
         chat_id = update.effective_chat.id
         context.bot.send_message(chat_id=chat_id, text="OK! 😀")
 
+    # A job that finds no pending snapshot left has had them handled by the job before it
     def status_notification_callback(self, context: CallbackContext):
-        response = self.ultimaker.get_printer_state()
+        printer = context.job.context
+        with printer.status_lock:
+            while printer.pending_snapshots:
+                snapshot, entries = printer.pending_snapshots.popleft()
+                STATUS_CALLBACK_LAG.observe(time.time() - snapshot.timestamp, printer=printer.name)
+                with STATUS_CALLBACK_SECONDS.time(printer=printer.name):
+                    self.live_status.update(printer, snapshot)
+                    self.publish_events(printer, entries)
+                    self.update_printer_status(context, printer, snapshot)
+
+    # One notification per event log entry, in the order they were logged
+    def publish_events(self, printer, entries):
+        for entry in entries:
+            msg = "Printer Event❗\n"
+            if self.fleet.is_multi():
+                msg += "   <b>Printer:</b> {}\n".format(printer.name)
+            msg += "   <b>{}</b> {}".format(format_event_time(entry['time']), html.escape(str(entry.get('message', ''))))
+            self.notifications.publish(classify_event(entry), msg)
+
+    # Text of the live status message. Times are shown to the minute and the progress in whole percent,
+    # so while printing the text changes about once a minute, not with every poll.
+    def render_live_status(self, printer, snapshot):
+        msg = "<b>Printer:</b> {}\n".format(printer.name)
+        if snapshot is None or snapshot.error is not None or snapshot.printer['status_code'] != 200:
+            return msg + "<b>Printer Status:</b> Not reachable ‼"
+
+        msg += "<b>Printer Status:</b> {}\n".format(format_printer_status(snapshot.printer['status']))
+        if snapshot.printjob['status_code'] == 200:
+            msg += format_printjob_message(snapshot.printjob, time_format="%Y-%m-%d %H:%M", rounded=True)
+        else:
+            msg += "<b>Status:</b> No printer job running"
+        return msg
+
+    def update_printer_status(self, context: CallbackContext, printer, snapshot):
+        if snapshot.error is not None:
+            print ('[{}] Status update failed ({}): {}'.format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), printer.name, snapshot.error))
+            return
+
+        response = snapshot.printer_state()
+        if response['status_code'] != 200:
+            return
+
+        if self.timelapse_executor is not None:
+            self.update_timelapse(printer, snapshot, response, context.bot)
+
+        old_printer_status = printer.printer_status
+        old_printjob_state = printer.printjob_state
         changed = False
 
-        if self.printer_status == None:
-            self.printer_status = response['printer_status']
+        if printer.printer_status == None:
+            printer.printer_status = response['printer_status']
         else:
-            if self.printer_status != response['printer_status']:
+            if printer.printer_status != response['printer_status']:
                 # printer_status changed
-                self.printer_status = response['printer_status']
+                printer.printer_status = response['printer_status']
                 changed = True
-        if self.printjob_state == None:
-            self.printjob_state = response['printjob_state']
+        if printer.printjob_state == None:
+            printer.printjob_state = response['printjob_state']
         else:
-            if self.printjob_state != response['printjob_state']:
+            if printer.printjob_state != response['printjob_state']:
                 # printer_status changed
-                self.printjob_state = response['printjob_state']
+                printer.printjob_state = response['printjob_state']
                 changed = True
 
-        if changed:
-            # notify users
-            for user_id in auth_get_notify_group():
-                msg = "Status Changed❗\n"
-                msg += "   <b>Printer Status:</b> {}\n".format(format_printer_status(self.printer_status))
-                msg += "   <b>Print Job Status:</b> {}".format(format_printjob_status(self.printjob_state))
-                if response['printjob_state'] == 'paused':
-                    msg += "<b>   Pause Source:</b> {0}\n".format(response['pause_source'])
-                context.bot.send_message(chat_id=user_id, text=msg, parse_mode=ParseMode.HTML)
+        self.state_store.set('printers', printer.name, { 'printer_status': printer.printer_status, 'printjob_state': printer.printjob_state })
+
+        # printers with an event log are notified from its entries, they also have the changes between two polls
+        if changed and not self.has_event_log(printer):
+            # notify subscribed users, sending is done by the notification engine threads
+            msg = "Status Changed❗\n"
+            if self.fleet.is_multi():
+                msg += "   <b>Printer:</b> {}\n".format(printer.name)
+            msg += "   <b>Printer Status:</b> {}\n".format(format_printer_status(printer.printer_status))
+            msg += "   <b>Print Job Status:</b> {}".format(format_printjob_status(printer.printjob_state))
+            if response['printjob_state'] == 'paused':
+                msg += "<b>   Pause Source:</b> {0}\n".format(response['pause_source'])
+
+            event = classify_change(old_printer_status, printer.printer_status, old_printjob_state, printer.printjob_state)
+            self.notifications.publish(event, msg)
+
+    # Start recording when the job is printing, stop it at post print and send the animation when it is encoded.
+    def update_timelapse(self, printer, snapshot, response, bot):
+        if printer.timelapse is None:
+            if response['printjob_state'] == 'printing':
+                # numpy and Pillow are only imported when a timelapse is recorded
+                from .timelapse import TimelapseRecorder
+                printer.timelapse = TimelapseRecorder(printer.camera, self.config.TIMELAPSE_DIR, snapshot.printjob['print_name'],
+                                                      self.config.TIMELAPSE_INTERVAL, self.timelapse_executor, self.config.TIMELAPSE_THIN_THRESHOLD)
+                printer.timelapse.start()
+        elif response['printjob_state'] in self.TIMELAPSE_STOP_STATES:
+            # the recorder is not waited for here, encoding starts when its thread ends
+            timelapse, printer.timelapse = printer.timelapse, None
+            timelapse.stop(lambda future: future.add_done_callback(lambda f: self.send_timelapse(printer, timelapse, f, bot)))
+
+    def send_timelapse(self, printer, timelapse, future, bot):
+        try:
+            path = future.result()
+        except Exception as ex:
+            print ('Timelapse: Could not encode {}: {}'.format(timelapse.job_name, ex))
+            return
+
+        caption = 'Timelapse: {}'.format(timelapse.job_name)
+        if self.fleet.is_multi():
+            caption = '{} ({})'.format(caption, printer.name)
+
+        for user_id in self.notifications.recipients(EVENT_COMPLETE):
+            try:
+                with open(path, 'rb') as f:
+                    bot.send_animation(chat_id=user_id, animation=f, caption=caption)
+            except Exception as ex:
+                print ('Timelapse: Could not send {} to {}: {}'.format(path, user_id, ex))
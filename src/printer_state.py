@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from .ultimaker import UltimakerError
+from .metrics import POLL_SECONDS
+
+
+class PrinterSnapshot(namedtuple('PrinterSnapshot', ['printer', 'printjob', 'timestamp', 'error'])):
+    # Immutable view of api/v1/printer and api/v1/print_job taken at one poll.
+    # printer and printjob have the same keys as Ultimaker.get_printer_status and Ultimaker.get_printjob_status.
+    __slots__ = ()
+
+    def age(self):
+        return time.time() - self.timestamp
+
+    # Same result as Ultimaker.get_printjob_state
+    def printjob_state(self):
+        res = { 'status_code': self.printjob['status_code'] }
+        if self.printjob['status_code'] == 200:
+            res['printjob_state'] = self.printjob['status']
+        else:
+            res['printjob_state'] = 'no_printjob'
+
+        return res
+
+    # Same result as Ultimaker.get_printer_state
+    def printer_state(self):
+        res = { 'status_code': self.printer['status_code'] }
+        if self.printer['status_code'] == 200:
+            res['printer_status'] = self.printer['status']
+
+            if res['printer_status'] == 'printing':
+                res['printjob_state'] = self.printjob_state()['printjob_state']
+                if res['printjob_state'] == 'paused':
+                    res['pause_source'] = self.printjob['pause_source']
+            else:
+                res['printjob_state'] = 'no_printjob'
+
+        return res
+
+
+class PrinterStatePoller:
+    # Owns all status reads of one printer. A background thread refreshes the snapshot, waiting between polls
+    # as long as the schedule says (AdaptiveSchedule, or a fixed interval if there is none).
+    # Handlers read the latest snapshot and only hit the printer when it is older than ttl or on a forced refresh.
+    # Polls never overlap: a refresh requested during a poll waits for it and shares its result.
+    def __init__(self, ultimaker, interval, ttl, schedule=None):
+        self.ultimaker = ultimaker
+        self.interval = interval
+        self.ttl = ttl
+        self.schedule = schedule
+
+        self.__snapshot = None
+        self.__refresh_lock = threading.Lock()
+        self.__listener_lock = threading.Lock()
+        self.__delivered = None
+        self.__wakeup = threading.Event()
+        self.__listeners = []
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='PrinterStatePoller', daemon=True)
+            self.__thread.start()
+
+    # Listeners are called with each new snapshot, from the polling thread or from a handler thread that refreshed it.
+    # Calls never overlap and come in the order the snapshots were taken, a snapshot older than the last one is dropped.
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+    # Wake the polling thread up early, e.g. after a command changed the printer state.
+    def request_refresh(self):
+        self.__wakeup.set()
+
+    def get_snapshot(self, max_age=None):
+        if max_age is None:
+            max_age = self.ttl
+
+        snapshot = self.__snapshot
+        if snapshot is None or snapshot.age() > max_age:
+            snapshot = self.refresh()
+        return snapshot
+
+    # Fetch a new snapshot. Concurrent callers share one fetch: whoever waited for the lock
+    # gets the snapshot taken by the holder, as it was started after they asked for it.
+    def refresh(self):
+        requested = time.time()
+        with self.__refresh_lock:
+            snapshot = self.__snapshot
+            if snapshot is not None and snapshot.timestamp >= requested:
+                return snapshot
+
+            snapshot = self.fetch()
+            self.__snapshot = snapshot
+
+        with self.__listener_lock:
+            if self.__delivered is not None and snapshot.timestamp <= self.__delivered:
+                return snapshot
+            self.__delivered = snapshot.timestamp
+
+            for listener in self.__listeners:
+                try:
+                    listener(snapshot)
+                except Exception as ex:
+                    print ('PrinterStatePoller: listener failed: {}'.format(ex))
+
+        return snapshot
+
+    def fetch(self):
+        timestamp = time.time()
+        try:
+            with POLL_SECONDS.time(printer=self.ultimaker.name):
+                printer, printjob = self.ultimaker.get_printer_and_printjob_status()
+            error = None
+        except UltimakerError as uer:
+            printer = { 'status_code': None }
+            printjob = { 'status_code': None }
+            error = uer.message
+
+        return PrinterSnapshot(MappingProxyType(printer), MappingProxyType(printjob), timestamp, error)
+
+    def __run(self):
+        while True:
+            snapshot = None
+            try:
+                snapshot = self.refresh()
+            except Exception as ex:
+                print ('PrinterStatePoller: poll failed: {}'.format(ex))
+
+            delay = self.schedule.next_delay(snapshot) if self.schedule is not None else self.interval
+            self.__wakeup.wait(delay)
+            self.__wakeup.clear()
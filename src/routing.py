@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from telegram import Update
+from telegram.ext import Handler
+
+
+class RouteHandler(Handler):
+    # One handler for many exact keys: the key of the update is looked up in a dict,
+    # so the cost of matching an update does not grow with the number of buttons.
+    # Returns the routed callback's result, so it can be used in ConversationHandler states.
+    def __init__(self, routes=None):
+        super().__init__(self.__route)
+        self.routes = dict(routes or {})
+
+    def add(self, key, callback):
+        self.routes[key] = callback
+
+    def route_key(self, update):
+        raise NotImplementedError
+
+    def check_update(self, update):
+        if not isinstance(update, Update):
+            return None
+        return self.routes.get(self.route_key(update))
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        self.collect_additional_context(context, update, dispatcher, check_result)
+        return check_result(update, context)
+
+    def __route(self, update, context):
+        return self.routes[self.route_key(update)](update, context)
+
+
+class TextRouter(RouteHandler):
+    # Reply keyboard buttons, routed by the exact message text
+    def route_key(self, update):
+        if update.message is None:
+            return None
+        return update.message.text
+
+
+class CallbackRouter(RouteHandler):
+    # Inline keyboard buttons, routed by the exact callback data
+    def route_key(self, update):
+        if update.callback_query is None:
+            return None
+        return update.callback_query.data
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+
+class AdaptiveSchedule:
+    # Delay until the next poll of one printer, chosen from the last snapshot:
+    # fast while the printer is changing state, normal while printing, slow while idle or waiting for the build plate
+    # to be cleared (which can take hours), and exponential backoff with jitter while the printer can not be reached.
+    FAST_STATES = ('pre_print', 'pausing', 'resuming')
+    FAST_PRINTER_STATUSES = ('booting',)
+    IDLE_STATES = ('wait_cleanup',)
+    IDLE_PRINTER_STATUSES = ('idle',)
+
+    def __init__(self, interval, fast_interval, idle_interval, max_backoff):
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.idle_interval = idle_interval
+        self.max_backoff = max_backoff
+        self.failures = 0
+
+    def next_delay(self, snapshot):
+        if snapshot is None:
+            return self.interval
+
+        if snapshot.error is not None or snapshot.printer['status_code'] != 200:
+            self.failures += 1
+            delay = min(self.max_backoff, self.interval * 2 ** self.failures)
+            # full jitter, so printers that went down together do not come back in lockstep
+            return random.uniform(self.interval, delay)
+
+        self.failures = 0
+        printer_status = snapshot.printer['status']
+        printjob_state = snapshot.printjob['status'] if snapshot.printjob['status_code'] == 200 else None
+
+        if printjob_state in self.FAST_STATES or printer_status in self.FAST_PRINTER_STATUSES:
+            return self.fast_interval
+        if printjob_state in self.IDLE_STATES or printer_status in self.IDLE_PRINTER_STATUSES:
+            return self.idle_interval
+        return self.interval
@@ -2,6 +2,7 @@
 
 from dotenv import load_dotenv
 import os
+import json
 
 
 class SettingsError(Exception):
@@ -14,35 +15,73 @@ class SettingsError(Exception):
     def __init__(self, message):
         self.message = message
 
-class Settings():
-    def __init__(self):
-        self.TLEGRAM_TOKEN = os.getenv("TLEGRAM_TOKEN")
-        if check_not_set(self.TLEGRAM_TOKEN):
-            raise SettingsError("Settings: TLEGRAM_TOKEN env variable has not been set")
-
-        self.STATIC_IP = os.getenv("STATIC_IP")
-        self.STATIC_IP = self.STATIC_IP.lower() == 'true' if self.STATIC_IP is not None else False
-
-        self.PRINTER_IP = os.getenv("PRINTER_IP")
-        self.PRINTER_MAC = os.getenv("PRINTER_MAC")
-        self.PRINTER_SUBNET = os.getenv("PRINTER_SUBNET")
+class PrinterSettings():
+    # Connection settings of one printer, same attribute names as the single printer env variables.
+    def __init__(self, name, static_ip, printer_ip, printer_mac, printer_subnet, ultimaker_id, ultimaker_key, camera_port=8080):
+        self.NAME = name
+        self.STATIC_IP = static_ip
+        self.PRINTER_IP = printer_ip
+        self.PRINTER_MAC = printer_mac
+        self.PRINTER_SUBNET = printer_subnet
+        self.ULTIMAKER_ID = ultimaker_id
+        self.ULTIMAKER_KEY = ultimaker_key
+        self.CAMERA_PORT = camera_port
 
         if self.STATIC_IP:
             if check_not_set(self.PRINTER_IP):
-                raise SettingsError("Settings: STATIC_IP is set to True, but PRINTER_IP env variable has not been set")
+                raise SettingsError("Settings: STATIC_IP is set to True, but PRINTER_IP has not been set for printer {}".format(name))
         else:
             if check_not_set(self.PRINTER_MAC):
-                raise SettingsError("Ultimaker: STATIC_IP is set to False, but PRINTER_MAC env variable has not been set")
+                raise SettingsError("Ultimaker: STATIC_IP is set to False, but PRINTER_MAC has not been set for printer {}".format(name))
             if check_not_set(self.PRINTER_SUBNET):
-                raise SettingsError("Ultimaker: STATIC_IP is set to False, but PRINTER_SUBNET env variable has not been set")
+                raise SettingsError("Ultimaker: STATIC_IP is set to False, but PRINTER_SUBNET has not been set for printer {}".format(name))
 
-        self.ULTIMAKER_ID = os.getenv("ULTIMAKER_ID")
         if check_not_set(self.ULTIMAKER_ID):
-            raise SettingsError("Settings: ULTIMAKER_ID env variable has not been set")
+            raise SettingsError("Settings: ULTIMAKER_ID has not been set for printer {}".format(name))
 
-        self.ULTIMAKER_KEY = os.getenv("ULTIMAKER_KEY")
         if check_not_set(self.ULTIMAKER_KEY):
-            raise SettingsError("Settings: ULTIMAKER_KEY env variable has not been set")
+            raise SettingsError("Settings: ULTIMAKER_KEY has not been set for printer {}".format(name))
+
+
+class Settings():
+    def __init__(self):
+        self.TLEGRAM_TOKEN = os.getenv("TLEGRAM_TOKEN")
+        if check_not_set(self.TLEGRAM_TOKEN):
+            raise SettingsError("Settings: TLEGRAM_TOKEN env variable has not been set")
+
+        self.BOT_MODE = get_env("BOT_MODE", "polling").lower()
+        if self.BOT_MODE not in ('polling', 'webhook'):
+            raise SettingsError("Settings: BOT_MODE has to be polling or webhook")
+
+        self.BOT_WORKERS = get_int_env("BOT_WORKERS", 4)
+        # Bot api server, only changed for testing with a local stand-in (default https://api.telegram.org/bot)
+        self.BOT_API_URL = get_env("BOT_API_URL")
+        # update types the bot receives, e.g. message,callback_query (all types if not set)
+        self.ALLOWED_UPDATES = get_list_env("ALLOWED_UPDATES")
+
+        # threads for slow handlers: camera images and thumbnails, model uploads, and the calls each class may queue
+        self.MEDIA_HANDLER_WORKERS = get_int_env("MEDIA_HANDLER_WORKERS", 4)
+        self.UPLOAD_HANDLER_WORKERS = get_int_env("UPLOAD_HANDLER_WORKERS", 2)
+        self.HANDLER_QUEUE_SIZE = get_int_env("HANDLER_QUEUE_SIZE", 16)
+
+        self.POLL_TIMEOUT = get_int_env("POLL_TIMEOUT", 10)
+        self.POLL_INTERVAL = get_float_env("POLL_INTERVAL", 0.0)
+
+        self.WEBHOOK_LISTEN = get_env("WEBHOOK_LISTEN", "127.0.0.1")
+        self.WEBHOOK_PORT = get_int_env("WEBHOOK_PORT", 8443)
+        self.WEBHOOK_PATH = get_env("WEBHOOK_PATH")
+        self.WEBHOOK_URL = get_env("WEBHOOK_URL")
+        self.WEBHOOK_CERT = get_env("WEBHOOK_CERT")
+        self.WEBHOOK_KEY = get_env("WEBHOOK_KEY")
+        # Telegram needs a public url, the listener's own address (e.g. https://127.0.0.1:8443/...) only works with a local Bot api
+        if self.BOT_MODE == 'webhook' and self.WEBHOOK_URL is None and self.BOT_API_URL is None:
+            raise SettingsError("Settings: WEBHOOK_URL has to be set when BOT_MODE is webhook")
+
+        self.PRINTERS_FILE = get_env("PRINTERS_FILE")
+        if self.PRINTERS_FILE is None:
+            self.PRINTERS = [self.load_env_printer()]
+        else:
+            self.PRINTERS = load_printers(self.PRINTERS_FILE)
 
         self.STATUS_UPDATE_INTERVAL = os.getenv("STATUS_UPDATE_INTERVAL")
         if check_not_set(self.STATUS_UPDATE_INTERVAL):
@@ -53,10 +92,140 @@ class Settings():
         except ValueError:
             raise SettingsError("Settings: STATUS_UPDATE_INTERVAL env variable has to be integer")
 
+        self.STATE_CACHE_TTL = get_int_env("STATE_CACHE_TTL", self.STATUS_UPDATE_INTERVAL)
+
+        self.FAST_UPDATE_INTERVAL = get_float_env("FAST_UPDATE_INTERVAL", min(1.0, self.STATUS_UPDATE_INTERVAL))
+        self.IDLE_UPDATE_INTERVAL = get_float_env("IDLE_UPDATE_INTERVAL", self.STATUS_UPDATE_INTERVAL * 10.0)
+        self.MAX_UPDATE_BACKOFF = get_float_env("MAX_UPDATE_BACKOFF", 300.0)
+
+        # number of samples kept per printer, one per poll
+        self.TELEMETRY_CAPACITY = get_int_env("TELEMETRY_CAPACITY", 17280)
+
+        self.DISCOVERY_WORKERS = get_int_env("DISCOVERY_WORKERS", 32)
+        self.IP_CACHE_FILE = get_env("IP_CACHE_FILE", "config/ip_cache.json")
+        # last notified printer states, menu conversations and live status messages, kept across restarts
+        self.STATE_FILE = get_env("STATE_FILE", "config/state.json")
+        self.STATE_WRITE_DELAY = get_float_env("STATE_WRITE_DELAY", 1.0)
+
+        # seconds between attempts to connect the printers while none can be reached
+        self.ATTACH_RETRY_INTERVAL = get_float_env("ATTACH_RETRY_INTERVAL", 30.0)
+
+        # printer api requests: retries of GETs after a network error, and the circuit breaker
+        self.REQUEST_RETRIES = get_int_env("REQUEST_RETRIES", 1)
+        self.REQUEST_RETRY_BACKOFF = get_float_env("REQUEST_RETRY_BACKOFF", 0.5)
+        self.BREAKER_FAILURES = get_int_env("BREAKER_FAILURES", 3)
+        self.BREAKER_RESET = get_float_env("BREAKER_RESET", 30.0)
+
+        self.CAMERA_STREAM = get_bool_env("CAMERA_STREAM", False)
+        self.CAMERA_MAX_AGE = get_float_env("CAMERA_MAX_AGE", 1.0)
+
+        self.NOTIFY_SUBSCRIPTIONS_FILE = get_env("NOTIFY_SUBSCRIPTIONS_FILE", "config/subscriptions.json")
+        self.NOTIFY_DIGEST_WINDOW = get_float_env("NOTIFY_DIGEST_WINDOW", 0.0)
+        self.NOTIFY_WORKERS = get_int_env("NOTIFY_WORKERS", 8)
+
+        # notify from the printer event log (api/v1/history/events) instead of comparing consecutive states
+        self.EVENT_LOG_SYNC = get_bool_env("EVENT_LOG_SYNC", True)
+        self.EVENT_LOG_PAGE_SIZE = get_int_env("EVENT_LOG_PAGE_SIZE", 20)
+
+        self.LIVE_STATUS_INTERVAL = get_float_env("LIVE_STATUS_INTERVAL", 10.0)
+        self.LIVE_STATUS_PIN = get_bool_env("LIVE_STATUS_PIN", False)
+
+        self.TIMELAPSE = get_bool_env("TIMELAPSE", False)
+        self.TIMELAPSE_DIR = get_env("TIMELAPSE_DIR", "timelapse")
+        self.TIMELAPSE_INTERVAL = get_float_env("TIMELAPSE_INTERVAL", 60.0)
+        self.TIMELAPSE_THIN_THRESHOLD = get_float_env("TIMELAPSE_THIN_THRESHOLD", 0.0)
+        self.TIMELAPSE_WORKERS = get_int_env("TIMELAPSE_WORKERS", 1)
+
+        # seconds between checks of the users file for changes, 0 disables reloading
+        self.USERS_RELOAD_INTERVAL = get_float_env("USERS_RELOAD_INTERVAL", 2.0)
+
+        # 0 disables the metrics endpoint
+        self.METRICS_PORT = get_int_env("METRICS_PORT", 0)
+        self.METRICS_HOST = get_env("METRICS_HOST", "127.0.0.1")
+
+    # Single printer configured with env variables
+    def load_env_printer(self):
+        static_ip = os.getenv("STATIC_IP")
+        static_ip = static_ip.lower() == 'true' if static_ip is not None else False
+
+        return PrinterSettings(
+            name=get_env("PRINTER_NAME", "Ultimaker"),
+            static_ip=static_ip,
+            printer_ip=os.getenv("PRINTER_IP"),
+            printer_mac=os.getenv("PRINTER_MAC"),
+            printer_subnet=os.getenv("PRINTER_SUBNET"),
+            ultimaker_id=os.getenv("ULTIMAKER_ID"),
+            ultimaker_key=os.getenv("ULTIMAKER_KEY"),
+            camera_port=get_int_env("CAMERA_PORT", 8080)
+        )
+
 
 def check_not_set(var):
     return (var is None or var == '')
 
+def get_env(name, default=None):
+    value = os.getenv(name)
+    return default if check_not_set(value) else value
+
+def get_int_env(name, default=None):
+    value = os.getenv(name)
+    if check_not_set(value):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise SettingsError("Settings: {} env variable has to be integer".format(name))
+
+def get_float_env(name, default=None):
+    value = os.getenv(name)
+    if check_not_set(value):
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise SettingsError("Settings: {} env variable has to be number".format(name))
+
+def get_bool_env(name, default=False):
+    value = os.getenv(name)
+    if check_not_set(value):
+        return default
+    return value.lower() == 'true'
+
+# Comma separated list, None if not set
+def get_list_env(name, default=None):
+    value = os.getenv(name)
+    if check_not_set(value):
+        return default
+    return [item.strip() for item in value.split(',') if item.strip() != '']
+
+def load_printers(printers_path):
+    try:
+        with open(printers_path, "rt") as f:
+            printers_config = json.load(f)
+    except (IOError, ValueError):
+        raise SettingsError("Settings: Could not load printers config file: {}".format(printers_path))
+
+    printers = []
+    for printer in printers_config['printers']:
+        printers.append(PrinterSettings(
+            name=printer['name'],
+            static_ip=printer.get('static_ip', False),
+            printer_ip=printer.get('ip'),
+            printer_mac=printer.get('mac'),
+            printer_subnet=printer.get('subnet'),
+            ultimaker_id=printer.get('ultimaker_id'),
+            ultimaker_key=printer.get('ultimaker_key'),
+            camera_port=printer.get('camera_port', 8080)
+        ))
+
+    names = [printer.NAME for printer in printers]
+    if len(printers) == 0:
+        raise SettingsError("Settings: No printers in printers config file: {}".format(printers_path))
+    if len(set(names)) != len(names):
+        raise SettingsError("Settings: Printer names have to be unique: {}".format(printers_path))
+
+    return printers
+
 def load_settings(config_path, env_file):
     print (os.path.join(config_path, env_file + '.env'))
     print (__file__)
@@ -3,15 +3,17 @@
 #from telegram.ext import Updater, CommandHandler, RegexHandler, MessageHandler, CallbackQueryHandler, Filters, CallbackContext, ConversationHandler
 #from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, ParseMode, ChatAction, InlineKeyboardButton, InlineKeyboardMarkup
 
-from io import BytesIO, BufferedWriter, BufferedReader
 import traceback
 
-from telegram.ext import ConversationHandler, MessageHandler, Filters, CallbackQueryHandler, CallbackContext
+from telegram.ext import ConversationHandler, MessageHandler, Filters, CallbackContext
 from telegram import Update, InlineKeyboardMarkup, ParseMode, ChatAction
 
 from .auth import authorized
+from .handler_pool import run_in_pool, BUSY_TEXT
+from .routing import TextRouter, CallbackRouter
 from .utils import build_inline_keyboard
 from .text_formating import format_printjob_status
+from .upload import SpoolBuffer, MultipartUploadStream, UploadProgressMessage, spool_download
 
 
 class SettingsMenu:
@@ -74,41 +76,61 @@ class SettingsMenu:
             [ self.MENU_BACK_SETTINGS ]
         ]
 
+        # markups are built once and reused by the callbacks
+        self.MARKUP_SETTINGS = InlineKeyboardMarkup(build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS))
+        self.MARKUP_SETTINGS_LED = InlineKeyboardMarkup(build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS_LED))
+        self.MARKUP_SETTINGS_PRINTJOB = InlineKeyboardMarkup(build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS_PRINTJOB))
+        self.MARKUP_YES_NO_BACK = InlineKeyboardMarkup(build_inline_keyboard(self.MENU_INLINELAYOUT_YES_NO_BACK))
+
     def add_handlers(self, dp):
         dp.add_handler(self.settings_handler())
 
     def settings_handler(self):
         settings_conv_handler = ConversationHandler(
-            entry_points=[MessageHandler(Filters.regex('^{}$'.format(self.main_menu.MENU_PRINTER_SETTINGS)), self.printer_settings_cmd)],
+            entry_points=[TextRouter({ self.main_menu.MENU_PRINTER_SETTINGS: self.printer_settings_cmd })],
 
+            # inline buttons of each state, looked up by their callback data
             states={
-                self.SETTINGS: [CallbackQueryHandler(self.printer_settings_leds_cb, pattern='^{}$'.format(self.MENU_SETTINGS_LEDS)),
-                                CallbackQueryHandler(self.printer_settings_printjob_cb, pattern='^{}$'.format(self.MENU_SETTINGS_PRINTJOB))],
-
-                self.LEDS: [CallbackQueryHandler(self.printer_leds_high_cb, pattern='^{}$'.format(self.MENU_SET_LED_HIGH)),
-                                CallbackQueryHandler(self.printer_leds_medium_cb, pattern='^{}$'.format(self.MENU_SET_LED_MEDIUM)),
-                                CallbackQueryHandler(self.printer_leds_low_cb, pattern='^{}$'.format(self.MENU_SET_LED_LOW)),
-                                CallbackQueryHandler(self.printer_leds_level_cb, pattern='^{}$'.format(self.MENU_GET_LED_LEVEL))],
-
-                self.PRINTJOB : [CallbackQueryHandler(self.printjob_state_cb, pattern='^{}$'.format(self.MENU_GET_PRINTJOB_STATE)),
-                                CallbackQueryHandler(self.printjob_thumbnail_cb, pattern='^{}$'.format(self.MENU_GET_PRINTJOB_THUMBNAIL)),
-                                CallbackQueryHandler(self.printjob_print_model_cb, pattern='^{}$'.format(self.MENU_PRINT_MODEL)),
-                                CallbackQueryHandler(self.printjob_pause_cb, pattern='^{}$'.format(self.MENU_PAUSE_PRINTJOB_STATE)),
-                                CallbackQueryHandler(self.printjob_unpause_cb, pattern='^{}$'.format(self.MENU_UNPAUSE_PRINTJOB_STATE))],
-
-                self.PRINTJOB_PAUSING: [CallbackQueryHandler(self.printjob_pause_no_cb, pattern='^{}$'.format(self.MENU_NO)),
-                                        CallbackQueryHandler(self.printjob_pause_yes_cb, pattern='^{}$'.format(self.MENU_YES))],
-
-                self.PRINTJOB_UNPAUSING: [CallbackQueryHandler(self.printjob_unpause_no_cb, pattern='^{}$'.format(self.MENU_NO)),
-                                        CallbackQueryHandler(self.printjob_unpause_yes_cb, pattern='^{}$'.format(self.MENU_YES))],
+                self.SETTINGS: [CallbackRouter({
+                    self.MENU_SETTINGS_LEDS: self.printer_settings_leds_cb,
+                    self.MENU_SETTINGS_PRINTJOB: self.printer_settings_printjob_cb
+                })],
+
+                self.LEDS: [CallbackRouter({
+                    self.MENU_SET_LED_HIGH: self.printer_leds_high_cb,
+                    self.MENU_SET_LED_MEDIUM: self.printer_leds_medium_cb,
+                    self.MENU_SET_LED_LOW: self.printer_leds_low_cb,
+                    self.MENU_GET_LED_LEVEL: self.printer_leds_level_cb
+                })],
+
+                self.PRINTJOB : [CallbackRouter({
+                    self.MENU_GET_PRINTJOB_STATE: self.printjob_state_cb,
+                    self.MENU_GET_PRINTJOB_THUMBNAIL: self.printjob_thumbnail_cb,
+                    self.MENU_PRINT_MODEL: self.printjob_print_model_cb,
+                    self.MENU_PAUSE_PRINTJOB_STATE: self.printjob_pause_cb,
+                    self.MENU_UNPAUSE_PRINTJOB_STATE: self.printjob_unpause_cb
+                })],
+
+                self.PRINTJOB_PAUSING: [CallbackRouter({
+                    self.MENU_NO: self.printjob_pause_no_cb,
+                    self.MENU_YES: self.printjob_pause_yes_cb
+                })],
+
+                self.PRINTJOB_UNPAUSING: [CallbackRouter({
+                    self.MENU_NO: self.printjob_unpause_no_cb,
+                    self.MENU_YES: self.printjob_unpause_yes_cb
+                })],
 
                 self.PRINT_MODEL: [MessageHandler(Filters.document, self.download_model_file_cb)]
             },
 
-            fallbacks=[MessageHandler(Filters.regex('^{}$'.format(self.main_menu.MENU_PRINTER_SETTINGS)), self.printer_settings_cmd),
+            fallbacks=[TextRouter({ self.main_menu.MENU_PRINTER_SETTINGS: self.printer_settings_cmd }),
                         MessageHandler(Filters.text, self.done), 
-                        CallbackQueryHandler(self.printer_back_settings_cb, pattern='^{}$'.format(self.MENU_BACK_SETTINGS))],
+                        CallbackRouter({ self.MENU_BACK_SETTINGS: self.printer_back_settings_cb })],
             #per_user=True
+            # kept in the state store, an open settings menu still works after a restart
+            name='settings',
+            persistent=True
         )
 
         return settings_conv_handler
@@ -116,8 +138,7 @@ class SettingsMenu:
     @authorized('control')
     def printer_settings_cmd(self, update: Update, context: CallbackContext):
         chat_id = update.effective_chat.id
-        button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS)
-        reply_markup = InlineKeyboardMarkup(button_list)
+        reply_markup = self.MARKUP_SETTINGS
 
         context.bot.send_message(chat_id=chat_id, text=self.MENU_SETTINGS_HEADER, reply_markup=reply_markup)
 
@@ -125,8 +146,7 @@ class SettingsMenu:
 
     @authorized('control')
     def printer_back_settings_cb(self, update: Update, context: CallbackContext):
-        button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS)
-        reply_markup = InlineKeyboardMarkup(button_list)
+        reply_markup = self.MARKUP_SETTINGS
 
         self.edit_message_text(update, context, self.MENU_SETTINGS_HEADER, reply_markup)
 
@@ -134,8 +154,7 @@ class SettingsMenu:
 
     @authorized('control')
     def printer_settings_leds_cb(self, update: Update, context: CallbackContext):
-        button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS_LED)
-        reply_markup = InlineKeyboardMarkup(button_list)
+        reply_markup = self.MARKUP_SETTINGS_LED
 
         self.edit_message_text(update, context, self.MENU_SETTINGS_LEDS_HEADER, reply_markup)
 
@@ -143,8 +162,7 @@ class SettingsMenu:
 
     @authorized('control')
     def printer_settings_printjob_cb(self, update: Update, context: CallbackContext):
-        button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS_PRINTJOB)
-        reply_markup = InlineKeyboardMarkup(button_list)
+        reply_markup = self.MARKUP_SETTINGS_PRINTJOB
 
         self.edit_message_text(update, context, self.MENU_SETTINGS_PRINTJOB_HEADER, reply_markup)
 
@@ -152,7 +170,7 @@ class SettingsMenu:
 
     @authorized('control')
     def printer_leds_high_cb(self, update: Update, context: CallbackContext):
-        res = self.printer_bot.ultimaker.set_led_brightness(100)
+        res = self.printer_bot.get_printer(context).ultimaker.set_led_brightness(100)
         if res['status_code'] == 200:
             text = self.MENU_SETTINGS_LEDS_HEADER + '\n  Setting LEDs to High'
             self.edit_message_text(update, context, text=text)
@@ -164,7 +182,7 @@ class SettingsMenu:
 
     @authorized('control')
     def printer_leds_low_cb(self, update: Update, context: CallbackContext):
-        res = self.printer_bot.ultimaker.set_led_brightness(0)
+        res = self.printer_bot.get_printer(context).ultimaker.set_led_brightness(0)
 
         if res['status_code'] == 200:
             text = self.MENU_SETTINGS_LEDS_HEADER + '\n  Setting LEDs to Low'
@@ -177,7 +195,7 @@ class SettingsMenu:
 
     @authorized('control')
     def printer_leds_medium_cb(self, update: Update, context: CallbackContext):
-        res = self.printer_bot.ultimaker.set_led_brightness(50)
+        res = self.printer_bot.get_printer(context).ultimaker.set_led_brightness(50)
 
         if res['status_code'] == 200:
             text = self.MENU_SETTINGS_LEDS_HEADER + '\n  Setting LEDs to Medium'
@@ -190,7 +208,7 @@ class SettingsMenu:
 
     @authorized('control')
     def printer_leds_level_cb(self, update: Update, context: CallbackContext):
-        res = self.printer_bot.ultimaker.get_led_brightness()
+        res = self.printer_bot.get_printer(context).ultimaker.get_led_brightness()
 
         if res['status_code'] == 200:
             text = self.MENU_SETTINGS_LEDS_HEADER + '\n  LEDs are set to {}'.format(res['level'])
@@ -201,16 +219,18 @@ class SettingsMenu:
 
     @authorized('control')
     def printjob_state_cb(self, update: Update, context: CallbackContext):
-        res = self.printer_bot.ultimaker.get_printjob_state()
+        res = self.printer_bot.get_printer(context).state_poller.get_snapshot().printjob_state()
 
         text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  <b>State</b>: ' + format_printjob_status(res['printjob_state'])
         self.edit_message_text(update, context, text=text, parse_mode=ParseMode.HTML)
 
     @authorized('control')
+    @run_in_pool('media')
     def printjob_thumbnail_cb(self, update: Update, context: CallbackContext):
         chat_id = update.callback_query.message.chat.id
 
-        res = self.printer_bot.ultimaker.get_printjob_thumbnail()
+        printer = self.printer_bot.get_printer(context)
+        res = printer.thumbnails.get(printer.state_poller.get_snapshot().printjob)
 
         if res['status_code'] == 200:
             if res['has_thumbnail']:
@@ -226,7 +246,7 @@ class SettingsMenu:
 
     @authorized('control')
     def printjob_pause_cb(self, update: Update, context: CallbackContext):
-        res = self.printer_bot.ultimaker.get_printjob_state()
+        res = self.printer_bot.get_printer(context).state_poller.refresh().printjob_state()
         if res['printjob_state'] == 'paused':
             text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Print Job has already been stoped!'
         elif res['printjob_state'] == 'no_printjob':
@@ -234,8 +254,7 @@ class SettingsMenu:
         elif res['printjob_state'] == 'printing':
             text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Are you sure you want to pause Print Job?'
 
-            button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_YES_NO_BACK)
-            reply_markup = InlineKeyboardMarkup(button_list)
+            reply_markup = self.MARKUP_YES_NO_BACK
 
             self.edit_message_text(update, context, text=text, reply_markup=reply_markup)
             return self.PRINTJOB_PAUSING
@@ -249,8 +268,7 @@ class SettingsMenu:
     @authorized('control')
     def printjob_pause_no_cb(self, update: Update, context: CallbackContext):
         text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Canceled Print Job pause command 🚫'
-        button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS_PRINTJOB)
-        reply_markup = InlineKeyboardMarkup(button_list)
+        reply_markup = self.MARKUP_SETTINGS_PRINTJOB
 
         self.edit_message_text(update, context, text=text, reply_markup=reply_markup)
         return self.PRINTJOB
@@ -259,16 +277,16 @@ class SettingsMenu:
     def printjob_pause_yes_cb(self, update: Update, context: CallbackContext):
         #text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  THIS COMMAND IS NOT SUPPORTED YET 🛑'
         text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Pausing print'
-        self.printer_bot.ultimaker.pause_printjob()
-        button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS_PRINTJOB)
-        reply_markup = InlineKeyboardMarkup(button_list)
+        self.printer_bot.get_printer(context).ultimaker.pause_printjob()
+        self.printer_bot.get_printer(context).state_poller.request_refresh()
+        reply_markup = self.MARKUP_SETTINGS_PRINTJOB
 
         self.edit_message_text(update, context, text=text, reply_markup=reply_markup)
         return self.PRINTJOB
 
     @authorized('control')
     def printjob_unpause_cb(self, update: Update, context: CallbackContext):
-        res = self.printer_bot.ultimaker.get_printjob_state()
+        res = self.printer_bot.get_printer(context).state_poller.refresh().printjob_state()
         if res['printjob_state'] == 'printing':
             text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Print Job is already printing!'
         elif res['printjob_state'] == 'no_printjob':
@@ -276,8 +294,7 @@ class SettingsMenu:
         elif res['printjob_state'] == 'paused':
             text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Are you sure you want to continue Print Job?'
 
-            button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_YES_NO_BACK)
-            reply_markup = InlineKeyboardMarkup(button_list)
+            reply_markup = self.MARKUP_YES_NO_BACK
 
             self.edit_message_text(update, context, text=text, reply_markup=reply_markup)
             return self.PRINTJOB_UNPAUSING
@@ -291,8 +308,7 @@ class SettingsMenu:
     @authorized('control')
     def printjob_unpause_no_cb(self, update: Update, context: CallbackContext):
         text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Canceled Print Job resume printing command 🚫'
-        button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS_PRINTJOB)
-        reply_markup = InlineKeyboardMarkup(button_list)
+        reply_markup = self.MARKUP_SETTINGS_PRINTJOB
 
         self.edit_message_text(update, context, text=text, reply_markup=reply_markup)
         return self.PRINTJOB
@@ -301,9 +317,9 @@ class SettingsMenu:
     def printjob_unpause_yes_cb(self, update: Update, context: CallbackContext):
         #text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  THIS COMMAND IS NOT SUPPORTED YET 🛑'
         text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Resuming print'
-        self.printer_bot.ultimaker.unpause_printjob()
-        button_list = build_inline_keyboard(self.MENU_INLINELAYOUT_SETTINGS_PRINTJOB)
-        reply_markup = InlineKeyboardMarkup(button_list)
+        self.printer_bot.get_printer(context).ultimaker.unpause_printjob()
+        self.printer_bot.get_printer(context).state_poller.request_refresh()
+        reply_markup = self.MARKUP_SETTINGS_PRINTJOB
 
         self.edit_message_text(update, context, text=text, reply_markup=reply_markup)
         return self.PRINTJOB
@@ -321,39 +337,41 @@ class SettingsMenu:
 
     @authorized('control')
     def download_model_file_cb(self, update: Update, context: CallbackContext):
-        try:
-            document_id = update.message.document.file_id
-            ducoment_name = update.message.document.file_name
-            print (ducoment_name)
-            model_file = context.bot.get_file(document_id)
-            bytes_io = BytesIO()
-            model_file.download(out=bytes_io)
+        document = update.message.document
+        chat_id = update.effective_chat.id
+        printer = self.printer_bot.get_printer(context)
 
-            #bytes_io.seek(0)
-            #print(self.printer_bot.ultimaker.print_model(ducoment_name, bytes_io.read()).json())
+        # the upload runs on the upload handler pool, so the conversation is not blocked
+        if not self.printer_bot.handler_pools['upload'].submit(self.upload_model_file, context.bot, chat_id, printer, document):
+            context.bot.send_message(chat_id=chat_id, text=BUSY_TEXT)
 
-            bytes_io.seek(0)
-            with open(ducoment_name,'wb') as out: 
-                out.write(bytes_io.read())
+        return self.PRINTJOB
 
-            # with open(ducoment_name,'rb') as out: 
-            #     print(type(out))
-            print(self.printer_bot.ultimaker.print_model(ducoment_name, ducoment_name).json())
+    # File goes from Telegram to the printer through a bounded in memory spool, nothing is written to disk.
+    def upload_model_file(self, bot, chat_id, printer, document):
+        progress = None
+        spool = SpoolBuffer()
+        try:
+            print (document.file_name)
+            progress = UploadProgressMessage(bot, chat_id, self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  ' + document.file_name)
 
-            # buffer = BufferedReader(bytes_io, buffer_size=20*1024*1024)
-            # buffer.seek(0)
-            # print(self.printer_bot.ultimaker.print_model(ducoment_name, buffer).json())
+            model_file = bot.get_file(document.file_id)
+            spool_download(model_file.file_path, spool)
 
-            text = self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  File has been sent'
+            stream = MultipartUploadStream('file', document.file_name, model_file.file_size or document.file_size, spool, progress.update)
+            response = printer.ultimaker.print_model_stream(stream)
+            printer.state_poller.request_refresh()
 
-            chat_id = update.effective_chat.id
-            context.bot.send_message(chat_id=chat_id, text=text)
+            if response.status_code in (200, 201):
+                progress.set_text(self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  File has been sent')
+            else:
+                progress.set_text(self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Printer did not accept the file ({})'.format(response.status_code))
         except Exception:
             traceback.print_exc()
-
-        return self.PRINTJOB
-
-        
+            if progress is not None:
+                progress.set_text(self.MENU_SETTINGS_PRINTJOB_HEADER + '\n  Could not send the file')
+        finally:
+            spool.cancel()
 
     def edit_message_text(self, update: Update, context: CallbackContext, text, reply_markup=None, parse_mode=None):
         chat_id = update.callback_query.message.chat.id
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import os
+import copy
+import json
+import threading
+from collections import defaultdict
+from telegram.ext import BasePersistence
+
+
+class StateStore:
+    # State that should survive a restart, kept in one small json file as sections of key -> json value.
+    # A change is written in the background after write_delay seconds, so a burst of changes is written once.
+    # The file is written to a temporary file and renamed over the store, a crash never leaves a half written store.
+    def __init__(self, path, write_delay=1.0):
+        self.path = path
+        self.write_delay = write_delay
+        self.__lock = threading.Lock()
+        self.__write_lock = threading.Lock()
+        self.__timer = None
+        self.__dirty = False
+        self.__sections = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rt') as f:
+                sections = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return sections if isinstance(sections, dict) else {}
+
+    def get(self, section, key, default=None):
+        with self.__lock:
+            value = self.__sections.get(section, {}).get(str(key))
+        return copy.deepcopy(value) if value is not None else default
+
+    # Copy of the whole section, {} if there is none
+    def section(self, section):
+        with self.__lock:
+            return copy.deepcopy(self.__sections.get(section, {}))
+
+    # Keys are stored as strings, as json objects have no other keys. Setting an unchanged value writes nothing.
+    def set(self, section, key, value):
+        with self.__lock:
+            values = self.__sections.setdefault(section, {})
+            if values.get(str(key)) == value:
+                return
+            values[str(key)] = copy.deepcopy(value)
+            self.__changed()
+
+    def delete(self, section, key):
+        with self.__lock:
+            values = self.__sections.get(section, {})
+            if str(key) not in values:
+                return
+            del values[str(key)]
+            self.__changed()
+
+    def __changed(self):
+        self.__dirty = True
+        if self.__timer is None:
+            self.__timer = threading.Timer(self.write_delay, self.flush)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    # Write pending changes now, e.g. before the bot stops
+    def flush(self):
+        with self.__write_lock:
+            with self.__lock:
+                if self.__timer is not None:
+                    self.__timer.cancel()
+                    self.__timer = None
+                if not self.__dirty:
+                    return
+                self.__dirty = False
+                try:
+                    data = json.dumps(self.__sections, indent=4)
+                except (TypeError, ValueError) as ex:
+                    print ('StateStore: Could not encode state: {}'.format(ex))
+                    return
+
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'wt') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+            except IOError:
+                print ('StateStore: Could not save state: {}'.format(self.path))
+
+
+class StatePersistence(BasePersistence):
+    # Bot persistence (conversation states, user_data, chat_data, bot_data) kept in the StateStore.
+    # The dispatcher reports the data of every update, only changed data is written.
+    def __init__(self, store):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True)
+        self.store = store
+
+    def get_user_data(self):
+        return defaultdict(dict, { int(user_id): data for user_id, data in self.store.section('user_data').items() })
+
+    def get_chat_data(self):
+        return defaultdict(dict, { int(chat_id): data for chat_id, data in self.store.section('chat_data').items() })
+
+    def get_bot_data(self):
+        return self.store.section('bot_data')
+
+    # Conversation keys are tuples of ids, stored as their json list
+    def get_conversations(self, name):
+        return { tuple(json.loads(key)): state for key, state in self.store.section('conversation_' + name).items() }
+
+    def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self.store.delete('conversation_' + name, json.dumps(list(key)))
+        else:
+            self.store.set('conversation_' + name, json.dumps(list(key)), new_state)
+
+    def update_user_data(self, user_id, data):
+        self.__update('user_data', user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self.__update('chat_data', chat_id, data)
+
+    def update_bot_data(self, data):
+        for key, value in data.items():
+            self.store.set('bot_data', key, value)
+
+    def __update(self, section, key, data):
+        if data:
+            self.store.set(section, key, data)
+        else:
+            self.store.delete(section, key)
+
+    def flush(self):
+        self.store.flush()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import numpy as np
+
+
+COLUMNS = ('timestamp', 'bed_cur', 'bed_target', 'ext_cur', 'ext_target', 'progress')
+COLUMN_INDEX = { column: index for index, column in enumerate(COLUMNS) }
+
+
+class TelemetryBuffer:
+    # Fixed capacity ring buffer of printer telemetry, one numpy row per column.
+    # When it is full the oldest samples are overwritten, so memory does not grow however long the bot runs.
+    # Missing values (e.g. progress when there is no print job) are stored as nan.
+    # Samples are kept in time order, window() searches the timestamps. A sample older than the last one is skipped.
+    def __init__(self, capacity=17280):
+        self.capacity = capacity
+        self.__data = np.full((len(COLUMNS), capacity), np.nan)
+        self.__next = 0
+        self.__count = 0
+        self.__last = -np.inf
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return self.__count
+
+    def record(self, timestamp, bed_cur, bed_target, ext_cur, ext_target, progress):
+        with self.__lock:
+            if timestamp < self.__last:
+                return
+            self.__last = timestamp
+            self.__data[:, self.__next] = (timestamp, bed_cur, bed_target, ext_cur, ext_target, progress)
+            self.__next = (self.__next + 1) % self.capacity
+            self.__count = min(self.__count + 1, self.capacity)
+
+    # Poller listener, records temperatures and progress of every snapshot
+    def record_snapshot(self, snapshot):
+        printer = snapshot.printer
+        if printer['status_code'] != 200:
+            return
+
+        printjob = snapshot.printjob
+        progress = printjob['progress'] if printjob['status_code'] == 200 else np.nan
+        self.record(snapshot.timestamp, printer['bed_temp_cur'], printer['bed_temp_target'],
+                    printer['ext_1_temp_cur'], printer['ext_1_temp_target'], progress)
+
+    # Return dict column -> array of the samples from the last seconds (all samples if seconds is None), oldest first
+    def window(self, seconds=None, columns=COLUMNS):
+        since = -np.inf if seconds is None else time.time() - seconds
+
+        with self.__lock:
+            if self.__count < self.capacity:
+                segments = [(0, self.__count)]
+            else:
+                segments = [(self.__next, self.capacity), (0, self.__next)]
+
+            # timestamps are sorted inside each segment
+            slices = []
+            for start, end in segments:
+                first = start + int(np.searchsorted(self.__data[0, start:end], since, side='left'))
+                if first < end:
+                    slices.append((first, end))
+
+            return { column: np.concatenate([self.__data[COLUMN_INDEX[column], start:end] for start, end in slices])
+                        if slices else np.empty(0) for column in columns }
+
+    # Return dict with min, max, mean and last value of the column, None if there are no samples
+    def stats(self, column, seconds=None):
+        values = self.window(seconds, (column,))[column]
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return None
+
+        return { 'min': float(values.min()), 'max': float(values.max()), 'mean': float(values.mean()), 'last': float(values[-1]) }
+
+    # Rate of change of the column per second (least squares slope), None if there are not enough samples
+    def rate(self, column, seconds=None):
+        window = self.window(seconds, ('timestamp', column))
+        valid = ~np.isnan(window[column])
+        timestamps = window['timestamp'][valid]
+        values = window[column][valid]
+        if len(values) < 2 or timestamps[-1] == timestamps[0]:
+            return None
+
+        timestamps = timestamps - timestamps.mean()
+        return float(np.dot(timestamps, values - values.mean()) / np.dot(timestamps, timestamps))
+
+    # Seconds since the current temperature has been within tolerance of the target.
+    # None if it is not at the target now, or the heater is off. If it was at the target for the whole
+    # window, the window length is returned.
+    def time_since_target_reached(self, current_column, target_column, tolerance=2.0, seconds=None):
+        window = self.window(seconds, ('timestamp', current_column, target_column))
+        timestamps = window['timestamp']
+        if len(timestamps) == 0 or not window[target_column][-1] > 0:
+            return None
+
+        reached = np.abs(window[current_column] - window[target_column]) <= tolerance
+        if not reached[-1]:
+            return None
+
+        not_reached = np.flatnonzero(~reached)
+        since = timestamps[not_reached[-1] + 1] if len(not_reached) > 0 else timestamps[0]
+        return time.time() - since
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+
+from .utils import progress_bar
+
+
 def format_printjob_status(text):
     if text == 'printing':
         text = 'Printing ▶'
@@ -34,3 +39,53 @@ def format_printer_status(text):
         text = 'Booting 🖥'
     return text
 
+
+# Time of a printer event log entry (utc) in the local timezone
+def format_event_time(text, time_format="%H:%M:%S"):
+    import dateutil.parser
+    from tzlocal import get_localzone
+
+    event_time_utc = dateutil.parser.parse(text).replace(tzinfo=datetime.timezone.utc)
+    return event_time_utc.astimezone(get_localzone()).strftime(time_format)
+
+
+# Print job details of a Ultimaker.get_printjob_status result (status_code 200), times in the local timezone.
+# rounded shows the remaining time to the minute and the progress in whole percent, so the text changes less often.
+def format_printjob_message(res, time_format="%Y-%m-%d %H:%M:%S", rounded=False):
+    # imported on first use, they are slow to import and only needed when a print job is shown
+    import dateutil.parser
+    from tzlocal import get_localzone
+
+    status = format_printjob_status(res['status'])
+
+    time_remaining_secs = res['time_total'] - res['time_elapsed']
+    if time_remaining_secs < 0:
+        time_remaining_secs = 0
+
+    time_remaining = datetime.timedelta(seconds=time_remaining_secs)
+    if rounded:
+        time_remaining_shown = str(datetime.timedelta(minutes=round(time_remaining_secs / 60.0)))[:-3]
+        progress_shown = "{0:.0f}%".format(res['progress'] * 100)
+    else:
+        time_remaining_shown = str(time_remaining)
+        progress_shown = "{0:.2f}%".format(res['progress'] * 100)
+
+    if 'datetime_finished' in res and res['datetime_finished'] != '':
+        end_time_utc = dateutil.parser.parse(res['datetime_finished']).replace(tzinfo=datetime.timezone.utc)
+        end_time = end_time_utc.astimezone(get_localzone())
+    else:
+        end_time = datetime.datetime.now() + time_remaining
+
+    start_time_utc = dateutil.parser.parse(res['datetime_started']).replace(tzinfo=datetime.timezone.utc)
+    start_time = start_time_utc.astimezone(get_localzone())
+
+    msg = "<b>Status:</b> {0}\n".format(status)
+    if res['status'] == 'paused':
+        msg += "<b>Pause Source:</b> {0}\n".format(res['pause_source'])
+    msg += "<b>Model name:</b> {0}\n".format(res['print_name'])
+    msg += "<b>Total time:</b> {0}\n".format(str(datetime.timedelta(seconds=res['time_total'])))
+    msg += "<b>Time remaning:</b> {0}\n".format(time_remaining_shown)
+    msg += "<b>Progress:</b> {0} {1}\n".format(progress_shown, progress_bar(res['progress']))
+    msg += "<b>Start Time:</b> {0}\n".format(start_time.strftime(time_format))
+    msg += "<b>End Time:</b> {0}".format(end_time.strftime(time_format))
+    return msg
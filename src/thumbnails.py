@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import io
+import re
+import zipfile
+import threading
+
+
+THUMBNAIL_PATH = '/Metadata/thumbnail.png'
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
+
+
+# Return (first byte, last byte, total size) from Content-Range header, None if it can not be parsed
+def parse_content_range(content_range):
+    match = CONTENT_RANGE_RE.match(content_range or '')
+    if match is None:
+        return None
+    return tuple(int(value) for value in match.groups())
+
+# Read thumbnail from container file. Return BytesIO, None if the container has no thumbnail.
+def read_thumbnail(container_file):
+    if not zipfile.is_zipfile(container_file):
+        return None
+
+    with zipfile.ZipFile(container_file, "r") as zf:
+        try:
+            thumbnail = zf.read(THUMBNAIL_PATH)
+        except KeyError:
+            return None
+
+    thumbnail = io.BytesIO(thumbnail)
+    thumbnail.seek(0)
+    return thumbnail
+
+
+class HttpRangeFile(io.RawIOBase):
+    # Read only seekable file over HTTP range requests, so zipfile can read the central directory
+    # and a single entry without downloading the whole container.
+    # fetch_range(start, end) returns bytes start..end (inclusive). Fetched blocks are kept, reads are rounded to block_size.
+    def __init__(self, fetch_range, size, block_size=64*1024, initial_offset=None, initial_data=None):
+        self.fetch_range = fetch_range
+        self.size = size
+        self.block_size = block_size
+        self.__position = 0
+        self.__blocks = []
+        if initial_data is not None:
+            self.__blocks.append((initial_offset, initial_data))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.__position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.__position = offset
+        elif whence == io.SEEK_CUR:
+            self.__position += offset
+        elif whence == io.SEEK_END:
+            self.__position = self.size + offset
+        self.__position = max(0, min(self.__position, self.size))
+        return self.__position
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.size - self.__position)
+        if count <= 0:
+            return 0
+
+        data = self.__read(self.__position, count)
+        buffer[:len(data)] = data
+        self.__position += len(data)
+        return len(data)
+
+    def __read(self, start, count):
+        for offset, data in self.__blocks:
+            if offset <= start and start + count <= offset + len(data):
+                return data[start - offset:start - offset + count]
+
+        end = min(self.size, max(start + count, start + self.block_size)) - 1
+        data = self.fetch_range(start, end)
+        self.__blocks.append((start, data))
+        return data[:count]
+
+
+class ThumbnailCache:
+    # Thumbnail of the current print job of one printer. The entry is keyed by the job uuid (or name) and start time,
+    # and is dropped when the poller sees another job.
+    def __init__(self, ultimaker):
+        self.ultimaker = ultimaker
+        self.__lock = threading.Lock()
+        self.__key = None
+        self.__thumbnail = None
+        # job key -> Event set when the running download of its thumbnail is done
+        self.__fetching = {}
+
+    @staticmethod
+    def job_key(printjob):
+        if printjob['status_code'] != 200:
+            return None
+        return (printjob.get('uuid') or printjob['print_name'], printjob['datetime_started'])
+
+    # Poller listener, drops the cached thumbnail when the job has changed
+    def on_snapshot(self, snapshot):
+        key = self.job_key(snapshot.printjob)
+        with self.__lock:
+            if key != self.__key:
+                self.__key = None
+                self.__thumbnail = None
+
+    # Same result as Ultimaker.get_printjob_thumbnail, printjob is the current Ultimaker.get_printjob_status result.
+    # The download runs without the lock, so the poller is never held up by it. Callers asking for the thumbnail
+    # of the same job while it is downloaded wait for that download instead of starting another.
+    def get(self, printjob):
+        key = self.job_key(printjob)
+
+        while True:
+            with self.__lock:
+                if key is not None and key == self.__key:
+                    return self.__result(self.__thumbnail)
+                fetching = self.__fetching.get(key) if key is not None else None
+                if fetching is None:
+                    fetching = threading.Event()
+                    if key is not None:
+                        self.__fetching[key] = fetching
+                    break
+            # if that download failed the thumbnail is not cached, and the next round downloads it again
+            fetching.wait()
+
+        try:
+            result = self.ultimaker.get_printjob_thumbnail()
+            if key is not None and result['status_code'] == 200 and result['has_thumbnail']:
+                with self.__lock:
+                    self.__key = key
+                    self.__thumbnail = result['thumbnail'].getvalue()
+            return result
+        finally:
+            with self.__lock:
+                self.__fetching.pop(key, None)
+            fetching.set()
+
+    def __result(self, thumbnail):
+        bio = io.BytesIO(thumbnail)
+        bio.seek(0)
+        return { 'status_code': 200, 'has_thumbnail': True, 'thumbnail': bio }
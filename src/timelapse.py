@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import re
+import time
+import shutil
+import datetime
+import threading
+import numpy as np
+from PIL import Image
+
+
+FRAME_NAME = 'frame_{:06d}.jpg'
+SIGNATURE_SIZE = (64, 48)
+
+
+class TimelapseRecorder:
+    # Records one print job: a thread takes a camera frame every interval and writes it straight to disk.
+    # With thin_threshold > 0 a frame is skipped when it differs from the last kept one by less than
+    # thin_threshold (mean absolute difference of small grayscale copies, 0..1).
+    # After stop() the recorder thread hands the frames to the encode executor and passes its Future with the path
+    # of the animation to on_encoding.
+    def __init__(self, camera, directory, job_name, interval, encode_executor, thin_threshold=0.0, max_size=480, max_frames=600):
+        self.camera = camera
+        self.interval = interval
+        self.encode_executor = encode_executor
+        self.thin_threshold = thin_threshold
+        self.max_size = max_size
+        self.max_frames = max_frames
+
+        self.job_name = job_name
+        safe_name = re.sub(r'[^\w\-]+', '_', job_name)
+        self.frames_dir = os.path.join(directory, '{}_{}'.format(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), safe_name))
+        self.output_path = self.frames_dir + '.gif'
+
+        self.frame_count = 0
+        self.skipped_count = 0
+        self.__last_signature = None
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__on_encoding = None
+
+    def start(self):
+        os.makedirs(self.frames_dir, exist_ok=True)
+        self.__thread = threading.Thread(target=self.__run, name='TimelapseRecorder', daemon=True)
+        self.__thread.start()
+
+    def is_recording(self):
+        return self.__thread is not None and not self.__stop.is_set()
+
+    # Stop recording without waiting, the recorder can be in the middle of a camera fetch. Encoding is started
+    # by the recorder thread when it ends, on_encoding is called there with its Future, not at all if no frames were recorded.
+    def stop(self, on_encoding=None):
+        self.__on_encoding = on_encoding
+        self.__stop.set()
+        if self.__thread is None:
+            self.__finish()
+
+    def __run(self):
+        while not self.__stop.is_set():
+            started = time.time()
+            frame = self.camera.get_frame(max_age=self.interval / 2.0)
+            if frame is not None:
+                try:
+                    self.__add_frame(frame)
+                except Exception as ex:
+                    print ('Timelapse: Could not add frame: {}'.format(ex))
+
+            self.__stop.wait(max(0, self.interval - (time.time() - started)))
+
+        self.__finish()
+
+    def __finish(self):
+        if self.frame_count == 0:
+            shutil.rmtree(self.frames_dir, ignore_errors=True)
+            return
+
+        try:
+            future = self.encode_executor.submit(encode_timelapse, self.frames_dir, self.output_path, self.max_size, self.max_frames)
+        except RuntimeError as ex:
+            print ('Timelapse: Could not start encoding {}: {}'.format(self.job_name, ex))
+            return
+        if self.__on_encoding is not None:
+            self.__on_encoding(future)
+
+    def __add_frame(self, frame):
+        if self.thin_threshold > 0:
+            signature = frame_signature(frame)
+            if self.__last_signature is not None:
+                diff = np.mean(np.abs(signature - self.__last_signature)) / 255.0
+                if diff < self.thin_threshold:
+                    self.skipped_count += 1
+                    return
+            self.__last_signature = signature
+
+        with open(os.path.join(self.frames_dir, FRAME_NAME.format(self.frame_count)), 'wb') as f:
+            f.write(frame)
+        self.frame_count += 1
+
+
+# Small grayscale copy of the frame, draft lets the jpeg decoder scale down while decoding
+def frame_signature(frame):
+    img = Image.open(io.BytesIO(frame))
+    img.draft('L', SIGNATURE_SIZE)
+    img = img.convert('L').resize(SIGNATURE_SIZE)
+    return np.asarray(img, dtype=np.int16)
+
+# Encode frames of the directory into an animated gif and remove the frames. Runs in the encode executor.
+# At most max_frames evenly spaced frames are used, so memory stays bounded however long the job was.
+def encode_timelapse(frames_dir, output_path, max_size=480, max_frames=600, frame_duration=100):
+    names = sorted(name for name in os.listdir(frames_dir) if name.endswith('.jpg'))
+    if len(names) > max_frames:
+        indexes = np.linspace(0, len(names) - 1, max_frames).astype(int)
+        names = [names[i] for i in indexes]
+
+    def load(name):
+        img = Image.open(os.path.join(frames_dir, name))
+        img.draft('RGB', (max_size, max_size))
+        img = img.convert('RGB')
+        img.thumbnail((max_size, max_size))
+        return img
+
+    first = load(names[0])
+    first.save(output_path, save_all=True, append_images=(load(name) for name in names[1:]), duration=frame_duration, loop=0)
+
+    shutil.rmtree(frames_dir, ignore_errors=True)
+    return output_path
@@ -4,10 +4,31 @@ import os
 import io
 import zipfile
 import time
-import numpy as np
-import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor
 #import arpreq
-from getmac import get_mac_address
+
+from .circuit_breaker import CircuitBreaker
+from .discovery import find_ip_by_mac
+from .metrics import observe_request, REDISCOVERIES, REQUEST_RETRIES, CIRCUIT_STATE, CIRCUIT_REJECTED
+from .mjpeg import MjpegFrameReader, parse_boundary
+from .thumbnails import HttpRangeFile, parse_content_range, read_thumbnail
+
+
+# bytes requested from the end of the print job container, enough for the zip central directory of a .ufp
+CONTAINER_TAIL_SIZE = 64 * 1024
+
+# (connect, read) timeouts in seconds by endpoint class, see endpoint_class.
+# The read timeout is the longest wait for the next bytes of the response, not for the whole response.
+REQUEST_TIMEOUTS = {
+    'status': (3.05, 5),
+    'control': (3.05, 10),
+    'transfer': (3.05, 60),
+    'camera': (3.05, 10)
+}
+
+# The printer could not be reached, or stopped answering in the middle of a response
+NETWORK_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
 
 
 class UltimakerError(Exception):
@@ -25,9 +46,25 @@ class Ultimaker:
     # @param ip: IP address of the printer   
     # @param application: name of the application in string form, used during authentication requests and is shown on the printer.   
     #def __init__(self, subnet, mac, application, auth_filename):
-    def __init__(self, application, config):
+    # @param ip_cache: IpCache shared by all printers, the last found ip is checked first on rediscovery.
+    # @param retries: times a GET is sent again after a network error, with retry_backoff seconds doubling between tries.
+    # @param breaker_failures, breaker_reset: failed calls in a row that open the circuit, and seconds it stays open.
+    def __init__(self, application, config, ip_cache=None, discovery_workers=32, timeouts=REQUEST_TIMEOUTS,
+                 retries=1, retry_backoff=0.5, breaker_failures=3, breaker_reset=30.0):
+        self.ip_cache = ip_cache
+        self.discovery_workers = discovery_workers
+        self.timeouts = timeouts
+        self.retries = retries
+        self.retry_backoff = retry_backoff
         self.load_config(config)
 
+        self.__breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        CIRCUIT_STATE.set_function(lambda: self.__breaker.state, printer=self.name)
+        # rediscovery runs in the background while the circuit is open, never in a user's request
+        self.__rediscovery = None
+        self.__rediscovery_lock = threading.Lock()
+        self.__rediscovery_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Rediscovery-{}'.format(self.name))
+
         if self.use_static_ip:
             self.set_printer_ip(self.printer_ip)
         else:
@@ -38,6 +75,7 @@ class Ultimaker:
 
         self.__application = application
         self.__session = requests.sessions.Session()       
+        self.__executor = ThreadPoolExecutor(max_workers=2)
  
         if not self.__check_auth():
             raise UltimakerError("Ultimaker: Authentication Failed")
@@ -47,6 +85,8 @@ class Ultimaker:
         self.printer_mac = config.PRINTER_MAC
         self.printer_subnet = config.PRINTER_SUBNET
         self.printer_ip = config.PRINTER_IP
+        self.camera_port = config.CAMERA_PORT
+        self.name = config.NAME
         
         ultimaker_id = config.ULTIMAKER_ID
         ultimaker_key = config.ULTIMAKER_KEY
@@ -61,28 +101,20 @@ class Ultimaker:
 
     # Get printer ip from mac. Return None if not found.
     def get_ip_from_mac(self):
-        for ip in ipaddress.IPv4Network(self.printer_subnet):
-            # try without network request
-            mac = get_mac_address(ip=str(ip))
-            # if we dont get mac from arp table try updating mac
-            if mac == '00:00:00:00:00:00':
-                mac = get_mac_address(ip=str(ip), network_request=True)
-            # if we dont get mac from arp table again, it probably was
-            if mac == '00:00:00:00:00:00':
-                mac = get_mac_address(ip=str(ip), network_request=True)
-
-            if mac is not None and mac.lower() == self.printer_mac.lower():
-                print ('host: ' + str(ip) + ', mac: ' + mac)
-                return str(ip)
-        return None
+        return find_ip_by_mac(self.printer_subnet, self.printer_mac, self.discovery_workers, self.ip_cache)
 
     # Set printer ip
     def set_printer_ip(self, ip):
         self.__ip = ip
 
+    # Camera stream runs on its own port of the printer host. PRINTER_IP may contain the api port (e.g. for a local fake printer).
+    def camera_url(self, action):
+        return "http://{}:{}/?action={}".format(self.__ip.split(':')[0], self.camera_port, action)
+
     # Reset printer IP from mac. Return True if success, False otherwise.
     def reset_printer_ip(self):
         ip = self.get_ip_from_mac()
+        REDISCOVERIES.inc(printer=self.name, result='found' if ip is not None else 'not_found')
         if ip is not None:
             self.set_printer_ip(ip)
             return True
@@ -96,25 +128,64 @@ class Ultimaker:
             return True
         return False
 
-    # Do a new HTTP request to the printer. It formats data as JSON, and fills in the IP part of the URL.   
+    # Do a new HTTP request to the printer. It formats data as JSON, and fills in the IP part of the URL.
+    # GETs are retried on network errors, other methods are sent once (a streamed upload could not be sent again anyway).
+    # Calls fail fast with UltimakerError while the circuit is open.
     def request(self, method, path, **kwargs):       
-        if "data" in kwargs:           
-            kwargs["data"] = json.dumps(kwargs["data"])           
+        # file like bodies (uploads) are streamed as they are
+        if "data" in kwargs and not hasattr(kwargs["data"], "read"):
+            kwargs["data"] = json.dumps(kwargs["data"])
         if "headers" not in kwargs:               
             kwargs["headers"] = {"Content-type": "application/json"}     
+        if "timeout" not in kwargs:
+            kwargs["timeout"] = self.timeouts[endpoint_class(method, path)]
+
+        if not self.__breaker.allow():
+            CIRCUIT_REJECTED.inc(printer=self.name)
+            raise UltimakerError('Ultimaker: Printer {} is not reachable, next try in {:.0f}s'.format(self.name, self.__breaker.retry_in()))
+
+        attempts = 1 + self.retries if method.lower() == 'get' else 1
+        for attempt in range(attempts):
+            if attempt > 0:
+                REQUEST_RETRIES.inc(printer=self.name, endpoint=path.split('?', 1)[0])
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            try:
+                response = self.__send(method, path, **kwargs)
+            except NETWORK_ERRORS as ex:
+                error = ex
+                continue
+            self.__breaker.record_success()
+            return response
+
+        if self.__breaker.record_failure():
+            self.__on_circuit_open()
+        raise UltimakerError('Ultimaker: Could not connect to printer at {} ({})'.format(self.__ip, type(error).__name__))
+
+    def __on_circuit_open(self):
+        print ('Ultimaker: {} is not reachable, requests fail fast for {:.0f}s'.format(self.name, self.__breaker.reset_timeout))
+        # a static ip can not change, the trial call after the reset timeout finds out if the printer is back
+        if self.use_static_ip:
+            return
+        with self.__rediscovery_lock:
+            if self.__rediscovery is None or self.__rediscovery.done():
+                self.__rediscovery = self.__rediscovery_executor.submit(self.__rediscover)
+
+    def __rediscover(self):
+        try:
+            if self.reset_printer_ip():
+                self.__breaker.allow_trial()
+        except Exception as ex:
+            print ('Ultimaker: rediscovery of {} failed: {}'.format(self.name, ex))
+
+    # Single timed request, recorded in the request metrics
+    def __send(self, method, path, **kwargs):
+        start = time.perf_counter()
         try:
             response = self.__session.request(method, "http://{}/{}".format(self.__ip, path), auth=self.__auth, **kwargs)
-        except requests.exceptions.ConnectionError:
-            if self.use_static_ip:
-                # try to find new ip
-                if self.reset_printer_ip():
-                    # try with new ip
-                    response = self.__session.request(method, "http://{}/{}".format(self.__ip, path), auth=self.__auth, **kwargs)
-                else:
-                    # ip not found
-                    raise UltimakerError('Ultimaker: Could not get printer IP')
-            else:
-                raise UltimakerError('Ultimaker: Could not connect to printer at {}'.format(self.__ip))
+        except requests.exceptions.RequestException as ex:
+            observe_request(self.name, method, path, time.perf_counter() - start, error=ex)
+            raise
+        observe_request(self.name, method, path, time.perf_counter() - start, response)
         return response
 
     # Shorthand function to do a "GET" request.   
@@ -130,170 +201,223 @@ class Ultimaker:
         return self.request("post", path, **kwargs)
 
     def get_printer_status(self):
-        response = self.get('api/v1/printer')
-        res = { 'status_code': response.status_code }
-
-        if response.status_code == 200:
-            status_json = response.json()
-
-            res['status'] = status_json['status']
-            res['bed_temp_cur'] = status_json['bed']['temperature']['current']
-            res['bed_temp_target'] = status_json['bed']['temperature']['target']
-
-            res['ext_1_temp_cur'] = status_json['heads'][0]['extruders'][0]['hotend']['temperature']['current']
-            res['ext_1_temp_target'] = status_json['heads'][0]['extruders'][0]['hotend']['temperature']['target']
-            res['ext_1_feeder_max_speed'] = status_json['heads'][0]['extruders'][0]['feeder']['max_speed']
-        
-        return res
+        return parse_printer_status(self.get('api/v1/printer'))
 
     def get_printjob_status(self):
-        response = self.get('api/v1/print_job')
-
-        res = { 'status_code': response.status_code }
-
-        if response.status_code == 200:
-            status_json = response.json()
-        
-            res['status'] = status_json['state']
-            res['time_total'] = status_json['time_total']
-            res['time_elapsed'] = status_json['time_elapsed']
-            res['print_name'] = status_json['name']
-            res['progress'] = status_json['progress']
-            res['datetime_started'] = status_json['datetime_started']
-            res['datetime_finished'] = status_json['datetime_finished']
-            res['pause_source'] = status_json['pause_source']
-
-        return res
+        return parse_printjob_status(self.get('api/v1/print_job'))
 
+    # Printer status and print job are requested at the same time, state and pause source both come with api/v1/print_job.
     def get_printer_state(self):
-        response = self.get('api/v1/printer/status')
+        status_future = self.__executor.submit(self.get, 'api/v1/printer/status')
+        printjob_future = self.__executor.submit(self.get, 'api/v1/print_job')
 
-        res = { 'status_code': response.status_code }
-        if response.status_code == 200:
-            res['printer_status'] = response.json()
-
-            if res['printer_status'] == 'printing':
-                result = self.get_printjob_state()
-                res['printjob_state'] = result['printjob_state']
-                if result['printjob_state'] == 'paused':
-                    pause_source_result = self.get_printjob_pause_source()
-                    res['pause_source'] = pause_source_result['pause_source']
-            else:
-                res['printjob_state'] = 'no_printjob'
+        return parse_printer_state(status_future.result(), printjob_future.result())
 
-        return res 
+    # api/v1/printer and api/v1/print_job requested at the same time. Return (printer status, print job status).
+    def get_printer_and_printjob_status(self):
+        printer_future = self.__executor.submit(self.get_printer_status)
+        printjob_future = self.__executor.submit(self.get_printjob_status)
 
-    def get_printjob_state(self):
-        response = self.get('api/v1/print_job/state')
+        return printer_future.result(), printjob_future.result()
 
-        res = { 'status_code': response.status_code }
-        if response.status_code == 200:
-            res['printjob_state'] = response.json()
-        else:
-            res['printjob_state'] = 'no_printjob'
-
-        return res 
+    def get_printjob_state(self):
+        return parse_json_value(self.get('api/v1/print_job/state'), 'printjob_state', 'no_printjob')
 
     def get_printjob_pause_source(self):
-        response = self.get('api/v1/print_job/pause_source')
+        return parse_json_value(self.get('api/v1/print_job/pause_source'), 'pause_source', '')
 
-        res = { 'status_code': response.status_code }
-        if response.status_code == 200:
-            res['pause_source'] = response.json()
-        else:
-            res['pause_source'] = ''
+    # Entries of the printer event log, newest first, each with time, type_id, message and parameters
+    def get_history_events(self, offset=0, count=20):
+        return parse_json_value(self.get('api/v1/history/events', params={'offset': offset, 'count': count}), 'events')
 
-        return res 
+    # Yield camera frames continuously as memoryviews, each is valid until the next one is requested.
+    def iter_printer_frames(self):
+        stream = self.__session.get(self.camera_url("stream"), stream=True, timeout=self.timeouts['camera'])
+        try:
+            reader = MjpegFrameReader(parse_boundary(stream.headers.get('Content-Type')))
+            for frame in reader.iter_frames(lambda buffer: read_available(stream.raw, buffer)):
+                yield frame
+        finally:
+            stream.close()
 
     def get_printer_image(self):
-        stream = self.__session.get("http://{}:8080/?action=stream".format(self.__ip), stream=True)
-        read_bytes = bytes()
-
-        for chunk in stream.iter_content(chunk_size=1024):
-            read_bytes += chunk
-            jpg_start = read_bytes.find(b'\xff\xd8')
-            jpg_end = read_bytes.find(b'\xff\xd9')
-
-            if jpg_start != -1 and jpg_end != -1:
-                jpg = read_bytes[jpg_start:jpg_end+2]
-                img_np = np.frombuffer(jpg, dtype=np.uint8)
-                bio = io.BytesIO(img_np)
+        frames = self.iter_printer_frames()
+        try:
+            for frame in frames:
+                bio = io.BytesIO(frame)
                 bio.seek(0)
-                return bio 
+                return bio
+        finally:
+            frames.close()
     
     def get_camera_snapshot(self):
         #response = self.get('camera/0/snapshot', stream=True)
-        response = self.__session.get("http://{}:8080/?action=snapshot".format(self.__ip), stream=True)
+        response = self.__session.get(self.camera_url("snapshot"), stream=True, timeout=self.timeouts['camera'])
         bio = io.BytesIO(response.content)
         bio.seek(0)
         return bio
 
     def get_led_brightness(self):
-        response = self.get('api/v1/printer/led/brightness')
-
-        res = {}
-        res['status_code'] = response.status_code
-
-        if res['status_code'] == 200:
-            res['level'] = response.json()
-
-        return res           
+        return parse_json_value(self.get('api/v1/printer/led/brightness'), 'level')
 
     def set_led_brightness(self, brightness):
-        response = self.put('api/v1/printer/led/brightness', data=brightness)
-
-        res = response.json()
-        res['status_code'] = response.status_code
-
-        return res
+        return parse_put_result(self.put('api/v1/printer/led/brightness', data=brightness))
 
     def pause_printjob(self):
-        response = self.put('api/v1/print_job/state', data={'target': 'pause'})
-
-        res = response.json()
-        res['status_code'] = response.status_code
-
-        return res
+        return parse_put_result(self.put('api/v1/print_job/state', data={'target': 'pause'}))
 
     def unpause_printjob(self):
-        response = self.put('api/v1/print_job/state', data={'target': 'print'})
-
-        res = response.json()
-        res['status_code'] = response.status_code
-
-        return res
+        return parse_put_result(self.put('api/v1/print_job/state', data={'target': 'print'}))
 
     def print_model(self, name, path):
         # api.post("api/v1/print_job", files={"file": ("UM3_Box_20x20x10.gcode", open("UM3_Box_20x20x10.gcode", "rb"))})
-        #with open(path, 'rb') as f:
-        response = self.post('api/v1/print_job', files={"file": (name, open(path, 'rb'))})
+        with open(path, 'rb') as f:
+            # multipart sets its own content type
+            response = self.post('api/v1/print_job', files={"file": (name, f)}, headers={})
 
         return response
 
+    # Upload model from a MultipartUploadStream without holding the file in memory or on disk.
+    def print_model_stream(self, stream):
+        # a streamed body can not be sent twice, so get the digest nonce first and the upload is not answered with 401
+        self.get("api/v1/auth/verify")
+        return self.post('api/v1/print_job', data=stream, headers={"Content-Type": stream.content_type})
+
     def get_printjob_container(self):
         response = self.get('api/v1/print_job/container')
 
         return response
 
+    # Only the end of the container (zip central directory) and the thumbnail entry are read with range requests.
+    # If the printer does not support ranges it answers the first request with the whole container.
     def get_printjob_thumbnail(self):
-        response = self.get_printjob_container()
-        result = { 'status_code': response.status_code }
-        #open('test_container', 'wb').write(result.content)
+        response = self.get('api/v1/print_job/container', headers={"Range": "bytes=-{}".format(CONTAINER_TAIL_SIZE)})
+        if response.status_code != 206:
+            return parse_thumbnail(response)
+
+        content_range = parse_content_range(response.headers.get('Content-Range'))
+        if content_range is None:
+            return parse_thumbnail(self.get_printjob_container())
+
+        first, last, size = content_range
+        container_file = HttpRangeFile(self.get_printjob_container_range, size, initial_offset=first, initial_data=response.content)
+        thumbnail = read_thumbnail(container_file)
+
+        result = { 'status_code': 200, 'has_thumbnail': thumbnail is not None }
+        if thumbnail is not None:
+            result['thumbnail'] = thumbnail
+        return result
+
+    def get_printjob_container_range(self, start, end):
+        response = self.get('api/v1/print_job/container', headers={"Range": "bytes={}-{}".format(start, end)})
+        if response.status_code == 206:
+            return response.content
         if response.status_code == 200:
-            container_file = io.BytesIO(response.content)
-            container_file.seek(0)
-            if zipfile.is_zipfile(container_file):
-                zf = zipfile.ZipFile(container_file, "r")
-                thumbnail = zf.open('/Metadata/thumbnail.png').read()
-                zf.close()
-                result['has_thumbnail'] = True
-                thumbnail = io.BytesIO(thumbnail)
-                thumbnail.seek(0)
-                result['thumbnail'] = thumbnail
+            return response.content[start:end + 1]
+        raise UltimakerError('Ultimaker: Could not read print job container ({})'.format(response.status_code))
+
+
+# Endpoint class of a request, selects its timeouts. The print job container and model uploads move whole files,
+# every other request has a small json body: GETs only read state, PUTs and POSTs change it.
+def endpoint_class(method, path):
+    if path.startswith('api/v1/print_job/container') or (method.lower() == 'post' and path == 'api/v1/print_job'):
+        return 'transfer'
+    if method.lower() == 'get':
+        return 'status'
+    return 'control'
+
+# Read what the stream has available into buffer, readinto would wait until the whole buffer is filled
+# and hold back frames of a slow camera stream. urllib3 before 2.0 has no read1, it reads in small blocks instead.
+def read_available(raw, buffer, block_size=4096):
+    if hasattr(raw, 'read1'):
+        data = raw.read1(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+    return raw.readinto(buffer[:block_size])
+
+# Response parsers shared by Ultimaker and AsyncUltimaker, both response types have status_code, json() and content.
+def parse_printer_status(response):
+    res = { 'status_code': response.status_code }
+
+    if response.status_code == 200:
+        status_json = response.json()
+
+        res['status'] = status_json['status']
+        res['bed_temp_cur'] = status_json['bed']['temperature']['current']
+        res['bed_temp_target'] = status_json['bed']['temperature']['target']
+
+        res['ext_1_temp_cur'] = status_json['heads'][0]['extruders'][0]['hotend']['temperature']['current']
+        res['ext_1_temp_target'] = status_json['heads'][0]['extruders'][0]['hotend']['temperature']['target']
+        res['ext_1_feeder_max_speed'] = status_json['heads'][0]['extruders'][0]['feeder']['max_speed']
+
+    return res
+
+def parse_printjob_status(response):
+    res = { 'status_code': response.status_code }
+
+    if response.status_code == 200:
+        status_json = response.json()
+
+        res['status'] = status_json['state']
+        res['time_total'] = status_json['time_total']
+        res['time_elapsed'] = status_json['time_elapsed']
+        res['print_name'] = status_json['name']
+        res['progress'] = status_json['progress']
+        res['datetime_started'] = status_json['datetime_started']
+        res['datetime_finished'] = status_json['datetime_finished']
+        res['pause_source'] = status_json['pause_source']
+        res['uuid'] = status_json.get('uuid')
+
+    return res
+
+# api/v1/printer/status and api/v1/print_job of Ultimaker.get_printer_state, the state and pause source come with the print job
+def parse_printer_state(status_response, printjob_response):
+    res = { 'status_code': status_response.status_code }
+    if status_response.status_code == 200:
+        res['printer_status'] = status_response.json()
+
+        if res['printer_status'] == 'printing':
+            if printjob_response.status_code == 200:
+                printjob_json = printjob_response.json()
+                res['printjob_state'] = printjob_json['state']
+                if res['printjob_state'] == 'paused':
+                    res['pause_source'] = printjob_json['pause_source']
             else:
-                result['has_thumbnail'] = False
+                res['printjob_state'] = 'no_printjob'
+        else:
+            res['printjob_state'] = 'no_printjob'
 
-        return result
+    return res
+
+# Endpoints that return a single json value. default is used when the request failed, if it is None the key is left out.
+def parse_json_value(response, key, default=None):
+    res = { 'status_code': response.status_code }
+
+    if response.status_code == 200:
+        res[key] = response.json()
+    elif default is not None:
+        res[key] = default
+
+    return res
+
+def parse_put_result(response):
+    res = response.json()
+    res['status_code'] = response.status_code
+
+    return res
+
+def parse_thumbnail(response):
+    result = { 'status_code': response.status_code }
+    #open('test_container', 'wb').write(result.content)
+    if response.status_code == 200:
+        container_file = io.BytesIO(response.content)
+        container_file.seek(0)
+        thumbnail = read_thumbnail(container_file)
+        result['has_thumbnail'] = thumbnail is not None
+        if thumbnail is not None:
+            result['thumbnail'] = thumbnail
+
+    return result
 
 
 if __name__ == '__main__':
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import time
+import uuid
+import queue
+import threading
+import requests
+
+
+class UploadError(Exception):
+    """Base error for model upload.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+class SpoolBuffer:
+    # Bounded chunk queue between a downloading thread and the upload: at most max_chunks chunks are held in memory,
+    # the download waits when the upload is slower.
+    END = object()
+
+    def __init__(self, max_chunks=16):
+        self.__queue = queue.Queue(maxsize=max_chunks)
+        self.__cancelled = threading.Event()
+
+    def put(self, chunk):
+        while not self.__cancelled.is_set():
+            try:
+                self.__queue.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def finish(self, error=None):
+        self.put(error if error is not None else self.END)
+
+    def cancel(self):
+        self.__cancelled.set()
+
+    def get(self, timeout=None):
+        try:
+            item = self.__queue.get(timeout=timeout)
+        except queue.Empty:
+            raise UploadError('Upload: Timed out waiting for file data')
+
+        if isinstance(item, Exception):
+            raise UploadError('Upload: Download failed: {}'.format(item))
+        return item
+
+
+# Download url into the spool in a background thread
+def spool_download(url, spool, chunk_size=64*1024):
+    def download():
+        try:
+            with requests.get(url, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if not spool.put(chunk):
+                        return
+            spool.finish()
+        except Exception as ex:
+            spool.finish(ex)
+
+    thread = threading.Thread(target=download, name='ModelDownload', daemon=True)
+    thread.start()
+    return thread
+
+
+class MultipartUploadStream:
+    # File like multipart/form-data body with one file field, read by requests block by block.
+    # len is the Content-Length, so the printer gets a normal (not chunked) request.
+    def __init__(self, field, file_name, file_size, spool, progress_callback=None, timeout=60):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        self.file_size = file_size
+        self.progress_callback = progress_callback
+        self.timeout = timeout
+
+        file_name = file_name.replace('"', '')
+        self.__preamble = ('--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                           'Content-Type: application/octet-stream\r\n\r\n').format(self.boundary, field, file_name).encode('utf-8')
+        self.__epilogue = '\r\n--{0}--\r\n'.format(self.boundary).encode('utf-8')
+        self.len = len(self.__preamble) + file_size + len(self.__epilogue)
+
+        self.__spool = spool
+        self.__pending = memoryview(self.__preamble)
+        self.__file_done = False
+        self.__epilogue_sent = False
+        self.sent = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+
+        while len(self.__pending) == 0:
+            if not self.__file_done:
+                chunk = self.__spool.get(self.timeout)
+                if chunk is SpoolBuffer.END:
+                    self.__file_done = True
+                    continue
+                self.__pending = memoryview(chunk)
+            elif not self.__epilogue_sent:
+                self.__epilogue_sent = True
+                self.__pending = memoryview(self.__epilogue)
+            else:
+                return b''
+
+        data = self.__pending[:size].tobytes()
+        self.__pending = self.__pending[len(data):]
+        self.sent += len(data)
+        if self.progress_callback is not None:
+            self.progress_callback(self.sent, self.len)
+        return data
+
+
+class UploadProgressMessage:
+    # Telegram message edited in place with the upload progress, at most every min_interval seconds
+    def __init__(self, bot, chat_id, title, min_interval=2.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.title = title
+        self.min_interval = min_interval
+        self.__last_update = 0
+        self.__last_text = None
+        self.__message = bot.send_message(chat_id=chat_id, text=self.render(0))
+
+    def render(self, percent):
+        return '{}\n  Uploading: {}%'.format(self.title, percent)
+
+    def update(self, sent, total):
+        now = time.time()
+        if now - self.__last_update < self.min_interval and sent < total:
+            return
+        self.__last_update = now
+        self.set_text(self.render(int(100 * sent / total) if total else 100))
+
+    def set_text(self, text):
+        if text == self.__last_text:
+            return
+        self.__last_text = text
+        try:
+            self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.__message.message_id, text=text)
+        except Exception as ex:
+            print ('Upload: Could not update progress message: {}'.format(ex))
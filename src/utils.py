@@ -3,8 +3,14 @@
 from telegram.ext import Updater, CallbackContext
 from telegram import Update, ChatAction
 from telegram import KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.utils.request import Request
 from functools import wraps
+from contextlib import contextmanager
 import sys
+import time
+import threading
+
+from .metrics import TELEGRAM_SEND_SECONDS, TELEGRAM_SEND_ERRORS
 
 
 def build_inline_keyboard(layout):
@@ -45,3 +51,52 @@ send_typing_action = send_action(ChatAction.TYPING)
 send_upload_video_action = send_action(ChatAction.UPLOAD_VIDEO)
 send_upload_photo_action = send_action(ChatAction.UPLOAD_PHOTO)
 
+
+class TimedRequest(Request):
+    # Bot api connection that records the duration of each call (sendMessage, sendPhoto, ...) in the metrics
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        except Exception as ex:
+            TELEGRAM_SEND_ERRORS.inc(method=method, error=type(ex).__name__)
+            raise
+        finally:
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - start, method=method)
+
+
+class StartupProfile:
+    # Time spent in each startup phase, printed with start.py --profile-startup.
+    # Phases are timed from start (e.g. before the imports of start.py), some run in the printer attach thread.
+    def __init__(self, enabled=False, start=None):
+        self.enabled = enabled
+        self.start = start if start is not None else time.perf_counter()
+        self.__phases = []
+        self.__lock = threading.Lock()
+
+    def record(self, name, begin, end=None):
+        end = end if end is not None else time.perf_counter()
+        with self.__lock:
+            self.__phases.append((name, begin - self.start, end - begin))
+
+    @contextmanager
+    def phase(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, begin)
+
+    # Point in time without duration, e.g. when the first update can be answered
+    def mark(self, name):
+        self.record(name, time.perf_counter())
+
+    def report(self):
+        if not self.enabled:
+            return
+        with self.__lock:
+            phases = sorted(self.__phases, key=lambda phase: phase[1])
+        print ('Startup profile (ms):')
+        for name, offset, duration in phases:
+            print ('  {:<20} at {:8.1f}  took {:8.1f}'.format(name, offset * 1000, duration * 1000))
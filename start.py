@@ -1,23 +1,33 @@
 import sys
+import time
+START = time.perf_counter()
+
 from src.printer_bot import PrinterBot, BotError
 from src.ultimaker import UltimakerError
 from src.settings import load_settings, SettingsError
+from src.utils import StartupProfile
 
 if __name__ == '__main__':
     print (sys.argv)
-    
-    if len(sys.argv) > 1:
-        env_file = sys.argv[1]
+
+    # --profile-startup prints the time spent in each startup phase once the printers are connected
+    profile = StartupProfile(enabled='--profile-startup' in sys.argv, start=START)
+    profile.record('imports', START)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) > 0:
+        env_file = args[0]
     else:
         env_file = 'start'
-    
-    config = load_settings('./config', env_file)
+
+    with profile.phase('settings'):
+        config = load_settings('./config', env_file)
 
     print (config.__dict__)
 
     try:
         #PrinterBot(config_path='config/config.json', users_path='config/authorized_users.json', ultimker_auth_file='config/ultimker_auth_file.json')
-        PrinterBot(config=config, users_path='config/authorized_users.json')
+        PrinterBot(config=config, users_path='config/authorized_users.json', profile=profile)
     except UltimakerError as uer:
         print (uer.message)
     except BotError as ber: